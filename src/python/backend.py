@@ -0,0 +1,88 @@
+'''
+Backend selection for the driver and the Lambda handlers
+
+By default every component talks to S3 and Lambda through boto3. Setting
+BL_BACKEND=local (or "backend": "local" in driverconfig.json) swaps both
+clients for the filesystem-backed stand-ins in localbackend.py, so a whole
+job can run on one box without an AWS account.
+
+Copyright 2016 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+'''
+
+import os
+
+BACKEND_ENV = "BL_BACKEND"
+LOCAL_ROOT_ENV = "BL_LOCAL_ROOT"
+
+AWS = "aws"
+LOCAL = "local"
+
+def use_local(root):
+    '''
+    Switch this process (and every process it forks) to the local backend
+    '''
+    os.environ[BACKEND_ENV] = LOCAL
+    os.environ[LOCAL_ROOT_ENV] = os.path.abspath(root)
+
+def is_local():
+    return os.environ.get(BACKEND_ENV, AWS) == LOCAL
+
+def local_root():
+    return os.environ[LOCAL_ROOT_ENV]
+
+# Clients of this process, by service and backend
+_clients = {}
+
+def _client(service, config):
+    if config is not None:
+        return _new_client(service, config)
+    # A forked process (the local worker pool) makes its own
+    key = (service, os.getpid(), os.environ.get(BACKEND_ENV), os.environ.get(LOCAL_ROOT_ENV))
+    if key not in _clients:
+        _clients[key] = _new_client(service, None)
+    return _clients[key]
+
+def _new_client(service, config):
+    if is_local():
+        import localbackend
+        if service == 's3':
+            return localbackend.LocalS3Client(local_root())
+        return localbackend.LocalLambdaClient(local_root())
+    import boto3
+    client = boto3.client(service, config=config)
+    if service == 's3':
+        _add_if_none_match(client)
+    return client
+
+def _add_if_none_match(client):
+    '''
+    Conditional writes (put_object(IfNoneMatch="*")) on a botocore from
+    before S3 had them: the parameter is taken out before validation and
+    sent as its header
+    '''
+    members = client.meta.service_model.operation_model('PutObject').input_shape.members
+    if 'IfNoneMatch' in members:
+        return
+    def take(params, context, **kwargs):
+        if 'IfNoneMatch' in params:
+            context['if_none_match'] = params.pop('IfNoneMatch')
+    def send(params, context, **kwargs):
+        if 'if_none_match' in context:
+            params['headers']['If-None-Match'] = context['if_none_match']
+    client.meta.events.register('before-parameter-build.s3.PutObject', take)
+    client.meta.events.register('before-call.s3.PutObject', send)
+
+def s3_client(config=None):
+    '''
+    The S3 client of this process, created on first use, so a handler
+    container makes it once and only when it needs it. A config gives a
+    new, unshared client.
+    '''
+    return _client('s3', config)
+
+def lambda_client(config=None):
+    '''
+    The Lambda client of this process; see s3_client
+    '''
+    return _client('lambda', config)
@@ -6,7 +6,8 @@
  SPDX-License-Identifier: MIT-0
 '''
 
-import boto3
+import backend
+import calendar
 import json
 import math
 import random
@@ -15,12 +16,18 @@ import StringIO
 import sys
 import time
 
+import invoker
+import jobspec
 import lambdautils
+import manifest
+import metrics
+import partials
+import sampler
+import scheduler
 
 import glob
-import subprocess 
-from multiprocessing.dummy import Pool as ThreadPool
 from functools import partial
+from multiprocessing.dummy import Pool as ThreadPool
 
 from botocore.client import Config
 import logging
@@ -34,25 +41,29 @@ SAMPLING_RULES = {"version": 1, "default": {"fixed_target": 1, "rate": 1}}
 xray_recorder.configure(sampling_rules=SAMPLING_RULES)
 
 xray_recorder.begin_segment('Map Reduce Driver')
-# create an S3 session
-s3 = boto3.resource('s3')
-s3_client = boto3.client('s3')
 
 JOB_INFO = 'jobinfo.json'
 
+# Helper modules packaged with every Lambda function
+LAMBDA_LIBS = ["lambdautils.py", "backend.py", "s3reader.py", "intermediate.py", "numpyengine.py",
+        "jobspec.py", "metrics.py", "sketches.py", "invoker.py"]
+
 ### UTILS ####
-@xray_recorder.capture('zipLambda')
-def zipLambda(fname, zipname):
-    # faster to zip with shell exec
-    subprocess.call(['zip', zipname] + glob.glob(fname) + glob.glob(JOB_INFO) +
-                        glob.glob("lambdautils.py"))
+def code_files(fname):
+    # handler, job spec and helper modules of a function
+    return glob.glob(fname) + glob.glob(job_spec) + sum([glob.glob(lib) for lib in LAMBDA_LIBS], [])
+
+def lambda_files(fname):
+    # code and job config of a function
+    return code_files(fname) + glob.glob(JOB_INFO)
 
 @xray_recorder.capture('write_to_s3')
 def write_to_s3(bucket, key, data, metadata):
-    s3.Bucket(bucket).put_object(Key=key, Body=data, Metadata=metadata)
+    s3_client.put_object(Bucket=bucket, Key=key, Body=data, Metadata=metadata)
 
 @xray_recorder.capture('write_job_config')
-def write_job_config(job_id, job_bucket, n_mappers, r_func, r_handler):
+def write_job_config(job_id, job_bucket, n_mappers, r_func, r_handler, prefetch, n_partitions,
+        out_format, job_spec, reducer_mode, reducer_planner):
     fname = "jobinfo.json"; 
     with open(fname, 'w') as f:
         data = json.dumps({
@@ -60,7 +71,16 @@ def write_job_config(job_id, job_bucket, n_mappers, r_func, r_handler):
             "jobBucket" : job_bucket,
             "mapCount": n_mappers,
             "reducerFunction": r_func,
-            "reducerHandler": r_handler
+            "reducerHandler": r_handler,
+            "prefetch": prefetch,
+            "nPartitions": n_partitions,
+            "intermediateFormat": out_format,
+            "jobSpec": job_spec,
+            "reducerMode": reducer_mode,
+            "lambdaMemory": lambda_memory,
+            "concurrentLambdas": concurrent_lambdas,
+            "invokeConcurrency": invoke_concurrency,
+            "reducerPlanner": reducer_planner
             }, indent=4);
         f.write(data)
 
@@ -83,22 +103,204 @@ lambda_memory = config["lambdaMemory"]
 concurrent_lambdas = config["concurrentLambdas"]
 lambda_read_timeout = config["lambda_read_timeout"]
 boto_max_connections = config["boto_max_connections"]
+prefetch = config.get("prefetch", {})
+# Hash-partitioned shuffle into this many reducers / result shards, or
+# "auto" to estimate it from a sample of the input; 0 merges mapper
+# outputs in a tree of reducer steps into one result
+n_partitions = config.get("shufflePartitions", 0)
+# Format of mapper outputs and reducer step outputs: "json" or "binary"
+out_format = config.get("intermediateFormat", "json")
+# Job spec module with the map, combine and reduce functions, packaged
+# with the mapper and reducer
+job_spec = config.get("jobSpec", jobspec.DEFAULT_SPEC)
+if out_format == "binary" and not jobspec.load(job_spec).binary_ok():
+    print "%s does not have str keys and float accumulators, using the json format" % job_spec
+    out_format = "json"
+# Reducers: "dict" loads all their inputs into one dict; "merge" streams a
+# k-way merge of the sorted binary intermediates, for much larger fan-in
+reducer_mode = config.get("reducerMode", "dict")
+if reducer_mode == "merge" and out_format != "binary":
+    if jobspec.load(job_spec).binary_ok():
+        print "The merge reducer reads sorted binary intermediates, using the binary format"
+        out_format = "binary"
+    else:
+        print "%s cannot use the binary format the merge reducer reads, using dict reducers" % job_spec
+        reducer_mode = "dict"
+# Mapper parsing: "python" line loop or "numpy" vectorized blocks
+mapper_engine = config.get("mapperEngine", "python")
+# Decompressed bytes per byte of gzip or bz2 input, by codec, for sizing
+# splits and batches (see s3reader.COMPRESSION_RATIOS)
+compression_ratios = config.get("compressionRatio")
+# Keep the functions after the job, so the next run with the same code and
+# job config reuses them (and their warm containers) instead of deploying
+keep_warm = config.get("keepWarm", False)
+# Backup copies of straggling mappers and reducers; off unless configured
+speculation = scheduler.Speculation.from_config(config.get("speculation"))
+# Mappers: "sync" holds a RequestResponse call open per running mapper;
+# "event" launches them as Event invocations and polls for their outputs
+mapper_invocation = config.get("mapperInvocation", "sync")
+# Event invocations in flight at once, in the driver and the coordinator
+invoke_concurrency = config.get("invokeConcurrency", invoker.CONCURRENCY)
+
+# "local" runs the whole job on this box, see localbackend.py
+if config.get("backend") == backend.LOCAL:
+    backend.use_local(config["localRoot"])
+
+# create an S3 session
+s3_client = backend.s3_client()
 
 # Setting longer timeout for reading lambda results and larger connections pool
 lambda_config = Config(read_timeout=lambda_read_timeout, max_pool_connections=boto_max_connections)
-lambda_client = boto3.client('lambda', config=lambda_config)
-
-# Fetch all the keys that match the prefix
-all_keys = []
-for obj in s3.Bucket(bucket).objects.filter(Prefix=config["prefix"]).all():
-    all_keys.append(obj)
-
-bsize = lambdautils.compute_batch_size(all_keys, lambda_memory, concurrent_lambdas)
-batches = lambdautils.batch_creator(all_keys, bsize)
-n_mappers = len(batches)
+lambda_client = backend.lambda_client(config=lambda_config)
+if backend.is_local():
+    lambda_client.start(config.get("localWorkers"))
+event_invoker = invoker.Invoker(lambda_client, min(invoke_concurrency, boto_max_connections))
+
+# The split plan of the job is saved with it. With "resume", a run picks up
+# the saved plan of an earlier run of the job, and only runs the mappers
+# and reducers that did not write their output.
+resume = config.get("resume", False)
+plan_key = job_id + "/plan"
+plan_settings = {"bucket": bucket, "prefix": config["prefix"], "nPartitions": n_partitions,
+        "intermediateFormat": out_format, "jobSpec": job_spec, "reducerMode": reducer_mode}
+# With "incremental", mapper outputs are cached by the ETags of their
+# splits and reused by later runs, see partials.py
+incremental = config.get("incremental", False)
+reducer_planner = config.get("reducerPlanner")
+plan = lambdautils.get_json(s3_client, job_bucket, plan_key) if resume else None
+if plan is not None and plan["settings"] != plan_settings:
+    print "Cannot resume: the job settings changed since the saved plan", plan["settings"]
+    if backend.is_local():
+        lambda_client.shutdown()
+    sys.exit(1)
+
+cache = None
+if plan is not None:
+    print "Resuming job %s from its saved plan" % job_id
+    n_partitions = plan["nPartitions"]
+    lambda_memory = plan["lambdaMemory"]
+    reducer_planner = plan["reducerPlanner"]
+    split_size = plan["splitSize"]
+    bsize = plan["batchSize"]
+    batches = [[{"Key": key, "Start": start, "End": end, "ETag": etag,
+            "Size": lambdautils.uncompressed_size(key, end - start + 1, compression_ratios)}
+            for key, start, end, etag in batch] for batch in plan["batches"]]
+    n_files, n_splits = plan["totalS3Files"], plan["totalSplits"]
+    cached = plan["cached"]
+    sample_summary = plan["sample"]
+    if cached or incremental:
+        # The cached outputs of the plan are restored from the cache that
+        # planned them, whether or not this run is incremental
+        cache = partials.PartialCache(s3_client, job_bucket, plan.get("cacheNamespace") or
+                partials.namespace(code_files(config["mapper"]["name"]), out_format,
+                    n_partitions), n_partitions)
+        cache.keep([h for m_id, h in cached])
+else:
+    if resume:
+        print "No saved plan for job %s, starting it from scratch" % job_id
+
+    # Fetch all the keys that match the prefix, listing sub-prefixes in
+    # parallel, or reuse the manifest of a recent run
+    all_keys = manifest.get_manifest(s3_client, bucket, config["prefix"], job_bucket,
+            config.get("manifest"))
+
+    # Optional sampling pre-pass: the map function on a few byte ranges of
+    # the input tells how large the mapper outputs and the key set get
+    total_bytes = sum(lambdautils.uncompressed_size(key['Key'], key['Size'], compression_ratios)
+            for key in all_keys)
+    sample, sample_summary = None, None
+    max_batch_bytes = lambdautils.mapper_batch_bytes(lambda_memory)
+    if config.get("sampling") is not None or n_partitions == sampler.AUTO:
+        sample = sampler.take(s3_client, bucket, all_keys, jobspec.load(job_spec), out_format,
+                config.get("sampling"))
+    if sample is not None:
+        sample_summary = sample.summary(total_bytes)
+        print "Sample of the input:", json.dumps(sample_summary)
+        max_batch_bytes = min(max_batch_bytes,
+                sample.max_input_bytes(sampler.data_memory(lambda_memory)))
+
+    # Cut large objects into byte ranges so the number of mappers follows the
+    # number of bytes, not the number of objects
+    split_size = config.get("splitSize") or lambdautils.compute_split_size(all_keys,
+            lambda_memory, concurrent_lambdas, max_batch_bytes, compression_ratios)
+    splits = lambdautils.split_creator(all_keys, split_size, compression_ratios)
+    n_files, n_splits = len(all_keys), len(splits)
+
+    if n_partitions == sampler.AUTO:
+        # About one mapper per split
+        n_partitions = sampler.shuffle_partitions(sample, total_bytes, n_splits, lambda_memory,
+                concurrent_lambdas) if sample is not None else 0
+        print "Shuffle partitions from the sample:", n_partitions
+    if sample is not None:
+        memory = sampler.reducer_memory(sample, total_bytes, n_partitions, lambda_memory)
+        if memory > lambda_memory:
+            print "Raising lambdaMemory to %s MB for the largest reducer" % memory
+            lambda_memory = memory
+        # How a reducer round shrinks the data, until the first round tells
+        reducer_planner = dict(reducer_planner or {})
+        reducer_planner.setdefault("keyGrowth", sample.growth)
+
+    reused = []
+    if incremental:
+        cache = partials.PartialCache(s3_client, job_bucket,
+                partials.namespace(code_files(config["mapper"]["name"]), out_format,
+                    n_partitions), n_partitions)
+        # The default split size grows with the input; objects in the cache
+        # are cut as they were, so that their splits match
+        splits = lambdautils.split_creator(all_keys, split_size, compression_ratios,
+                cache.split_sizes())
+        n_splits = len(splits)
+        # Only the splits without a cached output are mapped. Mapper ids
+        # change between runs, so the outputs of the last run go first.
+        reused, splits = cache.claim(splits)
+        print "Reusing %s cached mapper outputs; %s of %s splits are new or changed" % (
+                len(reused), len(splits), n_splits)
+        # The outputs of the last run go, but its plan stays until the new
+        # one replaces it: a run that stops before then can still resume
+        lambdautils.delete_keys(s3_client, job_bucket, [jk["Key"]
+                for jk in lambdautils.list_keys(s3_client, job_bucket, job_id + "/")
+                if jk["Key"] != plan_key])
+
+    if not splits:
+        bsize, batches = 0, []
+    else:
+        n_batches = lambdautils.compute_mapper_batch_count(splits, lambda_memory,
+                concurrent_lambdas, max_batch_bytes)
+        bsize = int(math.ceil(len(splits) / float(n_batches)))
+        if config.get("batching") == "balanced":
+            # Same number of mappers, but each gets about the same number of bytes
+            batches = lambdautils.balanced_batch_creator(splits, n_batches, max_batch_bytes)
+        else:
+            batches = lambdautils.batch_creator(splits, bsize)
+    # Cached outputs become the mappers after the ones that run
+    cached = [[len(batches) + i + 1, h] for i, h in enumerate(reused)]
+
+    write_to_s3(job_bucket, plan_key, json.dumps({
+                "settings": plan_settings,
+                "nPartitions": n_partitions,
+                "lambdaMemory": lambda_memory,
+                "reducerPlanner": reducer_planner,
+                "sample": sample_summary,
+                "splitSize": split_size,
+                "batchSize": bsize,
+                "totalS3Files": n_files,
+                "totalSplits": n_splits,
+                "batches": [[[s['Key'], s['Start'], s['End'], s.get('ETag')] for s in batch]
+                    for batch in batches],
+                "cached": cached,
+                "cacheNamespace": cache.namespace if cache is not None else None
+                }), {})
+n_mappers = len(batches) + len(cached)
+
+imbalance = lambdautils.batch_imbalance(batches)
+print "Mapper bytes per batch: min %(minBytes)s, mean %(meanBytes).0f, max %(maxBytes)s" % imbalance
+print "Expected imbalance (max/mean): %.2f" % imbalance["maxOverMean"]
 document = xray_recorder.current_subsegment()
+document.put_metadata("Split size: ", split_size, "Processing initialization")
+document.put_metadata("Splits: ", n_splits, "Processing initialization")
 document.put_metadata("Batch size: ", bsize, "Processing initialization")
 document.put_metadata("Mappers: ", n_mappers, "Processing initialization")
+document.put_metadata("Imbalance: ", imbalance, "Processing initialization")
 xray_recorder.end_subsegment() #Get all keys to be processed
 
 # 2. Create the lambda functions
@@ -111,35 +313,31 @@ reducer_lambda_name = L_PREFIX + "-reducer-" +  job_id;
 rc_lambda_name = L_PREFIX + "-rc-" +  job_id;
 
 # write job config
-write_job_config(job_id, job_bucket, n_mappers, reducer_lambda_name, config["reducer"]["handler"]);
-
-zipLambda(config["mapper"]["name"], config["mapper"]["zip"])
-zipLambda(config["reducer"]["name"], config["reducer"]["zip"])
-zipLambda(config["reducerCoordinator"]["name"], config["reducerCoordinator"]["zip"])
+write_job_config(job_id, job_bucket, n_mappers, reducer_lambda_name, config["reducer"]["handler"], prefetch, n_partitions, out_format, job_spec, reducer_mode,
+        reducer_planner);
 xray_recorder.end_subsegment() #Prepare Lambda functions
 
 # mapper
 xray_recorder.begin_subsegment('Create mapper Lambda function')
 l_mapper = lambdautils.LambdaManager(lambda_client, s3_client, region, config["mapper"]["zip"], job_id,
-        mapper_lambda_name, config["mapper"]["handler"])
-l_mapper.update_code_or_create_on_noexist()
+        mapper_lambda_name, config["mapper"]["handler"], lambda_memory)
+l_mapper.deploy(lambda_files(config["mapper"]["name"]))
 xray_recorder.end_subsegment() #Create mapper Lambda function
 
 # Reducer func
 xray_recorder.begin_subsegment('Create reducer Lambda function')
 l_reducer = lambdautils.LambdaManager(lambda_client, s3_client, region, config["reducer"]["zip"], job_id,
-        reducer_lambda_name, config["reducer"]["handler"])
-l_reducer.update_code_or_create_on_noexist()
+        reducer_lambda_name, config["reducer"]["handler"], lambda_memory)
+l_reducer.deploy(lambda_files(config["reducer"]["name"]))
 xray_recorder.end_subsegment() #Create reducer Lambda function
 
 # Coordinator
 xray_recorder.begin_subsegment('Create reducer coordinator Lambda function')
 l_rc = lambdautils.LambdaManager(lambda_client, s3_client, region, config["reducerCoordinator"]["zip"], job_id,
-        rc_lambda_name, config["reducerCoordinator"]["handler"])
-l_rc.update_code_or_create_on_noexist()
-
-# Add permission to the coordinator
-l_rc.add_lambda_permission(random.randint(1,1000), job_bucket)
+        rc_lambda_name, config["reducerCoordinator"]["handler"], lambda_memory)
+if l_rc.deploy(lambda_files(config["reducerCoordinator"]["name"])):
+    # Add permission to the coordinator; it stays with the function
+    l_rc.add_lambda_permission(random.randint(1,1000), job_bucket)
 
 # create event source for coordinator
 l_rc.create_s3_eventsource_notification(job_bucket)
@@ -148,10 +346,13 @@ xray_recorder.end_subsegment() #Create reducer coordinator Lambda function
 # Write Jobdata to S3
 xray_recorder.begin_subsegment('Write job data to S3')
 j_key = job_id + "/jobdata";
+job_start = time.time()
 data = json.dumps({
                 "mapCount": n_mappers, 
-                "totalS3Files": len(all_keys),
-                "startTime": time.time()
+                "totalS3Files": n_files,
+                "totalSplits": n_splits,
+                "nPartitions": n_partitions,
+                "startTime": job_start
                 })
 xray_recorder.current_subsegment().put_metadata("Job data: ", data, "Write job data to S3")
 write_to_s3(job_bucket, j_key, data, {})
@@ -159,129 +360,262 @@ xray_recorder.end_subsegment() #Write job data to S3
 
 ### Execute ###
 
-mapper_outputs = []
-
 #2. Invoke Mappers
 xray_recorder.begin_subsegment('Invoke mappers')
+def mapper_event(batches, m_id):
+    return {
+        "bucket": bucket,
+        "splits": [[s['Key'], s['Start'], s['End']] for s in batches[m_id-1]],
+        "jobBucket": job_bucket,
+        "jobId": job_id,
+        "mapperId": m_id,
+        "prefetch": prefetch,
+        "nPartitions": n_partitions,
+        "intermediateFormat": out_format,
+        "jobSpec": job_spec,
+        "engine": mapper_engine
+    }
+
 def invoke_lambda(batches, m_id):
     xray_recorder.begin_segment('Invoke mapper Lambda')
     '''
     lambda invoke function
     '''
 
-    #batch = [k['Key'] for k in batches[m_id-1]]
-    batch = [k.key for k in batches[m_id-1]]
-    xray_recorder.current_segment().put_annotation("batch_for_mapper_"+str(m_id), str(batch))
+    params = mapper_event(batches, m_id)
+    xray_recorder.current_segment().put_annotation("batch_for_mapper_"+str(m_id), str(params["splits"]))
     #print "invoking", m_id, len(batch)
-    resp = lambda_client.invoke( 
-            FunctionName = mapper_lambda_name,
-            InvocationType = 'RequestResponse',
-            Payload =  json.dumps({
-                "bucket": bucket,
-                "keys": batch,
-                "jobBucket": job_bucket,
-                "jobId": job_id,
-                "mapperId": m_id
-            })
-        )
-    out = eval(resp['Payload'].read())
-    mapper_outputs.append(out)
-    print "mapper output", out
-    xray_recorder.end_segment()
+    try:
+        resp = lambda_client.invoke( 
+                FunctionName = mapper_lambda_name,
+                InvocationType = 'RequestResponse',
+                Payload =  json.dumps(params)
+            )
+        payload = resp['Payload'].read()
+        if 'FunctionError' in resp:
+            # Raised to the scheduler, which retries the mapper
+            raise Exception("mapper %s: %s" % (m_id, payload))
+        out = json.loads(payload)
+        print "mapper output", out
+        return out
+    finally:
+        xray_recorder.end_segment()
+def done_mapper_ids():
+    '''
+    Ids of the mappers that wrote their output
+    '''
+    prefix = "%s/task/mapper/" % job_id
+    return [int(jk["Key"][len(prefix):])
+            for jk in lambdautils.list_keys(s3_client, job_bucket, prefix)]
+
+def done_mapper_records():
+    '''
+    Metrics records of the mappers that already wrote their output, by id
+    '''
+    prefix = "%s/task/mapper/" % job_id
+    done = done_mapper_ids()
+    if not done:
+        return {}
+    pool = ThreadPool(min(len(done), 32))
+    heads = pool.map(lambda m_id: lambdautils.object_metadata(s3_client, job_bucket,
+            prefix + str(m_id)), done)
+    pool.close()
+    return dict((m_id, json.loads(head[metrics.METRICS_META]))
+            for m_id, head in zip(done, heads) if head is not None and m_id <= len(batches))
+
 # Exec Parallel
-print "# of Mappers ", n_mappers 
-pool = ThreadPool(n_mappers)
-Ids = [i+1 for i in range(n_mappers)]
+done_mappers = done_mapper_records() if resume else {}
+if done_mappers:
+    print "Skipping %s mappers that already wrote their output" % len(done_mappers)
+Ids = [i+1 for i in range(len(batches)) if i+1 not in done_mappers]
+print "# of Mappers ", len(Ids)
 invoke_lambda_partial = partial(invoke_lambda, batches)
 
-# Burst request handling
-mappers_executed = 0
-while mappers_executed < n_mappers:
-    nm = min(concurrent_lambdas, n_mappers)
-    results = pool.map(invoke_lambda_partial, Ids[mappers_executed: mappers_executed + nm])
-    mappers_executed += nm
-    xray_recorder.current_subsegment().put_metadata("Mapper lambdas executed: ", mappers_executed, "Invoke mappers")
-
-pool.close()
-pool.join()
+if cached:
+    # Cached outputs go into place like mapper outputs, without a mapper
+    print "Copying %s cached mapper outputs" % len(cached)
+    cache.restore(job_id, cached)
+
+# Keep concurrentLambdas mappers in flight; start the next one as soon as
+# any finishes, and retry throttled or failed invocations with backoff
+max_retries = config.get("maxRetries", scheduler.MAX_RETRIES)
+if mapper_invocation == "event":
+    # The mappers' own Lambda retries come first; after them a mapper has
+    # had three timeouts and the retry delays to write its output
+    mapper_scheduler = scheduler.EventScheduler(concurrent_lambdas,
+            3 * l_mapper.timeout + scheduler.ASYNC_RETRY_SECS, max_retries, speculation)
+    mapper_scheduler.run(Ids, lambda m_ids: event_invoker.invoke_events(mapper_lambda_name,
+            [mapper_event(batches, m_id) for m_id in m_ids]), done_mapper_ids)
+    # The mappers' records are in the metadata of their outputs
+    mapper_outputs = done_mapper_records().values()
+else:
+    mapper_scheduler = scheduler.TaskScheduler(concurrent_lambdas, max_retries=max_retries,
+            speculation=speculation)
+    mapper_outputs = mapper_scheduler.run(Ids, invoke_lambda_partial).values() + done_mappers.values()
+if incremental:
+    cache.store(job_id, [(i+1, batch) for i, batch in enumerate(batches)])
+    print "Cached %s mapper outputs, dropped %s stale ones" % (len(batches), cache.save())
+print "Backup mappers launched:", mapper_scheduler.backups
+xray_recorder.current_subsegment().put_metadata("Mapper lambdas executed: ", len(mapper_outputs), "Invoke mappers")
 
 print "all the mappers finished"
 xray_recorder.end_subsegment() #Invoke mappers
 
 # Delete Mapper function
-xray_recorder.begin_subsegment('Delete mappers')
-l_mapper.delete_function()
-xray_recorder.end_subsegment() #Delete mappers
+if not keep_warm:
+    xray_recorder.begin_subsegment('Delete mappers')
+    l_mapper.delete_function()
+    xray_recorder.end_subsegment() #Delete mappers
 
 xray_recorder.begin_subsegment('Calculate cost')
 
-# Calculate costs - Approx (since we are using exec time reported by our func and not billed ms)
-total_lambda_secs = 0
-total_s3_get_ops = 0
-total_s3_put_ops = 0
-s3_storage_hours = 0
-total_lines = 0
-
+# Per-stage summaries of the task metrics; the mappers returned theirs
+stages = {"mapper": metrics.StageSummary()}
 for output in mapper_outputs:
-    total_s3_get_ops += int(output[0])
-    total_lines += int(output[1])
-    total_lambda_secs += float(output[2])
+    stages["mapper"].add(output)
+mapper_durations = [output["totalSecs"] for output in mapper_outputs]
 
 
-#Note: Wait for the job to complete so that we can compute total cost ; create a poll every 10 secs
+# (step, reducer) pairs that already have a backup copy
+reducer_backups = set()
 
-# Get all reducer keys
-reducer_keys = []
+def speculate_reducers(job_keys):
+    '''
+    Launch a backup copy of the reducers of the current step that run well
+    past the median of the ones already done. Whichever copy writes the
+    reducer output first wins.
+    '''
+    steps = [int(jk["Key"].rsplit(".", 1)[1]) for jk in job_keys if "/reducerstate." in jk["Key"]]
+    if not steps:
+        return
+    step_id = max(steps)
+    state_key = "%s/reducerstate.%s" % (job_id, step_id)
+    state = json.loads(s3_client.get_object(Bucket=job_bucket, Key=state_key)["Body"].read())
+    batches = state.get("batches")
+    if not batches or (len(batches) == 1 and not n_partitions):
+        # No peers to compare the final reducer with
+        return
+    if n_partitions:
+        prefix = job_id + "/result/"
+    else:
+        prefix = "%s/task/reducer/%s/" % (job_id, step_id)
+    step_start = float(state["start_time"])
+    durations = [calendar.timegm(jk["LastModified"].utctimetuple()) - step_start
+            for jk in job_keys if jk["Key"].startswith(prefix)]
+    done = set(jk["Key"][len(prefix):] for jk in job_keys if jk["Key"].startswith(prefix))
+    now = time.time()
+    running = dict((r_id, now - step_start) for r_id in range(len(batches))
+            if str(r_id) not in done and (step_id, r_id) not in reducer_backups)
+    for r_id in speculation.stragglers(durations, running, len(batches)):
+        print "Reducer %s of step %s is a straggler, launching a backup copy" % (r_id, step_id)
+        reducer_backups.add((step_id, r_id))
+        event_invoker.invoke_events(reducer_lambda_name, [lambdautils.reducer_event(job_bucket, job_id,
+                step_id, batches, r_id, prefetch, n_partitions, out_format, job_spec,
+                reducer_mode == "merge")])
+
+def resume_reducers():
+    '''
+    Restart the reducers where an earlier run of the job stopped: invoke
+    the reducers of the last started step that did not write their output
+    or, if that step is complete, the coordinator for it, as if its last
+    output had just been written. The coordinator starts a step only once,
+    so this is safe when the reducers are still making progress.
+    '''
+    keys = set(jk["Key"] for jk in lambdautils.list_keys(s3_client, job_bucket, job_id + "/"))
+    steps = [int(k.rsplit(".", 1)[1]) for k in keys if "/reducerstate." in k]
+    if not steps:
+        # Only mappers so far, all of them done
+        trigger_key = "%s/task/mapper/%s" % (job_id, n_mappers)
+    else:
+        step_id = max(steps)
+        state = json.loads(s3_client.get_object(Bucket=job_bucket,
+                Key="%s/reducerstate.%s" % (job_id, step_id))["Body"].read())
+        batches = state["batches"]
+        if n_partitions:
+            outputs = ["%s/result/%s" % (job_id, r_id) for r_id in range(len(batches))]
+        elif len(batches) == 1:
+            outputs = [job_id + "/result"]
+        else:
+            outputs = ["%s/task/reducer/%s/%s" % (job_id, step_id, r_id) for r_id in range(len(batches))]
+        missing = [r_id for r_id, key in enumerate(outputs) if key not in keys]
+        if missing:
+            print "Restarting %s reducers of step %s" % (len(missing), step_id)
+            event_invoker.invoke_events(reducer_lambda_name, [lambdautils.reducer_event(job_bucket, job_id,
+                    step_id, batches, r_id, prefetch, n_partitions, out_format, job_spec,
+                    reducer_mode == "merge") for r_id in missing])
+            return
+        if n_partitions or len(batches) == 1:
+            # The job is done
+            return
+        trigger_key = outputs[-1]
+    print "Restarting the reducer coordinator from", trigger_key
+    lambda_client.invoke(
+            FunctionName = rc_lambda_name,
+            InvocationType = 'Event',
+            Payload = json.dumps({"Records": [{"s3": {"bucket": {"name": job_bucket},
+                "object": {"key": trigger_key}}}]})
+        )
+
+if resume and not Ids:
+    # Mappers run by this run trigger the coordinator with their outputs
+    resume_reducers()
+
+#Note: Wait for the job to complete so that we can compute total cost ; create a poll every 10 secs
 
-# Total execution time for reducers
-reducer_lambda_time = 0
+# S3 requests of the driver
+driver_lists = 0
+driver_heads = 0
 
 while True:
-    job_keys = s3_client.list_objects(Bucket=job_bucket, Prefix=job_id)["Contents"]
+    job_keys = lambdautils.list_keys(s3_client, job_bucket, job_id + "/")
+    driver_lists += len(job_keys) // 1000 + 1
     keys = [jk["Key"] for jk in job_keys]
     total_s3_size = sum([jk["Size"] for jk in job_keys])
     
     print "check to see if the job is done"
 
     # check job done
-    if job_id + "/result" in keys:
+    if n_partitions:
+        result_keys = [k for k in keys if k.startswith(job_id + "/result/")]
+        job_done = len(result_keys) == n_partitions
+    else:
+        result_keys = [job_id + "/result"]
+        job_done = result_keys[0] in keys
+
+    if job_done:
         print "job done"
-        reducer_lambda_time += float(s3.Object(job_bucket, job_id + "/result").metadata['processingtime'])
-        for key in keys:
-            if "task/reducer" in key:
-                reducer_lambda_time += float(s3.Object(job_bucket, key).metadata['processingtime'])
-                reducer_keys.append(key)
+        # The metadata of the result holds the records of the reducers
+        # that wrote it and the summaries of the steps before
+        for key in result_keys:
+            metrics.fold(stages, s3_client.head_object(Bucket=job_bucket, Key=key)['Metadata'])
+            driver_heads += 1
         break
+    if speculation:
+        speculate_reducers(job_keys)
     time.sleep(5)
 
-# S3 Storage cost - Account for mappers only; This cost is neglibile anyways since S3 
-# costs 3 cents/GB/month
-s3_storage_hour_cost = 1 * 0.0000521574022522109 * (total_s3_size/1024.0/1024.0/1024.0) # cost per GB/hr 
-s3_put_cost = len(job_keys) *  0.005/1000
-
-# S3 GET # $0.004/10000 
-total_s3_get_ops += len(job_keys) 
-s3_get_cost = total_s3_get_ops * 0.004/10000 
-
-# Total Lambda costs
-total_lambda_secs += reducer_lambda_time
-lambda_cost = total_lambda_secs * 0.00001667 * lambda_memory/ 1024.0
-s3_cost =  (s3_get_cost + s3_put_cost + s3_storage_hour_cost)
-
-# Print costs
-print "Reducer L", reducer_lambda_time * 0.00001667 * lambda_memory/ 1024.0
-print "Lambda Cost", lambda_cost
-print "S3 Storage Cost", s3_storage_hour_cost
-print "S3 Request Cost", s3_get_cost + s3_put_cost 
-print "S3 Cost", s3_cost 
-print "Total Cost: ", lambda_cost + s3_cost
-print "Total Lines:", total_lines 
+# Costs use the durations the tasks measured, not billed ms. S3 storage is
+# one hour of the job bucket; LISTs are billed like PUTs.
+report = metrics.job_report(stages, lambda_memory, time.time() - job_start,
+        extra_s3_gets=driver_heads, extra_s3_puts=driver_lists + 1,
+        stored_bytes=total_s3_size, durations={"mapper": mapper_durations})
+for line in metrics.format_report(report):
+    print line
+print "Total Cost: ", report["cost"]["total"]
+print "Total Lines:", report["stages"]["mapper"]["recordsIn"]
+write_to_s3(job_bucket, job_id + "/report", json.dumps(report, indent=4), {})
+xray_recorder.current_subsegment().put_metadata("Report: ", report, "Calculate cost")
 xray_recorder.end_subsegment() #Calculate cost
 
 # Delete Reducer function
-xray_recorder.begin_subsegment('Delete reducers')
-l_reducer.delete_function()
-l_rc.delete_function()
-xray_recorder.end_subsegment() #Delete reducers
+if not keep_warm:
+    xray_recorder.begin_subsegment('Delete reducers')
+    l_reducer.delete_function()
+    l_rc.delete_function()
+    xray_recorder.end_subsegment() #Delete reducers
+
+event_invoker.close()
+if backend.is_local():
+    lambda_client.shutdown()
 
 xray_recorder.end_segment() #Map Reduce Driver
@@ -0,0 +1,186 @@
+'''
+Intermediate formats for mapper and reducer step outputs
+
+"json" is a JSON object of key -> number. "binary" holds the same pairs
+sorted by key, in blocks of up to BLOCK_RECORDS records:
+
+    MAGIC
+    block*:  n, key_bytes         2 x uint32
+             key end offsets      n x uint32
+             keys                 key_bytes bytes, concatenated
+             values               n x float64
+
+All integers and floats are little-endian. Readers detect the format from
+the first bytes, so they do not need to be told which one was written, and
+the binary form is decoded block by block without building a dict.
+iter_stream_pairs and StreamWriter decode and encode a stream of sorted
+pairs without holding more than a block, for the merging reducer.
+
+Copyright 2016 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+'''
+
+import array
+import json
+import struct
+import sys
+
+JSON = "json"
+BINARY = "binary"
+
+MAGIC = "BLI1"
+BLOCK_RECORDS = 4096
+
+_BLOCK_HEADER = struct.Struct('<II')
+_SWAP = sys.byteorder != 'little'
+
+def _tostring(arr):
+    if _SWAP:
+        arr = array.array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tostring()
+
+def _fromstring(typecode, data):
+    arr = array.array(typecode)
+    arr.fromstring(data)
+    if _SWAP:
+        arr.byteswap()
+    return arr
+
+def encode_block(keys, values):
+    ends = array.array('I', map(len, keys))
+    pos = 0
+    for i in xrange(len(ends)):
+        pos += ends[i]
+        ends[i] = pos
+    return (_BLOCK_HEADER.pack(len(keys), pos) + _tostring(ends) +
+            ''.join(keys) + _tostring(array.array('d', values)))
+
+def dumps_sorted(keys, values):
+    '''
+    Binary encoding of parallel lists of keys, sorted, and values
+    '''
+    keys = [key.encode('utf-8') if isinstance(key, unicode) else key for key in keys]
+    out = [MAGIC]
+    for i in xrange(0, len(keys), BLOCK_RECORDS):
+        out.append(encode_block(keys[i:i + BLOCK_RECORDS], values[i:i + BLOCK_RECORDS]))
+    return ''.join(out)
+
+def dumps_pairs(pairs):
+    '''
+    Binary encoding of (key, value) pairs that are already sorted by key
+    '''
+    pairs = list(pairs)
+    return dumps_sorted([key for key, value in pairs], [value for key, value in pairs])
+
+def iter_blocks(data):
+    '''
+    Yield (keys, values) per block of a binary buffer
+    '''
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("not a binary intermediate")
+    pos = len(MAGIC)
+    while pos < len(data):
+        n, key_bytes = _BLOCK_HEADER.unpack_from(data, pos)
+        pos += _BLOCK_HEADER.size
+        ends = _fromstring('I', data[pos:pos + 4 * n])
+        pos += 4 * n
+        blob = data[pos:pos + key_bytes]
+        pos += key_bytes
+        values = _fromstring('d', data[pos:pos + 8 * n])
+        pos += 8 * n
+        starts = [0] + ends[:-1].tolist()
+        yield [blob[s:e] for s, e in zip(starts, ends)], values
+
+def iter_pairs(data):
+    for keys, values in iter_blocks(data):
+        for pair in zip(keys, values):
+            yield pair
+
+def _read_exact(body, n):
+    data = body.read(n)
+    while len(data) < n:
+        more = body.read(n - len(data))
+        if not more:
+            raise ValueError("truncated binary intermediate")
+        data += more
+    return data
+
+def iter_stream_pairs(body):
+    '''
+    (key, value) pairs of a binary intermediate read from body, a block at
+    a time
+    '''
+    if _read_exact(body, len(MAGIC)) != MAGIC:
+        raise ValueError("not a binary intermediate")
+    while True:
+        header = body.read(_BLOCK_HEADER.size)
+        if not header:
+            return
+        header += _read_exact(body, _BLOCK_HEADER.size - len(header))
+        n, key_bytes = _BLOCK_HEADER.unpack(header)
+        ends = _fromstring('I', _read_exact(body, 4 * n))
+        blob = _read_exact(body, key_bytes)
+        values = _fromstring('d', _read_exact(body, 8 * n))
+        starts = [0] + ends[:-1].tolist()
+        for pair in zip([blob[s:e] for s, e in zip(starts, ends)], values):
+            yield pair
+
+class StreamWriter(object):
+    '''
+    Encodes pairs to write(data) as they are added, a block at a time. For
+    the binary format they must be added in key order.
+    '''
+    def __init__(self, write, fmt=BINARY):
+        self.write = write
+        self.fmt = fmt
+        self.count = 0
+        self._keys = []
+        self._values = []
+        write(MAGIC if fmt == BINARY else '{')
+
+    def add(self, key, value):
+        self._keys.append(key)
+        self._values.append(value)
+        if len(self._keys) == BLOCK_RECORDS:
+            self._flush()
+
+    def _flush(self):
+        if not self._keys:
+            return
+        if self.fmt == BINARY:
+            keys = [key.encode('utf-8') if isinstance(key, unicode) else key for key in self._keys]
+            self.write(encode_block(keys, self._values))
+        else:
+            # The members of a block as json.dumps of the whole dict writes them
+            self.write((', ' if self.count else '') +
+                    json.dumps(dict(zip(self._keys, self._values)))[1:-1])
+        self.count += len(self._keys)
+        self._keys = []
+        self._values = []
+
+    def close(self):
+        self._flush()
+        if self.fmt != BINARY:
+            self.write('}')
+
+def dumps(results, fmt=JSON):
+    '''
+    Serialize a dict of key -> number in the given format
+    '''
+    if fmt == BINARY:
+        keys = sorted(results)
+        return dumps_sorted(keys, [results[key] for key in keys])
+    return json.dumps(results)
+
+def loads_pairs(data, decode_key=None, decode_value=float):
+    '''
+    (key, value) pairs of an intermediate in either format. JSON keys and
+    values are passed through decode_key and decode_value, as JSON turns
+    keys into strings and tuples into lists.
+    '''
+    if data[:len(MAGIC)] == MAGIC:
+        return iter_pairs(data)
+    if decode_key is None:
+        return ((key, decode_value(val)) for key, val in json.loads(data).iteritems())
+    return ((decode_key(key), decode_value(val)) for key, val in json.loads(data).iteritems())
@@ -0,0 +1,70 @@
+'''
+Benchmark the intermediate formats
+
+Encodes a uservisits-like mapper output (8-char srcIp prefix -> revenue)
+as JSON and as the binary format, then decodes it the way the reducer
+does, and reports size and throughput of each.
+
+  $ python intermediate_benchmark.py [n_keys] [repeat]
+'''
+
+import intermediate
+import json
+import random
+import sys
+import time
+
+def make_output(n_keys):
+    random.seed(42)
+    output = {}
+    while len(output) < n_keys:
+        ip = '%d.%d.%d.%d' % tuple(random.randint(1, 255) for _ in range(4))
+        output[ip[:8]] = random.random() * 1000
+    return output
+
+def json_decode(data):
+    total = 0.0
+    for key, val in json.loads(data).iteritems():
+        total += float(val)
+    return total
+
+def binary_decode(data):
+    total = 0.0
+    for key, val in intermediate.iter_pairs(data):
+        total += val
+    return total
+
+def best_of(repeat, fn, *args):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = fn(*args)
+        secs = time.time() - start
+        best = secs if best is None else min(best, secs)
+    return best, result
+
+def run(n_keys, repeat):
+    output = make_output(n_keys)
+    stats = {}
+    for fmt, decode in [(intermediate.JSON, json_decode), (intermediate.BINARY, binary_decode)]:
+        enc_secs, data = best_of(repeat, intermediate.dumps, output, fmt)
+        dec_secs, total = best_of(repeat, decode, data)
+        stats[fmt] = {
+            "bytes": len(data),
+            "encodeSecs": enc_secs,
+            "decodeSecs": dec_secs,
+            "encodeRecordsPerSec": n_keys / enc_secs,
+            "decodeRecordsPerSec": n_keys / dec_secs
+        }
+    return stats
+
+if __name__ == '__main__':
+    n_keys = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    stats = run(n_keys, repeat)
+    print "%-8s %12s %12s %12s" % ("format", "bytes", "encode r/s", "decode r/s")
+    for fmt in (intermediate.JSON, intermediate.BINARY):
+        s = stats[fmt]
+        print "%-8s %12d %12d %12d" % (fmt, s["bytes"], s["encodeRecordsPerSec"], s["decodeRecordsPerSec"])
+    print "size ratio (binary/json) %.2f" % (float(stats["binary"]["bytes"]) / stats["json"]["bytes"])
+    print json.dumps(stats)
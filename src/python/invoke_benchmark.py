@@ -0,0 +1,130 @@
+'''
+Benchmark how the driver and the coordinator invoke tasks
+
+Runs against a stand-in for the Lambda API where every call takes
+LATENCY secs and a task runs TASK_SECS, so it measures the invokers
+themselves. Each case runs in a fresh interpreter and reports the
+invocations per second, the wall time, and the peak RSS (MB) and thread
+count of the process:
+
+  serial  - the Event invocations one after another (the coordinator
+            before invoker.py); measured on the first SERIAL_SAMPLE only
+  pooled  - the Event invocations through an invoker.Invoker
+  sync    - every task a RequestResponse call, CONCURRENCY of them held
+            open by scheduler.TaskScheduler threads ("mapperInvocation":
+            "sync")
+  event   - every task an Event invocation, CONCURRENCY of them in flight,
+            followed by scheduler.EventScheduler polls ("event")
+
+  $ python invoke_benchmark.py [tasks ...]
+'''
+
+import json
+import os
+import resource
+import StringIO
+import subprocess
+import sys
+import threading
+import time
+
+import invoker
+import scheduler
+
+TASKS = [1000, 10000]
+CASES = ["serial", "pooled", "sync", "event"]
+
+LATENCY = 0.02
+TASK_SECS = 1.0
+CONCURRENCY = 1000
+SERIAL_SAMPLE = 500
+
+class StubLambda(object):
+    '''
+    Every call takes LATENCY secs; a RequestResponse call returns once its
+    task is done, an Event call right away
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.done_at = {}
+
+    def invoke(self, FunctionName, InvocationType='RequestResponse', Payload=''):
+        time.sleep(LATENCY)
+        if InvocationType == 'Event':
+            with self.lock:
+                self.done_at[json.loads(Payload)] = time.time() + TASK_SECS
+            return {"StatusCode": 202, "Payload": StringIO.StringIO('')}
+        time.sleep(TASK_SECS)
+        return {"StatusCode": 200, "Payload": StringIO.StringIO(Payload)}
+
+    def done(self):
+        now = time.time()
+        with self.lock:
+            return [t for t, at in self.done_at.items() if at <= now]
+
+class ThreadCounter(object):
+    def __init__(self):
+        self.peak = threading.active_count()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._watch)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _watch(self):
+        while not self._stopped.wait(0.05):
+            self.peak = max(self.peak, threading.active_count())
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        return self.peak
+
+def probe(case, n):
+    '''
+    Runs in the fresh interpreter
+    '''
+    client = StubLambda()
+    tasks = range(n)
+    threads = ThreadCounter()
+    start = time.time()
+    if case == "serial":
+        tasks = tasks[:SERIAL_SAMPLE]
+        for t in tasks:
+            client.invoke(FunctionName="task", InvocationType='Event', Payload=json.dumps(t))
+    elif case == "pooled":
+        invoker.Invoker(client).invoke_events("task", tasks)
+    elif case == "sync":
+        scheduler.TaskScheduler(CONCURRENCY).run(tasks, lambda t: client.invoke(
+                FunctionName="task", Payload=json.dumps(t))["Payload"].read())
+    else:
+        engine = invoker.Invoker(client)
+        scheduler.EventScheduler(CONCURRENCY, 10 * TASK_SECS).run(tasks,
+                lambda ts: engine.invoke_events("task", ts), client.done)
+    secs = time.time() - start
+    return {"tasks": n, "invocations": len(tasks), "secs": secs,
+            "invocationsPerSec": len(tasks) / secs, "threads": threads.stop(),
+            "rssMB": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0}
+
+def run(task_counts=TASKS):
+    stats = {}
+    for n in task_counts:
+        for case in CASES:
+            out = subprocess.check_output([sys.executable, __file__, "--probe", case, str(n)])
+            stats["%s/%s" % (case, n)] = json.loads(out.splitlines()[-1])
+    return stats
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "--probe":
+        print json.dumps(probe(sys.argv[2], int(sys.argv[3])))
+        sys.stdout.flush()
+        # Without waiting for the worker threads still winding down
+        os._exit(0)
+    task_counts = [int(n) for n in sys.argv[1:]] or TASKS
+    stats = run(task_counts)
+    print "%-8s %7s %10s %8s %8s %8s" % ("case", "tasks", "invokes/s", "secs", "threads", "RSS MB")
+    for n in task_counts:
+        for case in CASES:
+            s = stats["%s/%s" % (case, n)]
+            print "%-8s %7d %10.1f %8.2f %8d %8.1f" % (case, n, s["invocationsPerSec"], s["secs"],
+                    s["threads"], s["rssMB"])
+    print json.dumps(stats)
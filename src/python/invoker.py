@@ -0,0 +1,104 @@
+'''
+Bounded invocation engine of the driver and the reducer coordinator
+
+Starting a task is a call to the Lambda API that takes tens of ms, so a
+loop of them one after another spends minutes on a few thousand reducers.
+An Invoker makes Event invocations from a fixed set of worker threads
+that share one client, whose connection pool has a connection per worker:
+up to `concurrency` calls are in flight, each on a kept-alive connection.
+A call that is throttled or fails is retried with jittered exponential
+backoff.
+
+Copyright 2016 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+'''
+
+import backend
+import json
+import random
+import time
+
+from multiprocessing.dummy import Pool as ThreadPool
+
+# Calls in flight, and connections in the client's pool
+CONCURRENCY = 64
+
+# Retries per call and exponential backoff (secs) between attempts
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.1
+BACKOFF_MAX = 5
+
+class InvokeFailed(Exception):
+    def __init__(self, failures):
+        Exception.__init__(self, "%s invocation(s) failed: %s" % (len(failures),
+                ", ".join("%s (%s)" % (i, failures[i]) for i in sorted(failures))))
+        self.failures = failures
+
+def pooled_client(concurrency=CONCURRENCY, read_timeout=None):
+    '''
+    A new Lambda client with a pooled connection per concurrent call
+    '''
+    from botocore.client import Config
+    if read_timeout:
+        config = Config(max_pool_connections=concurrency, read_timeout=read_timeout)
+    else:
+        config = Config(max_pool_connections=concurrency)
+    return backend.lambda_client(config=config)
+
+class Invoker(object):
+    def __init__(self, client=None, concurrency=CONCURRENCY, max_retries=MAX_RETRIES,
+            backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX):
+        self.client = client or pooled_client(concurrency)
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.calls = 0
+        self.retries = 0
+        self._pool = None
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _invoke(self, function_name, payload):
+        '''
+        None once the invocation is accepted, else the last error
+        '''
+        body = json.dumps(payload)
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.retries += 1
+                time.sleep(self.backoff(attempt - 1))
+            self.calls += 1
+            try:
+                resp = self.client.invoke(FunctionName=function_name,
+                        InvocationType='Event', Payload=body)
+            except Exception as e:
+                error = e
+                continue
+            if resp.get("StatusCode") == 202:
+                return None
+            error = "status %s" % resp.get("StatusCode")
+        return error
+
+    def invoke_events(self, function_name, payloads):
+        '''
+        Event-invoke function_name with each payload, up to concurrency calls
+        at a time. Raises InvokeFailed with the index and error of the
+        payloads still failing after their retries.
+        '''
+        if not payloads:
+            return 0
+        if self._pool is None:
+            self._pool = ThreadPool(self.concurrency)
+        errors = self._pool.map(lambda payload: self._invoke(function_name, payload),
+                payloads, chunksize=1)
+        failures = dict((i, e) for i, e in enumerate(errors) if e is not None)
+        if failures:
+            raise InvokeFailed(failures)
+        return len(payloads)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
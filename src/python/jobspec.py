@@ -0,0 +1,114 @@
+'''
+Job definitions
+
+A job spec is a Python module that the driver packages with the mapper and
+reducer, next to jobinfo.json. It defines:
+
+    map_line(line)      (key, value) pairs of an input line
+    combine(acc, value) accumulator of a key with one more value. The mapper
+                        folds every value into its key's accumulator before
+                        it writes its output, so it writes one record per
+                        distinct key instead of one per value.
+    reduce(acc, other)  two accumulators of a key merged, in the reducers
+                        (default: combine)
+    create(value)       accumulator of the first value of a key (default:
+                        the value itself)
+    finalize(key, acc)  value written to the result (default: acc)
+    KEY_TYPE            type of the keys (default str)
+    ACC_TYPE            type of the accumulators (default float). Keys and
+                        accumulators are converted back to these after the
+                        JSON intermediate format; the binary format needs
+                        str keys and float accumulators. An ACC_TYPE with
+                        loads(value), like the sketches in sketches.py, is
+                        decoded with it; its accumulators are written as
+                        acc.dumps(), and finalize defaults to acc.result().
+    VECTORIZED          optional {"keyColumn", "keyWidth", "valueColumn"}
+                        when the job sums a float CSV column by a prefix of
+                        another one, which numpyengine can run
+
+combine and reduce must be associative and commutative, as mappers and
+reducers see the records in any order. uservisits_job.py is the default.
+
+Copyright 2016 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+'''
+
+import importlib
+
+DEFAULT_SPEC = "uservisits_job.py"
+
+class JobSpec(object):
+    def __init__(self, module):
+        self.name = module.__name__
+        self.map_line = module.map_line
+        self.combine = module.combine
+        self.reduce = getattr(module, "reduce", module.combine)
+        self.create = getattr(module, "create", None)
+        self.finalize = getattr(module, "finalize", None)
+        self.key_type = getattr(module, "KEY_TYPE", str)
+        self.acc_type = getattr(module, "ACC_TYPE", float)
+        self.vectorized = getattr(module, "VECTORIZED", None)
+        # Accumulators with their own serialized form
+        self.serialized = hasattr(self.acc_type, "loads")
+
+    def binary_ok(self):
+        '''
+        Whether the binary intermediate format can hold this job's records
+        '''
+        return self.key_type is str and self.acc_type is float
+
+    def decode_key(self, key):
+        if self.key_type is str:
+            return key.encode('utf-8') if isinstance(key, unicode) else key
+        return self.key_type(key)
+
+    def decode_acc(self, acc):
+        if self.serialized:
+            return self.acc_type.loads(acc)
+        return self.acc_type(acc)
+
+    def encode_all(self, results):
+        '''
+        results with the accumulators in their JSON form
+        '''
+        if not self.serialized:
+            return results
+        return dict((key, acc.dumps()) for key, acc in results.iteritems())
+
+    def map_into(self, lines, output):
+        '''
+        Map a block of lines and combine the values into output; returns
+        the number of lines. A line that fails is reported and skipped.
+        '''
+        create = self.create
+        combine = self.combine
+        for line in lines:
+            try:
+                for key, value in self.map_line(line):
+                    if key in output:
+                        output[key] = combine(output[key], value)
+                    else:
+                        output[key] = create(value) if create else value
+            except Exception, e:
+                print e
+        return len(lines)
+
+    def finalize_all(self, results):
+        if self.finalize is None:
+            if self.serialized:
+                return dict((key, acc.result()) for key, acc in results.iteritems())
+            return results
+        return dict((key, self.finalize(key, acc)) for key, acc in results.iteritems())
+
+_specs = {}
+
+def load(name=None):
+    '''
+    The job spec in module file `name` (default DEFAULT_SPEC), which must
+    be importable from the working directory
+    '''
+    name = name or DEFAULT_SPEC
+    module = name[:-3] if name.endswith(".py") else name
+    if module not in _specs:
+        _specs[module] = JobSpec(importlib.import_module(module))
+    return _specs[module]
@@ -2,9 +2,21 @@
  Copyright 2016 Amazon.com, Inc. or its affiliates. All Rights Reserved.
  SPDX-License-Identifier: MIT-0
 '''
-import boto3
 import botocore
+import hashlib
+import heapq
+import json
+import math
 import os
+import s3reader
+import zipfile
+import zlib
+
+# Marks the hash of the deployed code in a function's Description
+CODE_HASH_TAG = "code:"
+
+# Timeout (secs) of the deployed functions
+LAMBDA_TIMEOUT = 300
 
 class LambdaManager(object):
     def __init__ (self, l, s3, region, codepath, job_id, fname, handler, lmem=1536):
@@ -17,12 +29,12 @@ class LambdaManager(object):
         self.handler = handler
         self.role = os.environ.get('serverless_mapreduce_role')
         self.memory = lmem 
-        self.timeout = 300
+        self.timeout = LAMBDA_TIMEOUT
         self.function_arn = None # set after creation
 
     # TracingConfig parameter switches X-Ray tracing on/off.
     # Change value to 'Mode':'PassThrough' to switch it off
-    def create_lambda_function(self):
+    def create_lambda_function(self, description=None):
         runtime = 'python2.7';
         response = self.awslambda.create_function(
                       FunctionName = self.function_name, 
@@ -32,7 +44,7 @@ class LambdaManager(object):
                       Handler =  self.handler,
                       Role =  self.role, 
                       Runtime = runtime,
-                      Description = self.function_name,
+                      Description = description or self.function_name,
                       MemorySize = self.memory,
                       Timeout =  self.timeout,
                       TracingConfig={'Mode':'PassThrough'}
@@ -65,6 +77,43 @@ class LambdaManager(object):
             # parse (Function already exist) 
             self.update_function()
 
+    def deploy(self, files):
+        '''
+        Create the function from files, or update it, unless it already
+        runs the same code and settings: their hash is kept in the
+        function's Description, so an unchanged function is reused as is,
+        without zipping or uploading. Returns True if the function was
+        created.
+        '''
+        description = "%s %s%s" % (self.function_name, CODE_HASH_TAG,
+                code_hash(files, self.handler, self.memory, self.timeout))
+        try:
+            current = self.awslambda.get_function_configuration(FunctionName=self.function_name)
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'ResourceNotFoundException':
+                raise
+            current = None
+
+        if current is not None and current.get("Description") == description:
+            print "%s is up to date, reusing version %s" % (self.function_name, current.get("Version"))
+            self.function_arn = current["FunctionArn"]
+            return False
+
+        write_zip(self.codefile, files)
+        if current is None:
+            self.create_lambda_function(description)
+            return True
+        self.update_function()
+        # Record the hash only once the new code is in place
+        self.awslambda.update_function_configuration(
+                FunctionName = self.function_name,
+                Handler = self.handler,
+                MemorySize = self.memory,
+                Timeout = self.timeout,
+                Description = description
+                )
+        return False
+
     def add_lambda_permission(self, sId, bucket):
         resp = self.awslambda.add_permission(
           Action = 'lambda:InvokeFunction', 
@@ -112,13 +161,228 @@ class LambdaManager(object):
         Delete all Lambda log group and log streams for a given function
 
         '''
+        import boto3 # driver only; the handlers do not load it for this
         log_client = boto3.client('logs')
         #response = log_client.describe_log_streams(logGroupName='/aws/lambda/' + func_name)
         response = log_client.delete_log_group(logGroupName='/aws/lambda/' + func_name)
         return response
 
-def compute_batch_size(keys, lambda_memory, concurrent_lambdas):
-    max_mem_for_data = 0.6 * lambda_memory * 1000 * 1000; 
+def code_hash(files, *settings):
+    '''
+    SHA-256 of the names and contents of files and of the settings
+    '''
+    h = hashlib.sha256()
+    for fname in sorted(files):
+        with open(fname, 'rb') as f:
+            data = f.read()
+        h.update("%s\0%d\0" % (os.path.basename(fname), len(data)))
+        h.update(data)
+    h.update(json.dumps(settings))
+    return h.hexdigest()
+
+def write_zip(zipname, files):
+    '''
+    Zip files into zipname; entries get a fixed timestamp, so the same
+    files give the same bytes
+    '''
+    with zipfile.ZipFile(zipname, 'w', zipfile.ZIP_DEFLATED) as z:
+        for fname in sorted(files):
+            info = zipfile.ZipInfo(os.path.basename(fname), (1980, 1, 1, 0, 0, 0))
+            info.external_attr = 0644 << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with open(fname, 'rb') as f:
+                z.writestr(info, f.read())
+
+def list_keys(s3, bucket, prefix):
+    '''
+    All objects under prefix as {Key, Size, ETag, LastModified} dicts, following pagination
+    '''
+    keys = []
+    kwargs = {"Bucket": bucket, "Prefix": prefix}
+    while True:
+        resp = s3.list_objects_v2(**kwargs)
+        for obj in resp.get("Contents", []):
+            keys.append({"Key": obj["Key"], "Size": obj["Size"], "ETag": obj["ETag"],
+                "LastModified": obj["LastModified"]})
+        if not resp["IsTruncated"]:
+            return keys
+        kwargs["ContinuationToken"] = resp["NextContinuationToken"]
+
+# Keys per DeleteObjects request
+DELETE_BATCH = 1000
+
+def delete_keys(s3, bucket, keys):
+    for i in range(0, len(keys), DELETE_BATCH):
+        s3.delete_objects(Bucket=bucket, Delete={"Objects": [{"Key": key}
+                for key in keys[i:i + DELETE_BATCH]], "Quiet": True})
+
+# Error codes S3 returns for a missing key
+MISSING_CODES = ("404", "NoSuchKey", "NotFound")
+
+def object_metadata(s3, bucket, key):
+    '''
+    User metadata of an object, or None if it does not exist. Tasks use it to
+    check whether another copy of themselves already wrote their output.
+    '''
+    try:
+        return s3.head_object(Bucket=bucket, Key=key)["Metadata"]
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in MISSING_CODES:
+            return None
+        raise
+
+def get_json(s3, bucket, key):
+    '''
+    Parsed JSON object, or None if it does not exist
+    '''
+    try:
+        return json.loads(s3.get_object(Bucket=bucket, Key=key)["Body"].read())
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in MISSING_CODES:
+            return None
+        raise
+
+# Codes of a conditional write turned down: the object exists, or another
+# conditional write of it is in flight
+CONFLICT_CODES = ("412", "PreconditionFailed", "409", "ConditionalRequestConflict")
+
+def put_if_absent(s3, bucket, key, data):
+    '''
+    Create an object unless one exists at key; True if this call created
+    it. Of concurrent callers, one at most wins.
+    '''
+    try:
+        s3.put_object(Bucket=bucket, Key=key, Body=data, IfNoneMatch="*")
+        return True
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in CONFLICT_CODES:
+            return False
+        raise
+
+# Part size of streamed uploads; S3 takes parts of at least 5 MB, but the
+# last one
+UPLOAD_PART_SIZE = 8 * 1024 * 1024
+
+class S3StreamWriter(object):
+    '''
+    Writes an object from pieces of data as they come. It is one PUT if
+    the object ends up smaller than part_size, else a multipart upload, so
+    at most a part is held in memory. metadata() gives the object's
+    metadata when it is created: at close() for a PUT, at the first part
+    for a multipart upload. Nothing is visible before close().
+    '''
+    def __init__(self, s3, bucket, key, metadata, part_size=UPLOAD_PART_SIZE):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.metadata = metadata
+        self.part_size = part_size
+        self.bytes = 0
+        self.requests = 0
+        self._pieces = []
+        self._buffered = 0
+        self._upload_id = None
+        self._parts = []
+
+    def write(self, data):
+        self._pieces.append(data)
+        self._buffered += len(data)
+        self.bytes += len(data)
+        if self._buffered >= self.part_size:
+            self._upload_part()
+
+    def _upload_part(self):
+        if self._upload_id is None:
+            resp = self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.key,
+                    Metadata=self.metadata())
+            self._upload_id = resp["UploadId"]
+            self.requests += 1
+        data = ''.join(self._pieces)
+        self._pieces = []
+        self._buffered = 0
+        number = len(self._parts) + 1
+        resp = self.s3.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                PartNumber=number, Body=data)
+        self._parts.append({"ETag": resp["ETag"], "PartNumber": number})
+        self.requests += 1
+
+    def close(self):
+        if self._upload_id is None:
+            self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=''.join(self._pieces),
+                    Metadata=self.metadata())
+            self.requests += 1
+            return
+        if self._pieces:
+            self._upload_part()
+        self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key,
+                UploadId=self._upload_id, MultipartUpload={"Parts": self._parts})
+        self.requests += 1
+
+    def abort(self):
+        if self._upload_id is not None:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key,
+                    UploadId=self._upload_id)
+
+def reducer_event(bucket, job_id, step_id, batches, r_id, prefetch, partitioned, out_format,
+        job_spec, merge=False):
+    '''
+    Invocation payload of reducer r_id of a step
+    '''
+    params = {
+        "bucket": bucket,
+        "keys": batches[r_id],
+        "jobBucket": bucket,
+        "jobId": job_id,
+        "nReducers": len(batches),
+        "stepId": step_id,
+        "reducerId": r_id,
+        "prefetch": prefetch,
+        "intermediateFormat": out_format,
+        "jobSpec": job_spec,
+        "merge": merge
+    }
+    if partitioned:
+        params["partition"] = r_id
+    return params
+
+# Share of Lambda memory available for input data when a task buffers
+# whole objects (reducers)
+DATA_MEMORY_FRACTION = 0.6
+
+# A streaming mapper holds one chunk at a time, so its batch is bounded by
+# how much it can parse within the Lambda timeout rather than by memory:
+# input bytes/sec of the line loop on a full vCPU (mapper_benchmark.py
+# measures about twice that on uservisits lines, less the download), the
+# Lambda memory that gets a full vCPU, and the share of the timeout a
+# mapper is planned to take.
+MAPPER_THROUGHPUT = 16 * 1024 * 1024
+FULL_VCPU_MEMORY = 1769
+TIMEOUT_MARGIN = 0.5
+
+def mapper_batch_bytes(lambda_memory, timeout=LAMBDA_TIMEOUT, throughput=MAPPER_THROUGHPUT):
+    '''
+    Input bytes a mapper parses within TIMEOUT_MARGIN of its timeout. Below
+    FULL_VCPU_MEMORY a function gets a share of a vCPU in proportion to its
+    memory, and the line loop uses one at most.
+    '''
+    cpu_share = min(lambda_memory / float(FULL_VCPU_MEMORY), 1.0)
+    return int(throughput * cpu_share * timeout * TIMEOUT_MARGIN)
+
+def compute_mapper_batch_count(keys, lambda_memory, concurrent_lambdas, max_batch_bytes=None):
+    '''
+    Number of mapper batches of the splits in keys: a mapper per split up
+    to the available concurrency, and more batches if their bytes would
+    exceed max_batch_bytes (or what a streaming mapper can take)
+    '''
+    max_batch_bytes = max_batch_bytes or mapper_batch_bytes(lambda_memory)
+    size = float(sum(key['Size'] for key in keys))
+    print "Dataset size: %s, nKeys: %s, avg: %s" % (size, len(keys), size / len(keys))
+    by_bytes = min(int(math.ceil(size / max_batch_bytes)), len(keys))
+    return max(by_bytes, min(len(keys), concurrent_lambdas), 1)
+
+def compute_batch_size(keys, lambda_memory, concurrent_lambdas, max_mem_for_data=None):
+    if max_mem_for_data is None:
+        max_mem_for_data = DATA_MEMORY_FRACTION * lambda_memory * 1000 * 1000
     size = 0.0
     for key in keys:
         if isinstance(key, dict):
@@ -133,6 +397,167 @@ def compute_batch_size(keys, lambda_memory, concurrent_lambdas):
         b_size = int(round(max_mem_for_data/avg_object_size))
     return b_size
 
+# Input bytes a merging reducer holds per input: the chunk being decoded
+# and the one being fetched (see s3reader.RangeReader)
+MERGE_BYTES_PER_INPUT = 2 * 1024 * 1024
+
+# Defaults of the reducer fan-in planner ("reducerPlanner" in the driver
+# config): the fixed cost of a round of reducers (invocation, cold start and
+# the coordinator noticing the step is done), the input bytes a reducer
+# processes per second, and the output bytes of a reducer per input byte
+ROUND_OVERHEAD_SECS = 2.0
+REDUCER_THROUGHPUT = {"dict": 4 * 1024 * 1024, "merge": 16 * 1024 * 1024}
+REDUCER_SHRINK = 1.0
+
+def max_fan_in(avg_object_size, lambda_memory, merge=False):
+    '''
+    Most inputs a reducer can take: what fits in memory (dict) or streams
+    in memory (merge), and what it can get through within the timeout
+    '''
+    avg_object_size = max(avg_object_size, 1)
+    by_bytes = mapper_batch_bytes(lambda_memory) / avg_object_size
+    if merge:
+        by_memory = DATA_MEMORY_FRACTION * lambda_memory * 1000 * 1000 / MERGE_BYTES_PER_INPUT
+    else:
+        by_memory = DATA_MEMORY_FRACTION * lambda_memory * 1000 * 1000 / avg_object_size
+    return int(min(by_memory, by_bytes))
+
+def estimate_rounds(n_objects, total_bytes, fan_in, lambda_memory, concurrent_lambdas,
+        overhead, throughput, shrink, merge=False):
+    '''
+    Estimated (secs, fan-in per round) of a reducer tree over n_objects
+    that starts with fan_in. Later rounds keep that fan-in unless their
+    larger objects no longer fit; a round takes its overhead plus the
+    time of one reducer, once per wave of concurrent_lambdas reducers.
+    shrink is the output bytes per input byte of a reducer, or a function
+    of its fan-in.
+    '''
+    secs = 0.0
+    rounds = []
+    while n_objects > 1:
+        avg_object_size = total_bytes / n_objects
+        k = max(min(fan_in, max_fan_in(avg_object_size, lambda_memory, merge), n_objects), 2)
+        n_reducers = int(math.ceil(n_objects / float(k)))
+        waves = math.ceil(n_reducers / float(concurrent_lambdas))
+        secs += waves * (overhead + k * avg_object_size / throughput)
+        rounds.append(k)
+        n_objects = n_reducers
+        total_bytes *= shrink(k) if callable(shrink) else shrink
+    return secs, rounds
+
+def plan_fan_in(keys, lambda_memory, concurrent_lambdas, merge=False, options=None, shrink=None):
+    '''
+    Fan-in of the next reducer step, from the sizes of its input objects.
+
+    Tries every fan-in from 2 up to what a reducer can take and keeps the
+    one with the least estimated wall time of the remaining tree (fewer
+    rounds on a tie): small intermediates go to one round, large ones to as
+    many rounds as memory needs. shrink is the observed output bytes per
+    input byte of the previous step, if any. Without it, options["keyGrowth"]
+    (see sampler.py) gives the shrink of a reducer of fan-in k as
+    k^(keyGrowth - 1), else options["shrink"] is used. Returns the plan,
+    which the coordinator records in reducerstate.N.
+    '''
+    options = options or {}
+    mode = "merge" if merge else "dict"
+    overhead = options.get("roundOverheadSecs", ROUND_OVERHEAD_SECS)
+    throughput = options.get("throughput", {}).get(mode, REDUCER_THROUGHPUT[mode])
+    growth = options.get("keyGrowth")
+    if shrink is None and growth is not None:
+        shrink = lambda k: float(k) ** (min(max(growth, 0.0), 1.0) - 1)
+    elif shrink is None:
+        shrink = options.get("shrink", REDUCER_SHRINK)
+    if not callable(shrink):
+        shrink = min(max(shrink, 0.01), 1.0)
+
+    n_objects = len(keys)
+    total_bytes = float(sum(key['Size'] for key in keys))
+    limit = max(min(max_fan_in(total_bytes / n_objects, lambda_memory, merge), n_objects), 2)
+    best = None
+    for fan_in in range(2, limit + 1):
+        secs, rounds = estimate_rounds(n_objects, total_bytes, fan_in, lambda_memory,
+                concurrent_lambdas, overhead, throughput, shrink, merge)
+        if best is None or (secs, len(rounds)) <= (best[0], len(best[1])):
+            best = (secs, rounds)
+    secs, rounds = best
+    return {
+        "fanIn": rounds[0] if rounds else 2,
+        "inputs": n_objects,
+        "inputBytes": int(total_bytes),
+        "estimatedSecs": round(secs, 3),
+        "rounds": rounds,
+        "lambdaMemory": lambda_memory,
+        "roundOverheadSecs": overhead,
+        "throughput": throughput,
+        "shrink": "k^%s" % round(growth - 1, 4) if callable(shrink) else round(shrink, 4)
+    }
+
+# Smallest byte range worth giving its own mapper
+MIN_SPLIT_SIZE = 64 * 1024 * 1024
+
+def uncompressed_size(key, size, ratios=None):
+    '''
+    Estimated bytes of text in an object of size bytes: compressed objects
+    (see s3reader.codec_for) expand by the ratio of their codec, from
+    ratios or s3reader.COMPRESSION_RATIOS
+    '''
+    codec = s3reader.codec_for(key)
+    if codec is None:
+        return size
+    return int(size * dict(s3reader.COMPRESSION_RATIOS, **(ratios or {}))[codec])
+
+def compute_split_size(keys, lambda_memory, concurrent_lambdas, max_batch_bytes=None, ratios=None):
+    '''
+    Split size that spreads the dataset over the available concurrency,
+    within what a streaming mapper can take (or max_batch_bytes)
+    '''
+    total_size = sum(uncompressed_size(key['Key'], key['Size'], ratios) for key in keys)
+    split_size = total_size / max(concurrent_lambdas, 1)
+    split_size = min(split_size, max_batch_bytes or mapper_batch_bytes(lambda_memory))
+    return int(max(split_size, MIN_SPLIT_SIZE))
+
+def split_creator(all_keys, split_size, ratios=None, split_sizes=None):
+    '''
+    Cut every object into (Key, Start, End) byte ranges of at most split_size
+    bytes, or the size split_sizes gives its (Key, ETag), End inclusive.
+    Mappers assign a line to the split it starts in.
+
+    A compressed object can only be read from its start, so it is one split
+    whatever its size. Its Size is the estimated size of its text, which
+    is what a mapper holds and parses.
+    '''
+    splits = []
+    for key in all_keys:
+        if s3reader.codec_for(key['Key']):
+            if key['Size']:
+                splits.append({
+                    "Key": key['Key'],
+                    "Start": 0,
+                    "End": key['Size'] - 1,
+                    "Size": uncompressed_size(key['Key'], key['Size'], ratios),
+                    "ETag": key.get('ETag')
+                    })
+            continue
+        size = (split_sizes or {}).get((key['Key'], key.get('ETag')), split_size)
+        for start in xrange(0, key['Size'], size):
+            end = min(start + size, key['Size']) - 1
+            splits.append({
+                "Key": key['Key'],
+                "Start": start,
+                "End": end,
+                "Size": end - start + 1,
+                "ETag": key.get('ETag')
+                })
+    return splits
+
+def partition_for(key, n_partitions):
+    '''
+    Shuffle partition of an intermediate key; stable across processes
+    '''
+    if not isinstance(key, str):
+        key = unicode(key).encode('utf-8')
+    return (zlib.crc32(key) & 0xffffffff) % n_partitions
+
 def batch_creator(all_keys, batch_size):
     '''
     '''
@@ -149,3 +574,40 @@ def batch_creator(all_keys, batch_size):
     if len(batch):
         batches.append(batch)
     return batches
+
+def balanced_batch_creator(all_keys, n_batches, max_batch_bytes):
+    '''
+    Pack keys into at least n_batches batches of about the same number of
+    bytes, longest-processing-time first: the largest remaining key goes to
+    the lightest batch. A new batch is opened when even the lightest one
+    has no room left under max_batch_bytes. Keys keep their listing order
+    within a batch.
+    '''
+    order = sorted(range(len(all_keys)), key=lambda i: -all_keys[i]['Size'])
+    heap = [(0, b) for b in range(min(max(n_batches, 1), len(all_keys)))]
+    members = [[] for b in heap]
+    for i in order:
+        size, b = heap[0]
+        if size and size + all_keys[i]['Size'] > max_batch_bytes:
+            b = len(members)
+            members.append([])
+            heapq.heappush(heap, (all_keys[i]['Size'], b))
+        else:
+            heapq.heapreplace(heap, (size + all_keys[i]['Size'], b))
+        members[b].append(i)
+    return [[all_keys[i] for i in sorted(m)] for m in members if m]
+
+def batch_imbalance(batches):
+    '''
+    Bytes per batch: min, mean, max, and max/mean, which bounds how much
+    longer the slowest task of a wave runs than an evenly packed one
+    '''
+    sizes = [sum(key['Size'] for key in batch) for batch in batches]
+    mean = float(sum(sizes)) / len(sizes) if sizes else 0.0
+    return {
+        "batches": len(sizes),
+        "minBytes": min(sizes) if sizes else 0,
+        "meanBytes": mean,
+        "maxBytes": max(sizes) if sizes else 0,
+        "maxOverMean": max(sizes) / mean if mean else 1.0
+        }
@@ -0,0 +1,586 @@
+'''
+Local stand-ins for S3 and Lambda
+
+LocalS3Client stores objects as plain files under <root>/<bucket>/<key>, so
+an input dataset can simply be copied into place. LocalLambdaClient runs the
+handlers in a process pool owned by the driver. Both implement the subset
+of the boto3 client APIs used by the driver and the handlers, including the
+ObjectCreated notifications that LambdaManager.create_s3_eventsource_notification
+sets up for the reducer coordinator.
+
+Asynchronous ('Event') invocations, from the driver or from inside a
+handler, are spooled to <root>/.lambda/queue and dispatched to the pool by
+the process that called LocalLambdaClient.start().
+
+Handlers are imported from the working directory of the driver, which holds
+the same sources that are zipped for AWS. Timeouts are not enforced.
+
+Copyright 2016 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+'''
+
+import datetime
+import errno
+import hashlib
+import importlib
+import json
+import multiprocessing
+import os
+import shutil
+import StringIO
+import threading
+import time
+import traceback
+import urllib
+import uuid
+
+from botocore.exceptions import ClientError
+
+import backend
+
+META_DIR = ".meta"
+NOTIFICATION_DIR = ".notifications"
+LAMBDA_DIR = ".lambda"
+TMP_DIR = ".tmp"
+UPLOAD_DIR = ".uploads"
+
+ACCOUNT_ID = "000000000000"
+REGION = "local"
+
+DISPATCH_INTERVAL = 0.02 # secs between scans of the event queue
+
+def _error(code, message, operation):
+    return ClientError({"Error": {"Code": code, "Message": message}}, operation)
+
+def _write_atomic(root, path, data):
+    '''
+    Write to a temp file and rename it into place so that concurrent readers
+    never see a partial object
+    '''
+    tmp_dir = os.path.join(root, TMP_DIR)
+    _makedirs(tmp_dir)
+    _makedirs(os.path.dirname(path))
+    tmp = os.path.join(tmp_dir, uuid.uuid4().hex)
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.rename(tmp, path)
+
+def _create_exclusive(root, path, data):
+    '''
+    _write_atomic, unless path exists: False if it does
+    '''
+    tmp_dir = os.path.join(root, TMP_DIR)
+    _makedirs(tmp_dir)
+    _makedirs(os.path.dirname(path))
+    tmp = os.path.join(tmp_dir, uuid.uuid4().hex)
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    try:
+        # Unlike a rename, a link fails if the path exists
+        os.link(tmp, path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        return False
+    finally:
+        os.remove(tmp)
+    return True
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+class LocalBody(object):
+    '''
+    Minimal botocore StreamingBody: read(amt) over a byte range of a file
+    '''
+    def __init__(self, path, start, length):
+        self._f = open(path, 'rb')
+        self._f.seek(start)
+        self._remaining = length
+
+    def read(self, amt=None):
+        if amt is None or amt > self._remaining:
+            amt = self._remaining
+        data = self._f.read(amt)
+        self._remaining -= len(data)
+        return data
+
+    def close(self):
+        self._f.close()
+
+class LocalS3Client(object):
+    def __init__(self, root):
+        self.root = root
+
+    def _object_path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    def _meta_path(self, bucket, key):
+        return os.path.join(self.root, META_DIR, bucket, key)
+
+    def _read_meta(self, bucket, key):
+        path = self._object_path(bucket, key)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(self._meta_path(bucket, key)) as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            # Copied into place by hand; no md5 on record
+            meta = {"Metadata": {}, "ETag": '"%x-%x"' % (st.st_size, int(st.st_mtime))}
+        meta["ContentLength"] = st.st_size
+        meta["LastModified"] = datetime.datetime.utcfromtimestamp(st.st_mtime)
+        return meta
+
+    ### Objects ###
+
+    def put_object(self, Bucket, Key, Body=b'', Metadata=None, **kwargs):
+        if hasattr(Body, 'read'):
+            Body = Body.read()
+        etag = '"%s"' % hashlib.md5(Body).hexdigest()
+        return self._put(Bucket, Key, Body, Metadata, etag, "ObjectCreated:Put", **kwargs)
+
+    def _put(self, Bucket, Key, Body, Metadata, etag, event_name, **kwargs):
+        meta = {
+            "Metadata": dict((k.lower(), v) for k, v in (Metadata or {}).items()),
+            "ETag": etag
+        }
+        if "ContentEncoding" in kwargs:
+            meta["ContentEncoding"] = kwargs["ContentEncoding"]
+        if kwargs.get("IfNoneMatch") == "*":
+            # The object goes first, so that the write that loses leaves
+            # the metadata of the one that won
+            if not _create_exclusive(self.root, self._object_path(Bucket, Key), Body):
+                raise _error("PreconditionFailed",
+                        "At least one of the pre-conditions you specified did not hold",
+                        "PutObject")
+            _write_atomic(self.root, self._meta_path(Bucket, Key), json.dumps(meta))
+        else:
+            _write_atomic(self.root, self._meta_path(Bucket, Key), json.dumps(meta))
+            _write_atomic(self.root, self._object_path(Bucket, Key), Body)
+        self._notify(Bucket, Key, len(Body), event_name)
+        return {"ETag": etag}
+
+    ### Multipart uploads ###
+
+    def _upload_path(self, upload_id, name):
+        return os.path.join(self.root, UPLOAD_DIR, upload_id, name)
+
+    def create_multipart_upload(self, Bucket, Key, Metadata=None, **kwargs):
+        upload_id = uuid.uuid4().hex
+        _write_atomic(self.root, self._upload_path(upload_id, "upload.json"),
+                json.dumps({"Bucket": Bucket, "Key": Key, "Metadata": Metadata or {},
+                    "ContentEncoding": kwargs.get("ContentEncoding")}))
+        return {"Bucket": Bucket, "Key": Key, "UploadId": upload_id}
+
+    def _get_upload(self, upload_id, operation):
+        try:
+            with open(self._upload_path(upload_id, "upload.json")) as f:
+                return json.load(f)
+        except IOError:
+            raise _error("NoSuchUpload", "The specified upload does not exist.", operation)
+
+    def upload_part(self, Bucket, Key, PartNumber, UploadId, Body=b'', **kwargs):
+        self._get_upload(UploadId, "UploadPart")
+        if hasattr(Body, 'read'):
+            Body = Body.read()
+        _write_atomic(self.root, self._upload_path(UploadId, "%05d" % PartNumber), Body)
+        return {"ETag": '"%s"' % hashlib.md5(Body).hexdigest()}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        upload = self._get_upload(UploadId, "CompleteMultipartUpload")
+        parts = MultipartUpload["Parts"]
+        pieces = []
+        for part in parts:
+            with open(self._upload_path(UploadId, "%05d" % part["PartNumber"]), 'rb') as f:
+                pieces.append(f.read())
+        digests = ''.join(hashlib.md5(p).digest() for p in pieces)
+        etag = '"%s-%s"' % (hashlib.md5(digests).hexdigest(), len(parts))
+        extra = {}
+        if upload.get("ContentEncoding"):
+            extra["ContentEncoding"] = upload["ContentEncoding"]
+        self._put(Bucket, Key, ''.join(pieces), upload["Metadata"], etag,
+                "ObjectCreated:CompleteMultipartUpload", **extra)
+        self.abort_multipart_upload(Bucket, Key, UploadId)
+        return {"Bucket": Bucket, "Key": Key, "ETag": etag}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        shutil.rmtree(os.path.join(self.root, UPLOAD_DIR, UploadId), ignore_errors=True)
+        return {}
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        meta = self._read_meta(Bucket, Key)
+        if meta is None:
+            raise _error("NoSuchKey", "The specified key does not exist.", "GetObject")
+        size = meta["ContentLength"]
+        start, end = 0, size - 1
+        resp = {}
+        if Range:
+            # bytes=start-end | bytes=start- | bytes=-suffix
+            first, last = Range.split('=')[1].split('-')
+            if first == '':
+                start, end = max(0, size - int(last)), size - 1
+            else:
+                start = int(first)
+                end = min(int(last), size - 1) if last else size - 1
+            if start >= size:
+                raise _error("InvalidRange", "The requested range is not satisfiable", "GetObject")
+            resp["ContentRange"] = "bytes %s-%s/%s" % (start, end, size)
+        length = end - start + 1
+        resp.update({
+            "Body": LocalBody(self._object_path(Bucket, Key), start, length),
+            "ContentLength": length,
+            "ETag": meta["ETag"],
+            "LastModified": meta["LastModified"],
+            "Metadata": meta["Metadata"]
+        })
+        if "ContentEncoding" in meta:
+            resp["ContentEncoding"] = meta["ContentEncoding"]
+        return resp
+
+    def head_object(self, Bucket, Key, **kwargs):
+        meta = self._read_meta(Bucket, Key)
+        if meta is None:
+            raise _error("404", "Not Found", "HeadObject")
+        return meta
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        for path, base in ((self._object_path(Bucket, Key), os.path.join(self.root, Bucket)),
+                (self._meta_path(Bucket, Key), os.path.join(self.root, META_DIR, Bucket))):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            # S3 has no directories: drop the ones left empty, so that the
+            # key of one can be written as an object again
+            parent = os.path.dirname(path)
+            while parent != base and parent.startswith(base):
+                try:
+                    os.rmdir(parent)
+                except OSError:
+                    break
+                parent = os.path.dirname(parent)
+        return {}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        for obj in Delete["Objects"]:
+            self.delete_object(Bucket, obj["Key"])
+        return {}
+
+    def copy_object(self, Bucket, Key, CopySource, **kwargs):
+        meta = self._read_meta(CopySource["Bucket"], CopySource["Key"])
+        if meta is None:
+            raise _error("NoSuchKey", "The specified key does not exist.", "CopyObject")
+        with open(self._object_path(CopySource["Bucket"], CopySource["Key"]), 'rb') as f:
+            body = f.read()
+        extra = {}
+        if "ContentEncoding" in meta:
+            extra["ContentEncoding"] = meta["ContentEncoding"]
+        self._put(Bucket, Key, body, meta["Metadata"], meta["ETag"], "ObjectCreated:Copy", **extra)
+        return {"CopyObjectResult": {"ETag": meta["ETag"]}}
+
+    def _all_keys(self, bucket, prefix):
+        base = os.path.join(self.root, bucket)
+        # Only walk the directory that can contain the prefix
+        start = os.path.join(base, os.path.dirname(prefix))
+        keys = []
+        for dirpath, dirnames, filenames in os.walk(start):
+            rel = os.path.relpath(dirpath, base)
+            rel = '' if rel == '.' else rel.replace(os.sep, '/') + '/'
+            for name in filenames:
+                key = rel + name
+                if key.startswith(prefix):
+                    keys.append(key)
+        keys.sort()
+        return keys
+
+    def _list(self, bucket, prefix, after, max_keys, delimiter):
+        contents = []
+        common_prefixes = []
+        last = None
+        truncated = False
+        for key in self._all_keys(bucket, prefix):
+            if after and key <= after:
+                continue
+            if delimiter:
+                idx = key.find(delimiter, len(prefix))
+                if idx >= 0:
+                    cp = key[:idx + len(delimiter)]
+                    if common_prefixes and common_prefixes[-1] == cp:
+                        continue
+                    if after and cp <= after:
+                        continue
+                    if len(contents) + len(common_prefixes) >= max_keys:
+                        truncated = True
+                        break
+                    common_prefixes.append(cp)
+                    last = cp
+                    continue
+            if len(contents) + len(common_prefixes) >= max_keys:
+                truncated = True
+                break
+            meta = self._read_meta(bucket, key)
+            if meta is None:
+                continue
+            contents.append({
+                "Key": key,
+                "Size": meta["ContentLength"],
+                "ETag": meta["ETag"],
+                "LastModified": meta["LastModified"],
+                "StorageClass": "STANDARD"
+            })
+            last = key
+        resp = {"IsTruncated": truncated, "Name": bucket, "Prefix": prefix, "MaxKeys": max_keys}
+        if contents:
+            resp["Contents"] = contents
+        if common_prefixes:
+            resp["CommonPrefixes"] = [{"Prefix": cp} for cp in common_prefixes]
+        if delimiter:
+            resp["Delimiter"] = delimiter
+        return resp, last
+
+    def list_objects(self, Bucket, Prefix='', Marker='', MaxKeys=1000, Delimiter=None, **kwargs):
+        resp, last = self._list(Bucket, Prefix, Marker, MaxKeys, Delimiter)
+        resp["Marker"] = Marker
+        if resp["IsTruncated"] and Delimiter:
+            resp["NextMarker"] = last
+        return resp
+
+    def list_objects_v2(self, Bucket, Prefix='', ContinuationToken=None, StartAfter='',
+            MaxKeys=1000, Delimiter=None, **kwargs):
+        after = ContinuationToken or StartAfter
+        resp, last = self._list(Bucket, Prefix, after, MaxKeys, Delimiter)
+        resp["KeyCount"] = len(resp.get("Contents", [])) + len(resp.get("CommonPrefixes", []))
+        if ContinuationToken:
+            resp["ContinuationToken"] = ContinuationToken
+        if resp["IsTruncated"]:
+            resp["NextContinuationToken"] = last
+        return resp
+
+    ### Notifications ###
+
+    def _notification_path(self, bucket):
+        return os.path.join(self.root, NOTIFICATION_DIR, bucket + ".json")
+
+    def put_bucket_notification_configuration(self, Bucket, NotificationConfiguration):
+        _write_atomic(self.root, self._notification_path(Bucket),
+                json.dumps(NotificationConfiguration))
+        return {}
+
+    def get_bucket_notification_configuration(self, Bucket):
+        try:
+            with open(self._notification_path(Bucket)) as f:
+                return json.load(f)
+        except IOError:
+            return {}
+
+    def _notify(self, bucket, key, size, event_name):
+        config = self.get_bucket_notification_configuration(bucket)
+        for lc in config.get('LambdaFunctionConfigurations', []):
+            if not any(e in ('s3:ObjectCreated:*', 's3:' + event_name) for e in lc['Events']):
+                continue
+            rules = lc.get('Filter', {}).get('Key', {}).get('FilterRules', [])
+            if not all(self._match(r, key) for r in rules):
+                continue
+            event = {
+                "Records": [{
+                    "eventVersion": "2.0",
+                    "eventSource": "aws:s3",
+                    "awsRegion": REGION,
+                    "eventTime": datetime.datetime.utcnow().isoformat() + "Z",
+                    "eventName": event_name,
+                    "s3": {
+                        "bucket": {"name": bucket, "arn": "arn:aws:s3:::" + bucket},
+                        "object": {"key": urllib.quote_plus(key), "size": size}
+                    }
+                }]
+            }
+            LocalLambdaClient(self.root).invoke(
+                    FunctionName = lc['LambdaFunctionArn'],
+                    InvocationType = 'Event',
+                    Payload = json.dumps(event))
+
+    @staticmethod
+    def _match(rule, key):
+        if rule['Name'].lower() == 'prefix':
+            return key.startswith(rule['Value'])
+        return key.endswith(rule['Value'])
+
+class LocalContext(object):
+    '''
+    The parts of the Lambda context object a handler may look at
+    '''
+    def __init__(self, function_name, config):
+        self.function_name = function_name
+        self.function_version = str(config.get("Version", "$LATEST"))
+        self.invoked_function_arn = _function_arn(function_name)
+        self.memory_limit_in_mb = config.get("MemorySize", 128)
+        self.aws_request_id = str(uuid.uuid4())
+        self.log_group_name = "/aws/lambda/" + function_name
+        self.log_stream_name = "local"
+        self._deadline = time.time() + config.get("Timeout", 3)
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self._deadline - time.time()) * 1000))
+
+def _function_arn(name):
+    return "arn:aws:lambda:%s:%s:function:%s" % (REGION, ACCOUNT_ID, name)
+
+def _function_name(name_or_arn):
+    # Accepts a bare name, an ARN or a qualified ARN
+    if name_or_arn.startswith("arn:"):
+        return name_or_arn.split(':')[6]
+    return name_or_arn.split(':')[0]
+
+def _run_handler(root, function_name, config, payload):
+    '''
+    Runs inside a pool worker. Handler modules stay imported between
+    invocations, like a warm container.
+    '''
+    backend.use_local(root)
+    module_name, handler_name = config["Handler"].rsplit('.', 1)
+    try:
+        handler = getattr(importlib.import_module(module_name), handler_name)
+        result = handler(json.loads(payload or 'null'), LocalContext(function_name, config))
+        return None, json.dumps(result)
+    except Exception as e:
+        traceback.print_exc()
+        return "Unhandled", json.dumps({
+            "errorMessage": str(e),
+            "errorType": type(e).__name__,
+            "stackTrace": traceback.format_exc().splitlines()
+        })
+
+class LocalLambdaClient(object):
+    def __init__(self, root):
+        self.root = root
+        self._pool = None
+        self._dispatcher = None
+        self._stopped = threading.Event()
+
+    def _function_path(self, name):
+        return os.path.join(self.root, LAMBDA_DIR, "functions", name + ".json")
+
+    def _queue_dir(self):
+        return os.path.join(self.root, LAMBDA_DIR, "queue")
+
+    def _get_config(self, name):
+        try:
+            with open(self._function_path(name)) as f:
+                return json.load(f)
+        except IOError:
+            raise _error("ResourceNotFoundException", "Function not found: " + name, "Invoke")
+
+    def _put_config(self, name, config):
+        _write_atomic(self.root, self._function_path(name), json.dumps(config))
+
+    ### Service ###
+
+    def start(self, workers=None):
+        '''
+        Create the worker pool and start dispatching queued Event invocations
+        '''
+        _makedirs(self._queue_dir())
+        self._pool = multiprocessing.Pool(workers or multiprocessing.cpu_count())
+        self._dispatcher = threading.Thread(target=self._dispatch)
+        self._dispatcher.daemon = True
+        self._dispatcher.start()
+
+    def shutdown(self):
+        self._stopped.set()
+        if self._dispatcher:
+            self._dispatcher.join()
+        if self._pool:
+            self._pool.terminate()
+            self._pool.join()
+
+    def _dispatch(self):
+        qdir = self._queue_dir()
+        while not self._stopped.is_set():
+            for fname in sorted(os.listdir(qdir)):
+                path = os.path.join(qdir, fname)
+                with open(path) as f:
+                    item = json.load(f)
+                os.remove(path)
+                try:
+                    config = self._get_config(item["FunctionName"])
+                except ClientError as e:
+                    print "Dropping event for", item["FunctionName"], e
+                    continue
+                self._pool.apply_async(_run_handler,
+                        (self.root, item["FunctionName"], config, item["Payload"]))
+            self._stopped.wait(DISPATCH_INTERVAL)
+
+    ### Functions ###
+
+    def create_function(self, FunctionName, Handler, Code=None, MemorySize=128, Timeout=3, **kwargs):
+        if os.path.exists(self._function_path(FunctionName)):
+            raise _error("ResourceConflictException",
+                    "Function already exist: " + FunctionName, "CreateFunction")
+        config = {
+            "FunctionName": FunctionName,
+            "FunctionArn": _function_arn(FunctionName),
+            "Handler": Handler,
+            "MemorySize": MemorySize,
+            "Timeout": Timeout,
+            "Description": kwargs.get("Description", ""),
+            "Version": 1
+        }
+        self._put_config(FunctionName, config)
+        return config
+
+    def update_function_code(self, FunctionName, ZipFile=None, Publish=False, **kwargs):
+        config = self._get_config(FunctionName)
+        if Publish:
+            config["Version"] += 1
+        self._put_config(FunctionName, config)
+        resp = dict(config)
+        resp["FunctionArn"] = "%s:%s" % (config["FunctionArn"], config["Version"])
+        return resp
+
+    def update_function_configuration(self, FunctionName, **kwargs):
+        config = self._get_config(FunctionName)
+        for field in ("Handler", "MemorySize", "Timeout", "Description"):
+            if field in kwargs:
+                config[field] = kwargs[field]
+        self._put_config(FunctionName, config)
+        return config
+
+    def get_function_configuration(self, FunctionName, **kwargs):
+        return self._get_config(_function_name(FunctionName))
+
+    def delete_function(self, FunctionName, **kwargs):
+        self._get_config(FunctionName)
+        os.remove(self._function_path(FunctionName))
+        return {}
+
+    def add_permission(self, FunctionName, StatementId, **kwargs):
+        return {"Statement": json.dumps({"Sid": StatementId})}
+
+    def invoke(self, FunctionName, InvocationType='RequestResponse', Payload='', **kwargs):
+        name = _function_name(FunctionName)
+        config = self._get_config(name)
+        if InvocationType == 'Event':
+            qdir = self._queue_dir()
+            fname = "%020d-%s.json" % (int(time.time() * 1000000), uuid.uuid4().hex)
+            _write_atomic(self.root, os.path.join(qdir, fname),
+                    json.dumps({"FunctionName": name, "Payload": Payload}))
+            return {"StatusCode": 202, "Payload": StringIO.StringIO('')}
+
+        args = (self.root, name, config, Payload)
+        if self._pool:
+            error, result = self._pool.apply(_run_handler, args)
+        else:
+            error, result = _run_handler(*args)
+        resp = {"StatusCode": 200, "Payload": StringIO.StringIO(result)}
+        if error:
+            resp["FunctionError"] = error
+        return resp
@@ -0,0 +1,165 @@
+'''
+Input key manifest for the driver
+
+The input prefix is listed in parallel: sub-prefixes are discovered with
+a "/" delimiter, a level at a time, until there are enough of them to keep
+LIST_CONCURRENCY listings busy, and each is then listed with pagination in
+its own thread. Keys, sizes and ETags are held in flat lists and an array
+rather than one object per key, and the manifest is saved to the job
+bucket so that a re-run of the same input can skip the listing.
+
+Saved form: MAGIC, a JSON header line, then zlib of the keys, sizes and
+ETags, each joined with NUL and the three separated by \\x01 (characters
+S3 keys cannot contain).
+
+Copyright 2016 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+'''
+
+import array
+import botocore
+import hashlib
+import json
+import lambdautils
+import time
+import zlib
+
+from multiprocessing.dummy import Pool as ThreadPool
+
+MAGIC = "BLM1"
+MANIFEST_PREFIX = "manifests/"
+
+# Listings in flight, and how many levels of sub-prefixes to look for
+LIST_CONCURRENCY = 16
+MAX_DEPTH = 3
+
+class Manifest(object):
+    def __init__(self, bucket, prefix, keys, sizes, etags, created=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.keys = keys
+        self.sizes = sizes # array('d'): exact up to 2^53 bytes
+        self.etags = etags
+        self.created = time.time() if created is None else created
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        '''
+        {Key, Size, ETag} dicts, built as they are consumed
+        '''
+        for i in xrange(len(self.keys)):
+            yield {"Key": self.keys[i], "Size": int(self.sizes[i]), "ETag": self.etags[i]}
+
+    def total_bytes(self):
+        return int(sum(self.sizes))
+
+    def dumps(self):
+        header = json.dumps({
+            "bucket": self.bucket,
+            "prefix": self.prefix,
+            "count": len(self.keys),
+            "bytes": self.total_bytes(),
+            "created": self.created
+            })
+        body = "\x01".join(["\0".join(self.keys),
+                            "\0".join("%d" % s for s in self.sizes),
+                            "\0".join(self.etags)])
+        return MAGIC + header + "\n" + zlib.compress(body)
+
+    @classmethod
+    def loads(cls, data):
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError("not a key manifest")
+        header, body = data[len(MAGIC):].split("\n", 1)
+        header = json.loads(header)
+        keys, sizes, etags = zlib.decompress(body).split("\x01")
+        if not header["count"]:
+            return cls(header["bucket"], header["prefix"], [], array.array('d'), [], header["created"])
+        return cls(header["bucket"], header["prefix"], keys.split("\0"),
+                array.array('d', map(float, sizes.split("\0"))), etags.split("\0"), header["created"])
+
+def manifest_key(bucket, prefix):
+    return MANIFEST_PREFIX + hashlib.sha1("%s/%s" % (bucket, prefix)).hexdigest()
+
+def _entries(resp):
+    entries = []
+    for obj in resp.get("Contents", []):
+        key = obj["Key"]
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        entries.append((key, obj["Size"], obj["ETag"]))
+    return entries
+
+def _list(s3, bucket, prefix, delimiter=None):
+    '''
+    (entries, sub-prefixes) of one paginated listing
+    '''
+    entries = []
+    prefixes = []
+    kwargs = {"Bucket": bucket, "Prefix": prefix}
+    if delimiter:
+        kwargs["Delimiter"] = delimiter
+    while True:
+        resp = s3.list_objects_v2(**kwargs)
+        entries.extend(_entries(resp))
+        prefixes.extend(cp["Prefix"] for cp in resp.get("CommonPrefixes", []))
+        if not resp["IsTruncated"]:
+            return entries, prefixes
+        kwargs["ContinuationToken"] = resp["NextContinuationToken"]
+
+def list_manifest(s3, bucket, prefix, concurrency=LIST_CONCURRENCY):
+    '''
+    Manifest of every object under prefix, in key order
+    '''
+    entries = []
+    pool = ThreadPool(concurrency)
+    try:
+        level = [prefix]
+        for depth in range(MAX_DEPTH):
+            next_level = []
+            for found, prefixes in pool.map(lambda p: _list(s3, bucket, p, "/"), level):
+                entries.extend(found)
+                next_level.extend(prefixes)
+            level = next_level
+            if len(level) >= concurrency:
+                break
+        for found, prefixes in pool.map(lambda p: _list(s3, bucket, p), level):
+            entries.extend(found)
+    finally:
+        pool.close()
+
+    entries.sort()
+    return Manifest(bucket, prefix, [e[0] for e in entries],
+            array.array('d', (e[1] for e in entries)), [e[2] for e in entries])
+
+def get_manifest(s3, bucket, prefix, job_bucket, options=None):
+    '''
+    The saved manifest of bucket/prefix if it is younger than
+    options["maxAge"] secs, else a fresh listing, which is saved for the
+    next run. S3 cannot tell cheaply whether a prefix changed, so a saved
+    manifest is only reused within maxAge; without it the input is always
+    listed.
+    '''
+    options = options or {}
+    key = manifest_key(bucket, prefix)
+    max_age = options.get("maxAge")
+    if max_age:
+        try:
+            saved = Manifest.loads(s3.get_object(Bucket=job_bucket, Key=key)["Body"].read())
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] not in lambdautils.MISSING_CODES:
+                raise
+            saved = None
+        if saved is not None and saved.bucket == bucket and saved.prefix == prefix and \
+                time.time() - saved.created <= max_age:
+            print "Reusing key manifest s3://%s/%s (%d keys, %.0fs old)" % (job_bucket, key,
+                    len(saved), time.time() - saved.created)
+            return saved
+
+    start = time.time()
+    manifest = list_manifest(s3, bucket, prefix, options.get("concurrency", LIST_CONCURRENCY))
+    print "Listed %d keys in %.2fs" % (len(manifest), time.time() - start)
+    s3.put_object(Bucket=job_bucket, Key=key, Body=manifest.dumps())
+    return manifest
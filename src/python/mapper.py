@@ -5,77 +5,143 @@ Copyright 2016 Amazon.com, Inc. or its affiliates. All Rights Reserved.
 SPDX-License-Identifier: MIT-0
 '''
 
-import boto3
+import backend
+import intermediate
+import itertools
+import jobspec
 import json
-import random
-import resource
-import StringIO
+import lambdautils
+import metrics
+import numpyengine
+import s3reader
 import time
 
-# create an S3 session
-s3 = boto3.resource('s3')
-s3_client = boto3.client('s3')
+from multiprocessing.dummy import Pool as ThreadPool
 
 # constants
 TASK_MAPPER_PREFIX = "task/mapper/";
+SHUFFLE_PREFIX = "shuffle/";
+MAX_WRITERS = 16
 
 def write_to_s3(bucket, key, data, metadata):
-    s3.Bucket(bucket).put_object(Key=key, Body=data, Metadata=metadata)
+    backend.s3_client().put_object(Bucket=bucket, Key=key, Body=data, Metadata=metadata)
 
 def lambda_handler(event, context):
     
     start_time = time.time()
+    s3_client = backend.s3_client()
 
     job_bucket = event['jobBucket']
     src_bucket = event['bucket']
-    src_keys = event['keys']
+    # (key, start, end) byte ranges; whole objects if only keys are given
+    splits = event.get('splits') or [[key, 0, None] for key in event['keys']]
     job_id = event['jobId']
     mapper_id = event['mapperId']
+    n_partitions = event.get('nPartitions')
+    out_format = event.get('intermediateFormat', intermediate.JSON)
+    job = jobspec.load(event.get('jobSpec'))
+    task = metrics.TaskMetrics("mapper-%s" % mapper_id, "mapper")
    
+    mapper_fname = "%s/%s%s" % (job_id, TASK_MAPPER_PREFIX, mapper_id) 
+
+    # A backup copy of this mapper may already have finished
+    done = lambdautils.object_metadata(s3_client, job_bucket, mapper_fname)
+    if done is not None:
+        print "Mapper %s already done" % mapper_id
+        return json.loads(done[metrics.METRICS_META])
+
+    # "numpy" parses and aggregates a whole block of lines at a time
+    use_numpy = event.get('engine') == "numpy"
+    if use_numpy and not (numpyengine.available() and job.vectorized):
+        print "NumPy engine not available for %s, using map_line" % job.name
+        use_numpy = False
+
+    if use_numpy:
+        aggregator = numpyengine.Aggregator(job.map_into, **job.vectorized)
+
     # aggr 
     output = {}
     line_count = 0
-    err = ''
-
-    # INPUT CSV => OUTPUT JSON
-
-    # Download and process all keys
-    for key in src_keys:
-        response = s3_client.get_object(Bucket=src_bucket,Key=key)
-        contents = response['Body'].read()
-        
-        for line in contents.split('\n')[:-1]:
-            line_count +=1
-            try:
-                data = line.split(',')
-                srcIp = data[0][:8]
-                if srcIp not in output:
-                    output[srcIp] = 0
-                output[srcIp] += float(data[3])
-            except Exception, e:
-                print e
-                #err += '%s' % e
+
+    # INPUT CSV => map_line => combine into one accumulator per key =>
+    # OUTPUT JSON or binary intermediate
+
+    # Download and process all keys; the next objects are prefetched
+    # while the current one is parsed
+    ranges = [s3reader.input_range(s) for s in splits]
+    reader = s3reader.prefetch_reader(s3_client, src_bucket, ranges, event.get('prefetch'))
+    try:
+        for split, (item, body) in itertools.izip(splits, reader):
+            body = task.body(body)
+
+            # Stream the range, decompressing gzip or bz2 objects on the way;
+            # only one chunk is in memory at a time
+            blocks = s3reader.iter_input_text_blocks(s3_client, src_bucket, split, body)
+            for text in blocks:
+                with task.timer("parseSecs"):
+                    if use_numpy:
+                        line_count += aggregator.add(text)
+                    else:
+                        line_count += job.map_into(text.split('\n'), output)
+    finally:
+        # Stops the fetches still running if a split failed
+        reader.close()
+    if use_numpy:
+        with task.timer("parseSecs"):
+            aggregator.result(output)
+    task.add("getRequests", reader.requests)
+    task.add("recordsIn", line_count)
+    task.add("recordsOut", len(output))
 
     time_in_secs = (time.time() - start_time)
-    #timeTaken = time_in_secs * 1000000000 # in 10^9 
-    #s3DownloadTime = 0
-    #totalProcessingTime = 0 
-    pret = [len(src_keys), line_count, time_in_secs, err]
-    mapper_fname = "%s/%s%s" % (job_id, TASK_MAPPER_PREFIX, mapper_id) 
+
+    # First copy to write wins. The output only depends on the input, so
+    # copies racing past this check write the same bytes.
+    if lambdautils.object_metadata(s3_client, job_bucket, mapper_fname) is not None:
+        print "Mapper %s output already written by another copy" % mapper_id
+        return task.finish()
+
+    write_start = time.time()
+    if n_partitions:
+        # Hash-partitioned shuffle: one file per reducer partition. The task
+        # file is written last and only marks the mapper as done.
+        parts = [{} for p in range(n_partitions)]
+        for key, val in output.iteritems():
+            parts[lambdautils.partition_for(key, n_partitions)][key] = val
+        parts = [intermediate.dumps(job.encode_all(part), out_format) for part in parts]
+        pool = ThreadPool(min(n_partitions, MAX_WRITERS))
+        pool.map(lambda p: write_to_s3(job_bucket,
+                    "%s/%s%s/%s" % (job_id, SHUFFLE_PREFIX, p, mapper_id), parts[p], {}),
+                range(n_partitions))
+        pool.close()
+        task.add("bytesOut", sum(len(part) for part in parts))
+        task.add("putRequests", n_partitions)
+        data = json.dumps({"partitionSizes": [len(part) for part in parts]})
+    else:
+        data = intermediate.dumps(job.encode_all(output), out_format)
+        task.add("bytesOut", len(data))
+    task.add("putRequests", 1)
+
+    # The record in the metadata leaves out the time of this last PUT
+    task.add("writeSecs", time.time() - write_start)
+    record = task.finish()
     metadata = {
                     "linecount":  '%s' % line_count,
+                    "outputkeys": '%s' % len(output),
                     "processingtime": '%s' % time_in_secs,
-                    "memoryUsage": '%s' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                    "memoryUsage": '%s' % record["peakRssKb"],
+                    metrics.METRICS_META: metrics.dumps(record)
                }
-
     print "metadata", metadata
-    write_to_s3(job_bucket, mapper_fname, json.dumps(output), metadata)
-    return pret
+    write_start = time.time()
+    write_to_s3(job_bucket, mapper_fname, data, metadata)
+    task.add("writeSecs", time.time() - write_start)
+    return task.finish()
 
 '''
 ev = {
    "bucket": "-useast-1", 
-   "keys": ["key.sample"],
+   "splits": [["key.sample", 0, 1048575]],
    "jobId": "pyjob",
    "mapperId": 1,
    "jobBucket": "-useast-1"
@@ -0,0 +1,93 @@
+'''
+Benchmark the mapper engines
+
+Generates uservisits-like CSV lines, runs them through the line loop of
+the default job spec and through the NumPy engine in blocks of the size the mapper
+reads (s3reader.CHUNK_SIZE), checks that both give the same sums, and
+reports records per second of each. n_ips limits the number of distinct
+source IPs; by default every line gets a random one.
+
+  $ python mapper_benchmark.py [n_lines] [repeat] [n_ips]
+'''
+
+import jobspec
+import json
+import numpyengine
+import random
+import s3reader
+import StringIO
+import sys
+import time
+
+def random_ip():
+    return '%d.%d.%d.%d' % tuple(random.randint(1, 255) for _ in range(4))
+
+def make_data(n_lines, n_ips=None, seed=42):
+    random.seed(seed)
+    ips = [random_ip() for i in range(n_ips)] if n_ips else None
+    out = []
+    for i in range(n_lines):
+        ip = random.choice(ips) if ips else random_ip()
+        out.append('%s,http://example.com/%d,1980-01-01,%.6f,Mozilla/5.0,USA,USA-en,word,%d\n' %
+                (ip, i, random.random() * 1000, i % 10))
+    return ''.join(out)
+
+def run_python(data):
+    job = jobspec.load()
+    output = {}
+    count = 0
+    for text in s3reader.iter_text_blocks(StringIO.StringIO(data)):
+        count += job.map_into(text.split('\n'), output)
+    return count, output
+
+def run_numpy(data):
+    job = jobspec.load()
+    aggregator = numpyengine.Aggregator(job.map_into, **job.vectorized)
+    count = 0
+    for text in s3reader.iter_text_blocks(StringIO.StringIO(data)):
+        count += aggregator.add(text)
+    return count, aggregator.result({})
+
+def best_of(repeat, fn, *args):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = fn(*args)
+        secs = time.time() - start
+        best = secs if best is None else min(best, secs)
+    return best, result
+
+def run(n_lines, repeat, n_ips=None):
+    data = make_data(n_lines, n_ips)
+    engines = [("python", run_python)]
+    if numpyengine.available():
+        engines.append(("numpy", run_numpy))
+    stats = {}
+    outputs = {}
+    for name, engine in engines:
+        secs, (count, outputs[name]) = best_of(repeat, engine, data)
+        stats[name] = {"secs": secs, "lines": count, "recordsPerSec": count / secs}
+    if "numpy" in outputs:
+        ref = outputs["python"]
+        got = outputs["numpy"]
+        stats["numpy"]["sameKeys"] = sorted(ref) == sorted(got)
+        stats["numpy"]["maxRelError"] = max(abs(got.get(k, 0) - v) / max(abs(v), 1e-12)
+                for k, v in ref.iteritems())
+        stats["numpy"]["speedup"] = stats["numpy"]["recordsPerSec"] / stats["python"]["recordsPerSec"]
+    return stats
+
+if __name__ == '__main__':
+    n_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    n_ips = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    stats = run(n_lines, repeat, n_ips)
+    print "%-8s %12s %12s" % ("engine", "secs", "records/s")
+    for name in ("python", "numpy"):
+        if name in stats:
+            print "%-8s %12.3f %12d" % (name, stats[name]["secs"], stats[name]["recordsPerSec"])
+    if "numpy" in stats:
+        print "speedup %.2f, same keys %s, max relative error %.2g" % (stats["numpy"]["speedup"],
+                stats["numpy"]["sameKeys"], stats["numpy"]["maxRelError"])
+    else:
+        print "NumPy is not installed; only the line loop was run"
+    print json.dumps(stats)
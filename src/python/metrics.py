@@ -0,0 +1,311 @@
+'''
+Task metrics and the job report
+
+Every mapper and reducer fills a TaskMetrics record:
+
+  task, stage               e.g. "mapper-3" of "mapper", "reducer-1-0" of
+                            "reducer-1"
+  coldStart                 first invocation of the container
+  bytesIn, getRequests      input bytes read and GETs issued
+  downloadSecs              time spent waiting for input bytes; with
+                            prefetching, the download time that was not
+                            hidden behind parsing
+  parseSecs                 time spent in the job's map or reduce functions
+  writeSecs                 time spent writing the outputs
+  recordsIn, recordsOut     input lines or intermediate records, and
+                            output records
+  bytesOut, putRequests     output bytes and PUTs issued
+  peakRssKb                 peak resident set size
+  totalSecs                 handler duration
+
+Mappers return their record to the driver. A reducer stores its record in
+the metadata of its output, and the reducers of the next step, which GET
+that output anyway, fold the records into a StageSummary per step (counts,
+sums and a histogram of durations). The summaries travel up the reducer
+tree in the same metadata, so the driver gets every reducer step from the
+HEAD of the result instead of one HEAD per reducer.
+
+Copyright 2016 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+'''
+
+import contextlib
+import json
+import math
+import resource
+import time
+
+# Output metadata holding the record of a task and the summaries of the
+# steps before it
+METRICS_META = "metrics"
+STAGES_META = "stages"
+
+SUM_FIELDS = ("bytesIn", "getRequests", "downloadSecs", "parseSecs", "writeSecs",
+        "recordsIn", "recordsOut", "bytesOut", "putRequests", "totalSecs")
+
+# Duration histogram: buckets of a quarter of a power of 2 (19%) from 1 ms
+BUCKETS_PER_OCTAVE = 4
+MIN_SECS = 0.001
+
+# S3 user metadata is limited to 2 KB, counted as the bytes of its keys
+# and values. Step summaries that do not fit leave out their histograms,
+# then the earliest steps are merged into one summary.
+METADATA_LIMIT = 2048
+MERGED_STAGE = "reducer-earlier"
+
+# Prices (us-east-1) for the cost estimate
+LAMBDA_GB_SEC = 0.00001667
+LAMBDA_REQUEST = 0.2 / 1000000
+S3_GET = 0.004 / 10000
+S3_PUT = 0.005 / 1000
+S3_GB_HOUR = 0.0000521574022522109
+
+# Set by the first task of this container
+_warm = False
+
+def cold_start():
+    global _warm
+    cold = not _warm
+    _warm = True
+    return cold
+
+def _round(value):
+    return round(value, 4) if isinstance(value, float) else value
+
+def dumps(record):
+    return json.dumps(dict((k, _round(v)) for k, v in record.iteritems()), separators=(',', ':'))
+
+class TaskMetrics(object):
+    def __init__(self, task, stage):
+        self.start = time.time()
+        self.record = dict.fromkeys(SUM_FIELDS, 0)
+        self.record.update({"task": task, "stage": stage, "coldStart": cold_start()})
+
+    def add(self, field, n):
+        self.record[field] += n
+
+    @contextlib.contextmanager
+    def timer(self, field):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record[field] += time.time() - start
+
+    def body(self, body):
+        '''
+        body, counting the bytes read from it and the time spent waiting
+        '''
+        return _TimedBody(self, body)
+
+    def finish(self):
+        self.record["totalSecs"] = time.time() - self.start
+        self.record["peakRssKb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return self.record
+
+class _TimedBody(object):
+    def __init__(self, metrics, body):
+        self._metrics = metrics
+        self._body = body
+
+    def read(self, amt=None):
+        with self._metrics.timer("downloadSecs"):
+            data = self._body.read(amt)
+        self._metrics.add("bytesIn", len(data))
+        return data
+
+    def close(self):
+        self._body.close()
+
+    def __getattr__(self, name):
+        # e.g. the content_encoding of a prefetched body
+        return getattr(self._body, name)
+
+def _bucket(secs):
+    return int(math.floor(math.log(max(secs, MIN_SECS), 2) * BUCKETS_PER_OCTAVE))
+
+class StageSummary(object):
+    '''
+    Mergeable summary of the records of one stage
+    '''
+    def __init__(self, data=None):
+        self.data = data or {"n": 0, "cold": 0, "maxRssKb": 0, "hist": {}}
+
+    def pack(self, hist=True):
+        d = self.data
+        return [d["n"], d["cold"], d["maxRssKb"], _round(d["minSecs"]), _round(d["maxSecs"]),
+                [_round(d[field]) for field in SUM_FIELDS], d["hist"] if hist else {}]
+
+    @classmethod
+    def unpack(cls, packed):
+        n, cold, max_rss, min_secs, max_secs, sums, hist = packed
+        data = {"n": n, "cold": cold, "maxRssKb": max_rss, "minSecs": min_secs,
+                "maxSecs": max_secs, "hist": hist}
+        data.update(zip(SUM_FIELDS, sums))
+        return cls(data)
+
+    def add(self, record):
+        d = self.data
+        secs = record["totalSecs"]
+        d["minSecs"] = min(d.get("minSecs", secs), secs)
+        d["maxSecs"] = max(d.get("maxSecs", secs), secs)
+        d["n"] += 1
+        d["cold"] += 1 if record.get("coldStart") else 0
+        d["maxRssKb"] = max(d["maxRssKb"], record.get("peakRssKb", 0))
+        for field in SUM_FIELDS:
+            d[field] = d.get(field, 0) + record.get(field, 0)
+        b = str(_bucket(secs))
+        d["hist"][b] = d["hist"].get(b, 0) + 1
+
+    def merge(self, other):
+        d, o = self.data, other.data
+        if not o["n"]:
+            return
+        d["minSecs"] = min(d.get("minSecs", o["minSecs"]), o["minSecs"])
+        d["maxSecs"] = max(d.get("maxSecs", o["maxSecs"]), o["maxSecs"])
+        for field in ("n", "cold") + SUM_FIELDS:
+            d[field] = d.get(field, 0) + o.get(field, 0)
+        d["maxRssKb"] = max(d["maxRssKb"], o["maxRssKb"])
+        for b, count in o["hist"].iteritems():
+            d["hist"][b] = d["hist"].get(b, 0) + count
+
+    def percentile(self, q):
+        '''
+        Duration at quantile q, to the resolution of the histogram
+        '''
+        d = self.data
+        rank = q * d["n"]
+        seen = 0
+        for b in sorted(d["hist"], key=int):
+            seen += d["hist"][b]
+            if seen >= rank:
+                mid = 2 ** ((int(b) + 0.5) / BUCKETS_PER_OCTAVE)
+                return min(max(mid, d["minSecs"]), d["maxSecs"])
+        # No histogram, see METADATA_LIMIT
+        return d.get("maxSecs", 0)
+
+def loads_stages(text):
+    return dict((stage, StageSummary.unpack(packed))
+            for stage, packed in json.loads(text or '{}').iteritems())
+
+def dumps_stages(stages, hist=True):
+    return json.dumps(dict((stage, s.pack(hist)) for stage, s in stages.iteritems()),
+            separators=(',', ':'))
+
+def metadata_size(metadata):
+    return sum(len(key) + len(value) for key, value in metadata.iteritems())
+
+def _step(stage):
+    # Steps in the order they ran, the merged ones first
+    if stage == MERGED_STAGE:
+        return -1
+    tail = stage.rsplit('-', 1)[-1]
+    return int(tail) if tail.isdigit() else 0
+
+def with_stages(metadata, stages):
+    '''
+    metadata with the step summaries of stages, within METADATA_LIMIT
+    '''
+    stages = dict(stages)
+    hist = True
+    while True:
+        out = dict(metadata)
+        out[STAGES_META] = dumps_stages(stages, hist)
+        if metadata_size(out) <= METADATA_LIMIT or (not hist and len(stages) < 2):
+            return out
+        if hist:
+            hist = False
+            continue
+        merged = StageSummary()
+        for stage in sorted(stages, key=_step)[:2]:
+            merged.merge(stages.pop(stage))
+        stages[MERGED_STAGE] = merged
+
+def fold(stages, metadata):
+    '''
+    Add the record and step summaries in the metadata of a task output to
+    stages
+    '''
+    for stage, summary in loads_stages(metadata.get(STAGES_META)).iteritems():
+        stages.setdefault(stage, StageSummary()).merge(summary)
+    if METRICS_META in metadata:
+        record = json.loads(metadata[METRICS_META])
+        stages.setdefault(record["stage"], StageSummary()).add(record)
+
+def _exact_percentile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+def stage_report(summary, durations=None):
+    '''
+    Report of one stage; percentiles are exact with the task durations,
+    else from the histogram
+    '''
+    d = summary.data
+    pct = summary.percentile if durations is None else lambda q: _exact_percentile(durations, q)
+    p50 = pct(0.5)
+    secs = d["totalSecs"] or 1e-9
+    return {
+        "tasks": d["n"],
+        "coldStarts": d["cold"],
+        "taskSecs": d["totalSecs"],
+        "p50Secs": p50,
+        "p90Secs": pct(0.9),
+        "p99Secs": pct(0.99),
+        "maxSecs": d["maxSecs"],
+        "skew": d["maxSecs"] / p50 if p50 else 0,
+        "bytesIn": d["bytesIn"],
+        "bytesOut": d["bytesOut"],
+        "recordsIn": d["recordsIn"],
+        "recordsOut": d["recordsOut"],
+        "mbPerTaskSec": d["bytesIn"] / 1048576.0 / secs,
+        "recordsPerTaskSec": d["recordsIn"] / secs,
+        "downloadShare": d["downloadSecs"] / secs,
+        "parseShare": d["parseSecs"] / secs,
+        "writeShare": d["writeSecs"] / secs,
+        "maxRssKb": d["maxRssKb"]
+    }
+
+def job_report(stages, lambda_memory, wall_secs, extra_s3_gets=0, extra_s3_puts=0,
+        stored_bytes=0, durations=None):
+    '''
+    Per-stage reports and the cost of the job. durations maps stages to
+    their exact task durations, where the driver has them. The reducer
+    coordinator is counted as one request per task output; its duration
+    is not known to the driver and not counted.
+    '''
+    durations = durations or {}
+    report = {"wallSecs": wall_secs, "stages": {}}
+    totals = StageSummary()
+    for stage, summary in stages.iteritems():
+        report["stages"][stage] = stage_report(summary, durations.get(stage))
+        totals.merge(summary)
+    t = totals.data
+    n_tasks = t["n"]
+    gets = t.get("getRequests", 0) + extra_s3_gets
+    puts = t.get("putRequests", 0) + extra_s3_puts
+    cost = {
+        "lambdaCompute": t.get("totalSecs", 0) * LAMBDA_GB_SEC * lambda_memory / 1024.0,
+        "lambdaRequests": 2 * n_tasks * LAMBDA_REQUEST,
+        "s3Requests": gets * S3_GET + puts * S3_PUT,
+        "s3Storage": stored_bytes / 1024.0 ** 3 * S3_GB_HOUR
+    }
+    cost["total"] = sum(cost.values())
+    report["cost"] = cost
+    report["s3Requests"] = {"get": gets, "put": puts}
+    return report
+
+def format_report(report):
+    lines = ["%-12s %6s %5s %9s %9s %9s %9s %6s %10s %10s %9s" % ("stage", "tasks", "cold",
+            "task s", "p50 s", "p90 s", "max s", "skew", "MB in", "records", "MB/task-s")]
+    for stage in sorted(report["stages"]):
+        s = report["stages"][stage]
+        lines.append("%-12s %6d %5d %9.2f %9.3f %9.3f %9.3f %6.2f %10.1f %10d %9.2f" % (stage,
+                s["tasks"], s["coldStarts"], s["taskSecs"], s["p50Secs"], s["p90Secs"],
+                s["maxSecs"], s["skew"], s["bytesIn"] / 1048576.0, s["recordsIn"],
+                s["mbPerTaskSec"]))
+    cost = report["cost"]
+    lines.append("Wall time %.1f s; cost $%.6f (Lambda compute %.6f, requests %.6f; "
+            "S3 requests %.6f, storage %.6f)" % (report["wallSecs"], cost["total"],
+            cost["lambdaCompute"], cost["lambdaRequests"], cost["s3Requests"], cost["s3Storage"]))
+    return lines
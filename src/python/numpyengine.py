@@ -0,0 +1,192 @@
+'''
+Vectorized mapper engine
+
+Parses blocks of CSV lines into column arrays with NumPy and sums a float
+column by a prefix of another one, for jobs that declare VECTORIZED (see
+jobspec.py), like the default sum of uservisits adRevenue (column 3) by the
+first 8 characters of sourceIP (column 0):
+
+  - a block is scanned for newlines and commas once, and only the two
+    needed fields are copied out, as fixed-width byte rows;
+  - plain decimals ("123.456") are parsed from their digits in bulk and
+    anything else with numpy's string to float conversion;
+  - each block is reduced to its distinct keys and sums with np.unique and
+    np.bincount, and the partial sums are merged the same way; a dict is
+    only built once, for the mapper output.
+
+NumPy is optional and imported on first use: available() is False when it
+cannot be imported (it is not part of the python2.7 Lambda runtime; add it
+to the function, e.g. with a layer), and the mapper then runs the job's
+map_line. Mappers that use the line loop never import it. The sums can differ
+from map_line in the last bits, as they are added in a different order.
+
+Copyright 2016 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+'''
+
+import itertools
+
+# numpy once imported, False if it cannot be
+np = None
+
+# Key bytes are compared as one uint64, so keys are at most 8 bytes
+KEY_WIDTH = 8
+
+# Widest value field gathered into rows. A block's rows are as wide as its
+# widest value, with an int64 index per byte, so a block with a longer one
+# (a malformed or binary line) goes to the line loop instead.
+MAX_VALUE_WIDTH = 256
+
+# Distinct keys held in partial sums before they are merged
+COMPACT_RECORDS = 1 << 20
+
+# Digits that fit in an int64 and in the 53-bit mantissa of a float64, so
+# that mantissa / 10**decimals is rounded exactly like float() rounds the
+# string
+MAX_DIGITS = 15
+
+def available():
+    global np
+    if np is None:
+        try:
+            import numpy
+            np = numpy
+        except ImportError:
+            np = False
+    return np is not False
+
+def _gather(buf, starts, ends, width):
+    '''
+    buf[starts[i]:ends[i]] as rows of a (n, width) uint8 array, cut at width
+    bytes and padded with NULs
+    '''
+    idx = starts[:, None] + np.arange(width)
+    inside = idx < ends[:, None]
+    return np.where(inside, buf[np.where(inside, idx, 0)], 0).astype(np.uint8)
+
+def _parse_floats(rows, lengths):
+    '''
+    float64 of each row of _gather(); raises ValueError like float() does
+    '''
+    n, width = rows.shape
+    digit = (rows >= ord('0')) & (rows <= ord('9'))
+    dot = rows == ord('.')
+    n_digits = digit.sum(axis=1)
+    used = np.arange(width) < lengths[:, None]
+    plain = ((digit | dot | ~used).all(axis=1) & (dot.sum(axis=1) <= 1) &
+            (n_digits > 0) & (n_digits <= MAX_DIGITS))
+
+    # Digits as one integer, a column at a time, and the number of them
+    # after the dot
+    mantissa = np.zeros(n, dtype=np.int64)
+    decimals = np.zeros(n, dtype=np.int64)
+    after_dot = np.zeros(n, dtype=bool)
+    values = rows.astype(np.int64) - ord('0')
+    for j in range(width):
+        mantissa = np.where(digit[:, j], mantissa * 10 + values[:, j], mantissa)
+        decimals += digit[:, j] & after_dot
+        after_dot |= dot[:, j]
+    values = mantissa / np.power(10.0, decimals)
+
+    if not plain.all():
+        other = np.flatnonzero(~plain)
+        values[other] = rows[other].view('S%d' % width).ravel().astype(np.float64)
+    return values
+
+class Aggregator(object):
+    '''
+    Group-by-sum of blocks of lines, as s3reader.iter_text_blocks yields
+    them: column valueColumn summed by the first keyWidth bytes of column
+    keyColumn, as in a job's VECTORIZED. fallback(lines, output) is the
+    job's line loop; it takes blocks with a line that does not parse, or a
+    value wider than MAX_VALUE_WIDTH, so bad lines are reported and skipped
+    the way the loop does it.
+    '''
+    def __init__(self, fallback, keyColumn=0, keyWidth=KEY_WIDTH, valueColumn=3):
+        if keyWidth > KEY_WIDTH or keyColumn == valueColumn:
+            raise ValueError("unsupported VECTORIZED job")
+        self.fallback = fallback
+        self.key_column = keyColumn
+        self.key_width = keyWidth
+        self.value_column = valueColumn
+        self.keys = []
+        self.sums = []
+        self.pending = 0
+        self.other = {}
+
+    def add(self, text):
+        '''
+        Aggregate a block of lines; returns the number of lines
+        '''
+        buf = np.frombuffer(text + '\n', dtype=np.uint8)
+        line_ends = np.flatnonzero(buf == ord('\n'))
+        line_starts = np.concatenate(([0], line_ends[:-1] + 1))
+
+        # Position in `commas` of the first comma of each line
+        commas = np.flatnonzero(buf == ord(','))
+        first = np.searchsorted(commas, line_starts)
+        n_commas = np.searchsorted(commas, line_ends) - first
+        if not (n_commas >= max(self.key_column, self.value_column)).all():
+            # Lines without the columns
+            return self.fallback(text.split('\n'), self.other)
+
+        key_start, key_end = self._column(self.key_column, commas, first, n_commas, line_starts, line_ends)
+        val_start, val_end = self._column(self.value_column, commas, first, n_commas, line_starts, line_ends)
+        key_end = np.minimum(key_end, key_start + self.key_width)
+
+        lengths = val_end - val_start
+        width = max(int(lengths.max()), 1)
+        if width > MAX_VALUE_WIDTH:
+            return self.fallback(text.split('\n'), self.other)
+        try:
+            vals = _parse_floats(_gather(buf, val_start, val_end, width), lengths)
+        except ValueError:
+            return self.fallback(text.split('\n'), self.other)
+        keys = _gather(buf, key_start, key_end, KEY_WIDTH).view(np.uint64).ravel()
+
+        uniq, inverse = np.unique(keys, return_inverse=True)
+        self.keys.append(uniq)
+        self.sums.append(np.bincount(inverse, weights=vals))
+        self.pending += len(uniq)
+        if self.pending > COMPACT_RECORDS:
+            self._compact()
+        return len(line_ends)
+
+    @staticmethod
+    def _column(column, commas, first, n_commas, line_starts, line_ends):
+        '''
+        Start and end offsets of a column in every line
+        '''
+        if column == 0:
+            start = line_starts
+        else:
+            start = commas[first + column - 1] + 1
+        last = np.minimum(first + column, len(commas) - 1)
+        return start, np.where(n_commas > column, commas[last], line_ends)
+
+    def _compact(self):
+        if len(self.keys) > 1:
+            uniq, inverse = np.unique(np.concatenate(self.keys), return_inverse=True)
+            self.keys = [uniq]
+            self.sums = [np.bincount(inverse, weights=np.concatenate(self.sums))]
+            self.pending = len(uniq)
+
+    def result(self, output):
+        '''
+        Add the sums into the output dict
+        '''
+        self._compact()
+        if self.keys:
+            keys = self.keys[0].view('S%d' % KEY_WIDTH).tolist()
+            if output:
+                for key, val in zip(keys, self.sums[0].tolist()):
+                    if key not in output:
+                        output[key] = 0
+                    output[key] += val
+            else:
+                output.update(itertools.izip(keys, self.sums[0].tolist()))
+        for key, val in self.other.iteritems():
+            if key not in output:
+                output[key] = 0
+            output[key] += val
+        return output
@@ -0,0 +1,155 @@
+'''
+Cache of mapper outputs for incremental runs
+
+A mapper output is the partial aggregate of its batch of splits, and only
+depends on the mapper code, the intermediate format, the shuffle partitions
+and the bytes of the splits. After a mapper is done, the driver copies its
+output into the job bucket under
+
+  cache/<namespace>/<batch>/task       (and <batch>/<p> per shuffle partition)
+
+where namespace is a hash of the code (handler, job spec and the modules
+packaged with them) and settings, and batch a hash of the (key, ETag,
+start, end) of its splits. cache/<namespace>/index lists the splits of
+every cached batch.
+
+The next run cuts the objects it finds in the cache, with the same ETags,
+into the splits they were cached with, as the default split size changes
+with the size of the input. It reuses every cached batch whose splits are
+all still in the input, and copies it into place as a mapper output
+instead of running a mapper; only the remaining (new or changed) splits
+are mapped. Batches with a changed or deleted split are dropped from the
+cache. Copies stay within S3, so the cost of a run follows the new data.
+
+Copyright 2016 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+'''
+
+import hashlib
+import json
+import lambdautils
+
+from multiprocessing.dummy import Pool as ThreadPool
+
+CACHE_PREFIX = "cache/"
+
+# Copies in flight
+COPY_CONCURRENCY = 32
+
+def namespace(code_files, out_format, n_partitions):
+    '''
+    Hash of what a mapper output depends on besides its splits: the code
+    of the mapper function (handler, job spec and the modules packaged
+    with them) and the settings
+    '''
+    return lambdautils.code_hash(code_files, out_format, n_partitions)[:16]
+
+def split_id(split):
+    return [split['Key'], split.get('ETag'), split['Start'], split['End']]
+
+def batch_hash(ids):
+    return hashlib.sha256(json.dumps(ids)).hexdigest()[:32]
+
+def task_outputs(job_id, mapper_id, n_partitions):
+    '''
+    Keys of a mapper's output, the task file that marks it done last
+    '''
+    shards = ["%s/shuffle/%s/%s" % (job_id, p, mapper_id) for p in range(n_partitions or 0)]
+    return shards + ["%s/task/mapper/%s" % (job_id, mapper_id)]
+
+class PartialCache(object):
+    def __init__(self, s3, bucket, namespace, n_partitions):
+        self.s3 = s3
+        self.bucket = bucket
+        self.namespace = namespace
+        self.prefix = "%s%s/" % (CACHE_PREFIX, namespace)
+        self.n_partitions = n_partitions
+        # batch hash -> split ids
+        self.index = lambdautils.get_json(s3, bucket, self.prefix + "index") or {}
+        self.entries = {}
+
+    def _entry_keys(self, h):
+        return ["%s%s/%s" % (self.prefix, h, p) for p in range(self.n_partitions or 0)] + \
+                ["%s%s/task" % (self.prefix, h)]
+
+    def split_sizes(self):
+        '''
+        {(key, ETag): split size} of the cached objects. The length of the
+        first split of an object cuts it into the same splits again.
+        '''
+        sizes = {}
+        for ids in self.index.itervalues():
+            for key, etag, start, end in ids:
+                if start == 0:
+                    sizes[(key, etag)] = end - start + 1
+        return sizes
+
+    def claim(self, splits):
+        '''
+        (cached batches whose splits are all in splits, the other splits)
+        '''
+        available = set(tuple(split_id(s)) for s in splits)
+        reused = []
+        for h, ids in sorted(self.index.iteritems()):
+            ids = [tuple(i) for i in ids]
+            if all(i in available for i in ids):
+                reused.append(h)
+                available.difference_update(ids)
+        self.keep(reused)
+        return reused, [s for s in splits if tuple(split_id(s)) in available]
+
+    def keep(self, hashes):
+        '''
+        Keep these cached batches in the index this run saves
+        '''
+        for h in hashes:
+            if h in self.index:
+                self.entries[h] = self.index[h]
+
+    def _copy_all(self, pairs):
+        if not pairs:
+            return
+        pool = ThreadPool(min(len(pairs), COPY_CONCURRENCY))
+        pool.map(lambda pair: self.s3.copy_object(Bucket=self.bucket, Key=pair[1],
+                CopySource={"Bucket": self.bucket, "Key": pair[0]}), pairs)
+        pool.close()
+
+    def restore(self, job_id, assignments):
+        '''
+        Copy cached batches into place as the outputs of mappers, from
+        [mapper id, batch hash] pairs; the task file of a mapper is copied
+        after its shuffle files.
+        '''
+        pairs = []
+        for mapper_id, h in assignments:
+            pairs += zip(self._entry_keys(h), task_outputs(job_id, mapper_id, self.n_partitions))
+        shards = [pair for pair in pairs if "/shuffle/" in pair[1]]
+        self._copy_all(shards)
+        self._copy_all([pair for pair in pairs if "/shuffle/" not in pair[1]])
+
+    def store(self, job_id, batches):
+        '''
+        Cache the outputs of mappers, from (mapper id, splits) pairs. Batches
+        with a split of unknown ETag are not cached.
+        '''
+        pairs = []
+        for mapper_id, batch in batches:
+            ids = [split_id(s) for s in batch]
+            if any(i[1] is None for i in ids):
+                continue
+            h = batch_hash(ids)
+            self.entries[h] = ids
+            pairs += zip(task_outputs(job_id, mapper_id, self.n_partitions), self._entry_keys(h))
+        self._copy_all(pairs)
+
+    def save(self):
+        '''
+        Write the index of the batches claimed or stored by this run, and
+        delete the cached batches it left out
+        '''
+        dropped = [h for h in self.index if h not in self.entries]
+        self.s3.put_object(Bucket=self.bucket, Key=self.prefix + "index",
+                Body=json.dumps(self.entries))
+        lambdautils.delete_keys(self.s3, self.bucket, sum([self._entry_keys(h) for h in dropped], []))
+        self.index = dict(self.entries)
+        return len(dropped)
@@ -0,0 +1,242 @@
+'''
+Benchmark suite of the pipeline stages
+
+Generates a synthetic uservisits dataset into a local object store (see
+localbackend.py) and times each stage of a job on it:
+
+  download     - s3_download_benchmark: sequential GETs, and the prefetch
+                 reader at each concurrency and part size of its sweep
+  parse        - mapper_benchmark: the line loop (and the NumPy engine if
+                 installed) on lines like the dataset's
+  mapper       - the mapper handler, one object per call, for each
+                 intermediate format: records/s and its time spent on
+                 download, parse and write
+  intermediate - intermediate_benchmark: encoding and decoding a mapper
+                 output of the dataset's size in each format
+  reducer      - the reducer handler on all mapper outputs: dict reducers
+                 on json and binary inputs, and the k-way merge
+  coordinator  - the reducer coordinator handler for N mappers: the event
+                 of the next to last mapper output, which finds the step
+                 not done, and that of the last, which plans the step and
+                 invokes its reducers
+
+The results, with the settings they ran with, are written as JSON to
+compare between releases.
+
+  $ python pipeline_benchmark.py [results.json] [n_objects] [object_mb]
+'''
+
+import backend
+import contextlib
+import intermediate
+import intermediate_benchmark
+import invoker
+import json
+import lambdautils
+import localbackend
+import mapper
+import mapper_benchmark
+import os
+import platform
+import reducer
+import reducerCoordinator
+import s3_download_benchmark
+import shutil
+import StringIO
+import sys
+import tempfile
+import time
+
+BUCKET = "bench-data"
+JOB_BUCKET = "bench-job"
+PREFIX = "uservisits/"
+
+N_OBJECTS = 8
+OBJECT_MB = 8
+# Bytes of a generated line, to size the objects
+LINE_BYTES = 90
+REPEAT = 3
+
+COORDINATOR_MAPPERS = [100, 1000]
+REDUCER_FUNCTION = "BL-reducer-bench"
+
+@contextlib.contextmanager
+def quiet():
+    '''
+    Swallow what the handlers print
+    '''
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        yield
+    finally:
+        sys.stdout = stdout
+
+def generate(s3, n_objects, object_bytes):
+    '''
+    Write n_objects uservisits-style objects of about object_bytes each,
+    each with its own lines; returns their keys
+    '''
+    keys = []
+    for i in range(n_objects):
+        key = "%spart-%05d" % (PREFIX, i)
+        data = mapper_benchmark.make_data(object_bytes // LINE_BYTES, seed=i)
+        s3.put_object(Bucket=BUCKET, Key=key, Body=data)
+        keys.append(key)
+    return keys
+
+def bench_download(keys):
+    with quiet():
+        seq_secs, seq_tput = s3_download_benchmark.timed("sequential",
+                s3_download_benchmark.sequential_download, BUCKET, keys)
+        sweep = s3_download_benchmark.sweep_download(BUCKET, keys)
+    return {"sequential": {"secs": seq_secs, "MBps": seq_tput}, "prefetch": sweep}
+
+def bench_mapper(keys, out_format):
+    records = []
+    start = time.time()
+    with quiet():
+        for i, key in enumerate(keys):
+            records.append(mapper.lambda_handler({
+                "bucket": BUCKET,
+                "keys": [key],
+                "jobBucket": JOB_BUCKET,
+                "jobId": "mapper-" + out_format,
+                "mapperId": i + 1,
+                "intermediateFormat": out_format
+            }, None))
+    secs = time.time() - start
+    total = lambda field: sum(r.get(field, 0) for r in records)
+    return {
+        "secs": secs,
+        "records": total("recordsIn"),
+        "recordsPerSec": total("recordsIn") / secs,
+        "MBps": total("bytesIn") / 1024.0 / 1024 / secs,
+        "parseRecordsPerSec": total("recordsIn") / max(total("parseSecs"), 1e-9),
+        "downloadSecs": total("downloadSecs"),
+        "parseSecs": total("parseSecs"),
+        "writeSecs": total("writeSecs"),
+        "bytesOut": total("bytesOut"),
+        "keysOut": total("recordsOut") // len(records)
+    }
+
+def bench_reducer(n_mappers, out_format, merge):
+    name = "%s-%s" % ("merge" if merge else "dict", out_format)
+    keys = ["mapper-%s/task/mapper/%s" % (out_format, i + 1) for i in range(n_mappers)]
+    event = lambdautils.reducer_event(JOB_BUCKET, "reducer-" + name, 1, [keys], 0, {}, None,
+            out_format, None, merge)
+    start = time.time()
+    with quiet():
+        record = reducer.lambda_handler(event, None)
+    secs = time.time() - start
+    return name, {
+        "secs": secs,
+        "records": record["recordsIn"],
+        "recordsPerSec": record["recordsIn"] / secs,
+        "keysOut": record["recordsOut"]
+    }
+
+def bench_coordinator(root, s3, n_mappers):
+    '''
+    The coordinator handler as a new container, for a job of n_mappers
+    '''
+    job_id = "coordinator-%s" % n_mappers
+    job_info = os.path.join(root, job_id + ".json")
+    with open(job_info, 'w') as f:
+        json.dump({"jobId": job_id, "jobBucket": JOB_BUCKET, "mapCount": n_mappers,
+            "reducerFunction": REDUCER_FUNCTION, "reducerHandler": "reducer.lambda_handler"}, f)
+    reducerCoordinator.JOB_INFO = job_info
+    reducerCoordinator._job_config = None
+    reducerCoordinator._lambda_client = None
+
+    data = intermediate.dumps({"1.2.3.4": 1.0}, intermediate.JSON)
+    def output(m_id):
+        key = "%s/task/mapper/%s" % (job_id, m_id)
+        s3.put_object(Bucket=JOB_BUCKET, Key=key, Body=data)
+        return {"Records": [{"s3": {"bucket": {"name": JOB_BUCKET}, "object": {"key": key}}}]}
+
+    for m_id in range(1, n_mappers - 1):
+        output(m_id)
+    stats = {"mappers": n_mappers}
+    for field, m_id in (("probeSecs", n_mappers - 1), ("startSecs", n_mappers)):
+        event = output(m_id)
+        start = time.time()
+        with quiet():
+            reducerCoordinator.lambda_handler(event, None)
+        stats[field] = time.time() - start
+    state = lambdautils.get_json(s3, JOB_BUCKET, reducerCoordinator.reducer_state_key(job_id, 1))
+    stats["reducers"] = int(state["reducerCount"]) if state else 0
+    return stats
+
+def run(n_objects=N_OBJECTS, object_mb=OBJECT_MB, repeat=REPEAT):
+    root = tempfile.mkdtemp(prefix="bl-bench-")
+    try:
+        backend.use_local(root)
+        s3 = backend.s3_client()
+        localbackend.LocalLambdaClient(root).create_function(FunctionName=REDUCER_FUNCTION,
+                Handler="reducer.lambda_handler")
+        keys = generate(s3, n_objects, object_mb * 1024 * 1024)
+        # The first coordinator would otherwise pay for loading botocore
+        invoker.pooled_client()
+
+        stages = {}
+        stages["download"] = bench_download(keys)
+        lines = object_mb * 1024 * 1024 // LINE_BYTES
+        stages["parse"] = mapper_benchmark.run(lines, repeat)
+        stages["mapper"] = dict((fmt, bench_mapper(keys, fmt))
+                for fmt in (intermediate.JSON, intermediate.BINARY))
+        stages["intermediate"] = intermediate_benchmark.run(stages["mapper"]["json"]["keysOut"],
+                repeat)
+        stages["reducer"] = dict(bench_reducer(n_objects, fmt, merge)
+                for fmt, merge in ((intermediate.JSON, False), (intermediate.BINARY, False),
+                    (intermediate.BINARY, True)))
+        stages["coordinator"] = [bench_coordinator(root, s3, n) for n in COORDINATOR_MAPPERS]
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return {
+        "settings": {"objects": n_objects, "objectMB": object_mb, "repeat": repeat,
+            "lineBytes": LINE_BYTES},
+        "python": platform.python_version(),
+        "time": time.time(),
+        "stages": stages
+    }
+
+if __name__ == '__main__':
+    out = sys.argv[1] if len(sys.argv) > 1 else "pipeline_benchmark.json"
+    n_objects = int(sys.argv[2]) if len(sys.argv) > 2 else N_OBJECTS
+    object_mb = int(sys.argv[3]) if len(sys.argv) > 3 else OBJECT_MB
+    results = run(n_objects, object_mb)
+    stages = results["stages"]
+
+    print "%-26s %10s %12s" % ("download", "secs", "MB/s")
+    print "%-26s %10.3f %12.1f" % ("sequential", stages["download"]["sequential"]["secs"],
+            stages["download"]["sequential"]["MBps"])
+    for r in stages["download"]["prefetch"]:
+        print "%-26s %10.3f %12.1f" % ("prefetch %s x %sMB" % (r["concurrency"], r["partSize"] >> 20),
+                r["secs"], r["MBps"])
+    print
+    print "%-26s %10s %12s" % ("parse", "secs", "records/s")
+    for name, s in sorted(stages["parse"].items()):
+        print "%-26s %10.3f %12d" % (name, s["secs"], s["recordsPerSec"])
+    print
+    print "%-26s %10s %12s %12s" % ("mapper", "secs", "records/s", "parse r/s")
+    for name, s in sorted(stages["mapper"].items()):
+        print "%-26s %10.3f %12d %12d" % (name, s["secs"], s["recordsPerSec"], s["parseRecordsPerSec"])
+    print
+    print "%-26s %10s %12s %12s" % ("intermediate", "bytes", "encode r/s", "decode r/s")
+    for name, s in sorted(stages["intermediate"].items()):
+        print "%-26s %10d %12d %12d" % (name, s["bytes"], s["encodeRecordsPerSec"],
+                s["decodeRecordsPerSec"])
+    print
+    print "%-26s %10s %12s" % ("reducer", "secs", "records/s")
+    for name, s in sorted(stages["reducer"].items()):
+        print "%-26s %10.3f %12d" % (name, s["secs"], s["recordsPerSec"])
+    print
+    print "%-26s %10s %12s %12s" % ("coordinator", "probe s", "start s", "reducers")
+    for s in stages["coordinator"]:
+        print "%-26s %10.3f %12.3f %12d" % ("%s mappers" % s["mappers"], s["probeSecs"],
+                s["startSecs"], s["reducers"])
+
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=4, sort_keys=True)
+    print "Results written to", out
@@ -5,29 +5,111 @@ Copyright 2016 Amazon.com, Inc. or its affiliates. All Rights Reserved.
 SPDX-License-Identifier: MIT-0
 '''
 
-import boto3
+import backend
+import heapq
+import intermediate
+import jobspec
 import json
-import random
-import resource
-import StringIO
-import urllib2
+import lambdautils
+import metrics
+import s3reader
 import time
 
-# create an S3 & Dynamo session
-s3 = boto3.resource('s3')
-s3_client = boto3.client('s3')
+from multiprocessing.dummy import Pool as ThreadPool
 
 # constants
 TASK_MAPPER_PREFIX = "task/mapper/";
 TASK_REDUCER_PREFIX = "task/reducer/";
 
+# Inputs of a merging reducer fetched at once
+MERGE_READERS = 16
+
+# Before the first key of a merge
+_START = object()
+
 def write_to_s3(bucket, key, data, metadata):
     # Write to S3 Bucket
-    s3.Bucket(bucket).put_object(Key=key, Body=data, Metadata=metadata)
+    backend.s3_client().put_object(Bucket=bucket, Key=key, Body=data, Metadata=metadata)
+
+def merge_reduce(s3_client, job, job_bucket, keys, fname, out_format, final, step_id, task):
+    '''
+    Streaming k-way merge of binary inputs, each sorted by key. The values
+    of a key are reduced as the merge reaches them and written out right
+    away, so memory grows with the number of inputs, not with the number
+    of distinct keys.
+    '''
+    pool = ThreadPool(min(len(keys), MERGE_READERS))
+    sources = [s3reader.RangeReader(s3_client, job_bucket, key, pool) for key in keys]
+    for source in sources:
+        source.start()
+
+    def metadata():
+        # The merge has read the first pair, and so the metadata, of every
+        # input by now. A multipart upload takes this record at its first
+        # part, before the reducer is done.
+        stages = {}
+        if step_id > 1:
+            for source in sources:
+                metrics.fold(stages, source.metadata or {})
+        record = task.finish()
+        return metrics.with_stages({
+                    "linecount": '%s' % record["recordsIn"],
+                    metrics.METRICS_META: metrics.dumps(record)
+               }, stages)
+
+    writer = lambdautils.S3StreamWriter(s3_client, job_bucket, fname, metadata)
+    def write(data):
+        with task.timer("writeSecs"):
+            writer.write(data)
+
+    try:
+        merge_start = time.time()
+        waited = task.record["downloadSecs"] + task.record["writeSecs"]
+        out = intermediate.StreamWriter(write, out_format)
+        finalize = job.finalize if final else None
+        current, acc = _START, None
+        line_count = 0
+        for key, value in heapq.merge(*[intermediate.iter_stream_pairs(task.body(source))
+                for source in sources]):
+            line_count += 1
+            if key == current:
+                acc = job.reduce(acc, value)
+                continue
+            if current is not _START:
+                out.add(current, finalize(current, acc) if finalize else acc)
+            current, acc = key, value
+        if current is not _START:
+            out.add(current, finalize(current, acc) if finalize else acc)
+        out.close()
+        task.add("parseSecs", time.time() - merge_start -
+                (task.record["downloadSecs"] + task.record["writeSecs"] - waited))
+        task.add("getRequests", sum(source.requests for source in sources))
+        task.add("recordsIn", line_count)
+        task.add("recordsOut", out.count)
+        task.add("bytesOut", writer.bytes)
+        print "Reducer merged", [len(keys), line_count, out.count]
+
+        # First copy to write wins
+        if lambdautils.object_metadata(s3_client, job_bucket, fname) is not None:
+            print "Reducer output %s already written by another copy" % fname
+            writer.abort()
+            return task.finish()
+        # Counts the PUT of a small output in its own metadata
+        task.add("putRequests", 1)
+        with task.timer("writeSecs"):
+            writer.close()
+    except Exception:
+        writer.abort()
+        raise
+    finally:
+        pool.close()
+    task.add("putRequests", writer.requests - 1)
+    return task.finish()
 
 def lambda_handler(event, context):
     
     start_time = time.time()
+    s3_client = backend.s3_client()
     
     job_bucket = event['jobBucket']
     bucket = event['bucket']
@@ -36,48 +118,99 @@ def lambda_handler(event, context):
     r_id = event['reducerId']
     step_id = event['stepId']
     n_reducers = event['nReducers']
+    partition = event.get('partition')
+    out_format = event.get('intermediateFormat', intermediate.JSON)
+    job = jobspec.load(event.get('jobSpec'))
+    task = metrics.TaskMetrics("reducer-%s-%s" % (step_id, r_id), "reducer-%s" % step_id)
     
+    final = partition is not None or n_reducers == 1
+    if partition is not None:
+        # Hash-partitioned shuffle, one result shard per partition
+        fname = "%s/result/%s" % (job_id, partition)
+        out_format = intermediate.JSON
+    elif n_reducers == 1:
+        # Last reducer file, final result
+        fname = "%s/result" % job_id
+        out_format = intermediate.JSON
+    else:
+        fname = "%s/%s%s/%s" % (job_id, TASK_REDUCER_PREFIX, step_id, r_id)
+
+    # A backup copy of this reducer may already have finished
+    done = lambdautils.object_metadata(s3_client, job_bucket, fname)
+    if done is not None:
+        print "Reducer %s of step %s already done" % (r_id, step_id)
+        return json.loads(done[metrics.METRICS_META])
+
+    if event.get('merge'):
+        return merge_reduce(s3_client, job, job_bucket, reducer_keys, fname, out_format, final,
+                step_id, task)
+
     # aggr 
     results = {}
     line_count = 0
+    # Summaries of the reducer steps before this one, from the metadata of
+    # their outputs
+    stages = {}
 
-    # INPUT JSON => OUTPUT JSON
+    # INPUT JSON or binary => merge accumulators with the job's reduce =>
+    # OUTPUT JSON or binary; the result is JSON, after finalize
 
-    # Download and process all keys
-    for key in reducer_keys:
-        response = s3_client.get_object(Bucket=job_bucket, Key=key)
-        contents = response['Body'].read()
+    # Download and process all keys; the next keys are prefetched
+    # while the current one is parsed
+    reader = s3reader.prefetch_reader(s3_client, job_bucket, reducer_keys, event.get('prefetch'))
+    try:
+        for key, body in reader:
+            contents = task.body(body).read()
+            if step_id > 1:
+                metrics.fold(stages, body.metadata or {})
 
-        try:
-            for srcIp, val in json.loads(contents).iteritems():
-                line_count +=1
-                if srcIp not in results:
-                    results[srcIp] = 0
-                results[srcIp] += float(val)
-        except Exception, e:
-            print e
+            with task.timer("parseSecs"):
+                try:
+                    for k, acc in intermediate.loads_pairs(contents, job.decode_key, job.decode_acc):
+                        line_count +=1
+                        if k in results:
+                            results[k] = job.reduce(results[k], acc)
+                        else:
+                            results[k] = acc
+                except Exception, e:
+                    print e
+    finally:
+        reader.close()
+    task.add("getRequests", reader.requests)
+    task.add("recordsIn", line_count)
+    task.add("recordsOut", len(results))
 
     time_in_secs = (time.time() - start_time)
-    #timeTaken = time_in_secs * 1000000000 # in 10^9 
-    #s3DownloadTime = 0
-    #totalProcessingTime = 0 
-    pret = [len(reducer_keys), line_count, time_in_secs]
-    print "Reducer ouputput", pret
+    print "Reducer ouputput", [len(reducer_keys), line_count, time_in_secs]
 
-    if n_reducers == 1:
-        # Last reducer file, final result
-        fname = "%s/result" % job_id
+    # First copy to write wins; a copy racing past this check writes the
+    # same bytes
+    if lambdautils.object_metadata(s3_client, job_bucket, fname) is not None:
+        print "Reducer %s of step %s output already written by another copy" % (r_id, step_id)
+        return task.finish()
+
+    write_start = time.time()
+    if final:
+        results = job.finalize_all(results)
     else:
-        fname = "%s/%s%s/%s" % (job_id, TASK_REDUCER_PREFIX, step_id, r_id)
-    
-    metadata = {
+        results = job.encode_all(results)
+    data = intermediate.dumps(results, out_format)
+    task.add("bytesOut", len(data))
+    task.add("putRequests", 1)
+
+    # The record in the metadata leaves out the time of this PUT
+    task.add("writeSecs", time.time() - write_start)
+    record = task.finish()
+    metadata = metrics.with_stages({
                     "linecount":  '%s' % line_count,
                     "processingtime": '%s' % time_in_secs,
-                    "memoryUsage": '%s' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
-               }
-
-    write_to_s3(job_bucket, fname, json.dumps(results), metadata)
-    return pret
+                    "memoryUsage": '%s' % record["peakRssKb"],
+                    metrics.METRICS_META: metrics.dumps(record)
+               }, stages)
+    write_start = time.time()
+    write_to_s3(job_bucket, fname, data, metadata)
+    task.add("writeSecs", time.time() - write_start)
+    return task.finish()
 
 '''
 ev = {
@@ -5,104 +5,179 @@ Copyright 2016 Amazon.com, Inc. or its affiliates. All Rights Reserved.
 SPDX-License-Identifier: MIT-0
 '''
 
-import boto3
+import backend
+import invoker
 import json
 import lambdautils
-import random
-import re
-import StringIO
 import time
 import urllib
 
+from multiprocessing.dummy import Pool as ThreadPool
+
 DEFAULT_REGION = "us-east-1";
 
 ### STATES
 MAPPERS_DONE = 0;
 REDUCER_STEP = 1;
 
+TASK_MAPPER_PREFIX = "task/mapper/";
+TASK_REDUCER_PREFIX = "task/reducer/";
+SHUFFLE_PREFIX = "shuffle/";
+PROGRESS_PREFIX = "progress/";
+
+# Task outputs looked up at once while advancing a step's progress
+PROBE_BATCH = 32
+
 ### Helpers ###
 
-# create an S3 session
-s3 = boto3.resource('s3')
-s3_client = boto3.client('s3')
-lambda_client = boto3.client('lambda')
+JOB_INFO = "jobinfo.json"
+
+# jobinfo.json of this container, read by its first invocation
+_job_config = None
+
+# Lambda client of this container, with a connection per concurrent
+# invocation; made by the first invocation that starts a step
+_lambda_client = None
 
 # Write to S3 Bucket
 def write_to_s3(bucket, key, data, metadata):
-    s3.Bucket(bucket).put_object(Key=key, Body=data, Metadata=metadata)
+    backend.s3_client().put_object(Bucket=bucket, Key=key, Body=data, Metadata=metadata)
 
-def write_reducer_state(n_reducers, n_s3, bucket, fname):
+def job_config():
+    global _job_config
+    if _job_config is None:
+        with open(JOB_INFO) as f:
+            _job_config = json.load(f)
+    return _job_config
+
+def lambda_client():
+    global _lambda_client
+    if _lambda_client is None:
+        _lambda_client = invoker.pooled_client(
+                job_config().get("invokeConcurrency", invoker.CONCURRENCY))
+    return _lambda_client
+
+def write_reducer_state(n_reducers, n_s3, bucket, fname, batches, plan=None):
+    '''
+    Create the state of a reducer step, which claims the step: False if
+    another event created it first
+    '''
     ts = time.time()
+    # The batches let the driver launch a backup copy of a slow reducer;
+    # the plan records how the fan-in of the step was chosen
     data = json.dumps({
                 "reducerCount": '%s' % n_reducers, 
                 "totalS3Files": '%s' % n_s3,
-                "start_time": '%s' % ts 
+                "start_time": '%s' % ts,
+                "batches": batches,
+                "plan": plan
                })
-    write_to_s3(bucket, fname, data, {})
-
-# Count mapper files
-def get_mapper_files(files):
-    ret = []
-    for mf in files:
-        if "task/mapper" in mf["Key"]:
-            ret.append(mf)
-    return ret
-
-def get_reducer_batch_size(keys):
-    #TODO: Paramertize memory size
-    batch_size = lambdautils.compute_batch_size(keys, 1536, 1000)
-    return max(batch_size, 2) # At least 2 in a batch - Condition for termination
-
-def check_job_done(files):
-    # TODO: USE re
-    for f in files:
-        if "result" in f["Key"]:
-            return True
-    return False
-
-def get_reducer_state_info(files, job_id, job_bucket):
-        
-    reducers = [];
-    max_index = 0;
-    reducer_step = False;
-    r_index = 0;
-   
-    # Check if step is complete
-        
-    # Check for the Reducer state
-    # Determine the latest reducer step#
-    for f in files:
-        #parts = f['Key'].split('/');
-        if "reducerstate." in f['Key']:
-            idx = int(f['Key'].split('.')[1])
-            if idx > r_index:
-                r_index = idx
-            reducer_step = True
-
-    # Find with reducer state is complete 
-    if reducer_step == False:
-        # return mapper files
-        return [MAPPERS_DONE, get_mapper_files(files)]
-    else:
-        # Check if the current step is done
-        key = "%s/reducerstate.%s" % (job_id, r_index) 
-        response = s3_client.get_object(Bucket=job_bucket, Key=key)
-        contents = json.loads(response['Body'].read())
-        
-        # get reducer outputs
-        for f in files:
-            fname = f['Key']
-            parts = fname.split('/')
-            if len(parts) < 3:
-                continue
-            rFname = 'reducer/' + str(r_index)
-            if rFname in fname:
-                reducers.append(f)
-        
-        if int(contents["reducerCount"]) == len(reducers):
-            return (r_index, reducers)
+    return lambdautils.put_if_absent(backend.s3_client(), bucket, fname, data)
+
+def reducer_state_key(job_id, step):
+    return "%s/reducerstate.%s" % (job_id, step)
+
+def task_prefix(job_id, step):
+    '''
+    Prefix of the outputs of a step; step MAPPERS_DONE is the mappers
+    '''
+    if step == MAPPERS_DONE:
+        return "%s/%s" % (job_id, TASK_MAPPER_PREFIX)
+    return "%s/%s%s/" % (job_id, TASK_REDUCER_PREFIX, step)
+
+def parse_task_key(job_id, key):
+    '''
+    Step a task output key belongs to, None if it is not a task output
+    '''
+    if key.startswith(task_prefix(job_id, MAPPERS_DONE)):
+        return MAPPERS_DONE
+    parts = key[len(job_id) + 1:].split('/')
+    if key.startswith(job_id + "/" + TASK_REDUCER_PREFIX) and len(parts) == 4 and parts[2].isdigit():
+        return int(parts[2])
+    return None
+
+def latest_step(bucket, job_id):
+    '''
+    Fallback for events without a task key: the last step started so far
+    '''
+    steps = [int(f["Key"].rsplit('.', 1)[1])
+            for f in lambdautils.list_keys(backend.s3_client(), bucket, job_id + "/reducerstate.")]
+    return max(steps) if steps else MAPPERS_DONE
+
+def step_task_ids(bucket, job_id, step, map_count):
+    if step == MAPPERS_DONE:
+        return range(1, map_count + 1)
+    state = lambdautils.get_json(backend.s3_client(), bucket, reducer_state_key(job_id, step))
+    return range(int(state["reducerCount"]))
+
+def advance_progress(bucket, job_id, step, task_ids):
+    '''
+    True once every task of the step has written its output.
+
+    progress/<step> holds a watermark: the tasks before it are known to be
+    done. Each event looks up the task at the watermark, and only when that
+    one is done does it look further, PROBE_BATCH tasks at a time. Most
+    events cost a GET and a HEAD, and the whole step costs O(tasks)
+    lookups instead of a listing of the job per event. Concurrent events
+    may write back a lower watermark than another one found; it is still a
+    lower bound, so that only costs a few extra lookups.
+    '''
+    prefix = task_prefix(job_id, step)
+    done_task = lambda t: lambdautils.object_metadata(backend.s3_client(), bucket, prefix + str(t)) is not None
+    p_key = "%s/%s%s" % (job_id, PROGRESS_PREFIX, step)
+    start = done = (lambdautils.get_json(backend.s3_client(), bucket, p_key) or {"done": 0})["done"]
+
+    pool = None
+    while done < len(task_ids):
+        if done == start:
+            found = [done_task(task_ids[done])]
         else:
-            return (r_index, [])
+            if pool is None:
+                pool = ThreadPool(PROBE_BATCH)
+            found = pool.map(done_task, task_ids[done:done + PROBE_BATCH])
+        n = found.index(False) if False in found else len(found)
+        done += n
+        if n < len(found):
+            break
+    if pool is not None:
+        pool.close()
+
+    if done > start:
+        write_to_s3(bucket, p_key, json.dumps({"done": done}), {})
+    print "Step %s: %s of %s tasks done" % (step, done, len(task_ids))
+    return done == len(task_ids)
+
+def plan_reducer_step(bucket, job_id, step, keys, merge=False):
+    '''
+    Fan-in plan for the reducers over the outputs of step. After the first
+    reducer step, the output of the previous one tells how much a round
+    shrinks the data.
+    '''
+    config = job_config()
+    shrink = None
+    if step != MAPPERS_DONE:
+        state = lambdautils.get_json(backend.s3_client(), bucket, reducer_state_key(job_id, step))
+        if state.get("plan"):
+            shrink = sum(key['Size'] for key in keys) / float(max(state["plan"]["inputBytes"], 1))
+    plan = lambdautils.plan_fan_in(keys, config.get("lambdaMemory", 1536),
+            config.get("concurrentLambdas", 1000), merge, config.get("reducerPlanner"), shrink)
+    # At least 2 in a batch - Condition for termination
+    plan["fanIn"] = max(plan["fanIn"], 2)
+    return plan
+
+def invoke_reducers(r_function_name, bucket, job_id, step_id, batches, prefetch, partitioned,
+        out_format, job_spec, merge):
+    # Event invocations from a pool of connections rather than one by one,
+    # so a step of thousands of reducers starts in seconds
+    concurrency = job_config().get("invokeConcurrency", invoker.CONCURRENCY)
+    engine = invoker.Invoker(lambda_client(), concurrency)
+    payloads = [lambdautils.reducer_event(bucket, job_id, step_id, batches, i, prefetch,
+            partitioned, out_format, job_spec, merge) for i in range(len(batches))]
+    start = time.time()
+    engine.invoke_events(r_function_name, payloads)
+    engine.close()
+    print "Invoked %s reducers in %.2f secs (%s retries)" % (len(payloads),
+            time.time() - start, engine.retries)
 
 def lambda_handler(event, context):
     print("Received event: " + json.dumps(event, indent=2))
@@ -112,85 +187,78 @@ def lambda_handler(event, context):
     # Job Bucket. We just got a notification from this bucket
     bucket = event['Records'][0]['s3']['bucket']['name']
 
-    #key = urllib.unquote_plus(event['Records'][0]['s3']['object']['key'].encode('utf8'))
-   
-    config = json.loads(open('./jobinfo.json', "r").read())
-    
+    key = urllib.unquote_plus(event['Records'][0]['s3'].get('object', {}).get('key', '').encode('utf8'))
+
+    config = job_config()
+
     job_id =  config["jobId"]
     map_count = config["mapCount"] 
     r_function_name = config["reducerFunction"] 
     r_handler = config["reducerHandler"] 
+    prefetch = config.get("prefetch", {})
+    n_partitions = config.get("nPartitions")
+    out_format = config.get("intermediateFormat", "json")
+    job_spec = config.get("jobSpec")
+    merge = config.get("reducerMode") == "merge"
 
-    ### Get Mapper Finished Count ###
-    
-    # Get job files
-    files = s3_client.list_objects(Bucket=bucket, Prefix=job_id)["Contents"]
+    ### Stateless Coordinator logic
 
-    if check_job_done(files) == True:
-        print "Job done!!! Check the result file"
-        # TODO:  Delete reducer and coordinator lambdas
+    # The step that just made progress, from the key of the new object
+    step_number = parse_task_key(job_id, key)
+    if step_number is None:
+        step_number = latest_step(bucket, job_id)
+    step_id = step_number +1;
+
+    if lambdautils.object_metadata(backend.s3_client(), bucket, reducer_state_key(job_id, step_id)) is not None:
+        # Late or duplicate output of a finished step
+        print "Reducer step %s already started" % step_id
+        return
+
+    if not advance_progress(bucket, job_id, step_number, step_task_ids(bucket, job_id, step_number, map_count)):
+        print "Still waiting to finish step ", step_number
         return
+
+    plan = None
+    if n_partitions:
+        # Hash-partitioned shuffle: reducer i merges partition i of
+        # every mapper and writes result shard i in a single round
+        print "Starting the partition reducers", n_partitions
+        batches = [["%s/%s%s/%s" % (job_id, SHUFFLE_PREFIX, p, m) for m in range(1, map_count + 1)]
+                for p in range(n_partitions)]
     else:
-        ### Stateless Coordinator logic
-        mapper_keys = get_mapper_files(files)
-        print "Mappers Done so far ", len(mapper_keys)
-
-        if map_count == len(mapper_keys):
-            
-            # All the mappers have finished, time to schedule the reducers
-            stepInfo = get_reducer_state_info(files, job_id, bucket)
-
-            print "stepInfo", stepInfo
-
-            step_number = stepInfo[0];
-            reducer_keys = stepInfo[1];
-               
-            if len(reducer_keys) == 0:
-                print "Still waiting to finish Reducer step ", step_number
-                return
-                 
-            # Compute this based on metadata of files
-            r_batch_size = get_reducer_batch_size(reducer_keys); 
-                
-            print "Starting the the reducer step", step_number
-            print "Batch Size", r_batch_size
-                
-            # Create Batch params for the Lambda function
-            r_batch_params = lambdautils.batch_creator(reducer_keys, r_batch_size);
-                
-            # Build the lambda parameters
-            n_reducers = len(r_batch_params)
-            n_s3 = n_reducers * len(r_batch_params[0])
-            step_id = step_number +1;
-
-            for i in range(len(r_batch_params)):
-                batch = [b['Key'] for b in r_batch_params[i]]
-
-                # invoke the reducers asynchronously
-                resp = lambda_client.invoke( 
-                        FunctionName = r_function_name,
-                        InvocationType = 'Event',
-                        Payload =  json.dumps({
-                            "bucket": bucket,
-                            "keys": batch,
-                            "jobBucket": bucket,
-                            "jobId": job_id,
-                            "nReducers": n_reducers, 
-                            "stepId": step_id, 
-                            "reducerId": i 
-                        })
-                    )
-                print resp
-
-            # Now write the reducer state
-            fname = "%s/reducerstate.%s"  % (job_id, step_id)
-            write_reducer_state(n_reducers, n_s3, bucket, fname)
-        else:
-            print "Still waiting for all the mappers to finish .."
+        # One paginated listing of the finished step, for the key sizes
+        reducer_keys = lambdautils.list_keys(backend.s3_client(), bucket, task_prefix(job_id, step_number))
+
+        # Fan-in from the sizes of the files and the reducer memory
+        plan = plan_reducer_step(bucket, job_id, step_number, reducer_keys, merge)
+        r_batch_size = plan["fanIn"]
+
+        print "Starting the the reducer step", step_number
+        print "Batch Size", r_batch_size, "plan", json.dumps(plan)
+
+        # Create Batch params for the Lambda function
+        r_batch_params = lambdautils.batch_creator(reducer_keys, r_batch_size);
+        batches = [[b['Key'] for b in batch] for batch in r_batch_params]
+
+    # Build the lambda parameters
+    n_reducers = len(batches)
+    n_s3 = n_reducers * len(batches[0])
+
+    # Write the reducer state first: the outputs of the new step are
+    # only counted once it exists. Events of the last outputs of a step
+    # can all find it done; only the one that creates the state starts it.
+    fname = reducer_state_key(job_id, step_id)
+    if not write_reducer_state(n_reducers, n_s3, bucket, fname, batches, plan):
+        print "Reducer step %s started by another event" % step_id
+        return
+
+    invoke_reducers(r_function_name, bucket, job_id, step_id, batches, prefetch, n_partitions,
+            out_format, job_spec, merge)
 
 '''
 ev = {
-    "Records": [{'s3': {'bucket': {'name': "smallya-useast-1"}}}],
+    "Records": [{'s3': {'bucket': {'name': "smallya-useast-1"},
+                        'object': {'key': "jobid134/task/mapper/1"}}}],
     "bucket": "smallya-useast-1",
     "jobId": "jobid134",
     "mapCount": 1,
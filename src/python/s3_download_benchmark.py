@@ -1,38 +1,101 @@
 '''
 Benchmark downloading files from S3
+
+"mode" selects how the keys are fetched:
+  sequential - one get_object(...).read() after the other (default)
+  prefetch   - s3reader.PrefetchReader with the "prefetch" options
+  compare    - both, and the throughput gain of prefetch over sequential
+  sweep      - prefetch at every "concurrency" and "partSize" of the lists
+               given (default CONCURRENCIES and PART_SIZES)
+
+The clients come from backend.py, so BL_BACKEND=local runs it against the
+local object store; pipeline_benchmark.py runs the sweep that way.
 '''
 
-import boto3
+import backend
 import json
+import s3reader
 import time
 
-# create an S3 session
-s3 = boto3.resource('s3')
-s3_client = boto3.client('s3')
+# Prefetch settings of the sweep
+CONCURRENCIES = [1, 4, 16]
+PART_SIZES = [1024 * 1024, 8 * 1024 * 1024]
 
-def lambda_handler(event, context):
-    
-    start_time = time.time()
-    src_bucket = event['bucket']
-    src_keys = event['keys']
-    
+def sequential_download(src_bucket, src_keys):
+    s3_client = backend.s3_client()
     total_bytes = 0.0
-
-    # Download and process all keys
     for key in src_keys:
         response = s3_client.get_object(Bucket=src_bucket,Key=key)
         total_bytes += response['ContentLength']
         contents = response['Body'].read()
+    return total_bytes
+
+def prefetch_download(src_bucket, src_keys, options):
+    total_bytes = 0.0
+    reader = s3reader.prefetch_reader(backend.s3_client(), src_bucket, src_keys, options)
+    for key, body in reader:
+        while True:
+            data = body.read(s3reader.CHUNK_SIZE)
+            if not data:
+                break
+            total_bytes += len(data)
+    return total_bytes
 
+def timed(mode, fn, *args):
+    start_time = time.time()
+    total_bytes = fn(*args)
     time_in_secs = (time.time() - start_time)
-    print "Time taken (s)",  time_in_secs
-    print "Size (MB)", total_bytes / 1024/1024
-    return time_in_secs 
+    mb = total_bytes / 1024/1024
+    print "[%s] Time taken (s)" % mode, time_in_secs
+    print "[%s] Size (MB)" % mode, mb
+    print "[%s] Throughput (MB/s)" % mode, mb / time_in_secs
+    return time_in_secs, mb / time_in_secs
+
+def sweep_download(src_bucket, src_keys, concurrencies=None, part_sizes=None):
+    '''
+    Prefetch throughput at each concurrency and part size
+    '''
+    results = []
+    for concurrency in concurrencies or CONCURRENCIES:
+        for part_size in part_sizes or PART_SIZES:
+            options = {"concurrency": concurrency, "partSize": part_size}
+            secs, tput = timed("prefetch %s x %s" % (concurrency, part_size), prefetch_download,
+                    src_bucket, src_keys, options)
+            results.append({"concurrency": concurrency, "partSize": part_size,
+                "secs": secs, "MBps": tput})
+    return results
+
+def lambda_handler(event, context):
+
+    src_bucket = event['bucket']
+    src_keys = event['keys']
+    mode = event.get('mode', 'sequential')
+    options = event.get('prefetch')
+
+    if mode == 'sequential':
+        return timed(mode, sequential_download, src_bucket, src_keys)[0]
+    if mode == 'prefetch':
+        return timed(mode, prefetch_download, src_bucket, src_keys, options)[0]
+    if mode == 'sweep':
+        options = options or {}
+        return sweep_download(src_bucket, src_keys, options.get("concurrency"),
+                options.get("partSize"))
+
+    seq_secs, seq_tput = timed('sequential', sequential_download, src_bucket, src_keys)
+    pf_secs, pf_tput = timed('prefetch', prefetch_download, src_bucket, src_keys, options)
+    print "Prefetch speedup", pf_tput / seq_tput
+    return {
+        "sequential": {"secs": seq_secs, "MBps": seq_tput},
+        "prefetch": {"secs": pf_secs, "MBps": pf_tput, "options": options},
+        "speedup": pf_tput / seq_tput
+    }
 
 '''
 ev = {
-   "bucket": "smallya-useast-1", 
+   "bucket": "smallya-useast-1",
    "keys": ["pavlo.sample"],
+   "mode": "compare",
+   "prefetch": {"concurrency": 8}
    }
 lambda_handler(ev, {});
 '''
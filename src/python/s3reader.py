@@ -0,0 +1,518 @@
+'''
+Streaming readers for S3 objects
+
+Copyright 2016 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+'''
+
+import bz2
+import Queue
+import threading
+import zlib
+
+from multiprocessing.dummy import Pool as ThreadPool
+
+# Bytes read from a response body at a time
+CHUNK_SIZE = 1024 * 1024
+
+def iter_text_blocks(body, chunk_size=CHUNK_SIZE):
+    '''
+    Yield the lines of a streaming body in blocks, one per chunk of
+    chunk_size bytes, each block the text of its lines without the last
+    newline. A line cut by a chunk boundary is carried over to the next
+    chunk, so only one chunk (plus a partial line) is held in memory.
+    '''
+    tail = ''
+    while True:
+        chunk = body.read(chunk_size)
+        if not chunk:
+            break
+        text = tail + chunk
+        cut = text.rfind('\n')
+        if cut < 0:
+            tail = text
+            continue
+        tail = text[cut + 1:]
+        yield text[:cut]
+    # Last line without a trailing newline
+    if tail:
+        yield tail
+
+def iter_line_blocks(body, chunk_size=CHUNK_SIZE):
+    for text in iter_text_blocks(body, chunk_size):
+        yield text.split('\n')
+
+def iter_lines(body, chunk_size=CHUNK_SIZE):
+    for lines in iter_line_blocks(body, chunk_size):
+        for line in lines:
+            yield line
+
+# Prefetch defaults: parallel GETs, bytes per ranged GET, and the cap on
+# downloaded bytes waiting to be parsed
+CONCURRENCY = 4
+PART_SIZE = 8 * 1024 * 1024
+MAX_BUFFER = 256 * 1024 * 1024
+
+_DONE = object()
+
+class PrefetchReader(object):
+    '''
+    Downloads objects or byte ranges on a bounded thread pool while the
+    caller parses earlier ones.
+
+    items are key names or (key, start, end) tuples, end inclusive. A range
+    with a known end is fetched as several PART_SIZE GETs in parallel; a
+    whole object (or end=None) is fetched as one streaming GET. Iterating
+    the reader yields (item, body) in input order, where body supports
+    read(amt) like a botocore StreamingBody.
+
+    At most max_buffer downloaded bytes are held at a time. The part the
+    caller is waiting on is always allowed to make progress, so a full
+    buffer can never stall the reader.
+
+    requests counts the GETs issued, and body.metadata holds the user
+    metadata of the object once reading its body has started.
+    '''
+    def __init__(self, s3, bucket, items, concurrency=CONCURRENCY,
+            part_size=PART_SIZE, max_buffer=MAX_BUFFER):
+        self.s3 = s3
+        self.bucket = bucket
+        self.items = list(items)
+        self.concurrency = concurrency
+        self.part_size = part_size
+        self.max_buffer = max_buffer
+
+        self._cond = threading.Condition()
+        self._buffered = 0
+        self._head = 0 # part the caller is reading
+        self._closed = False
+        self.requests = 0
+
+    def _parts(self, item):
+        if isinstance(item, basestring):
+            return [(item, None)]
+        key, start, end = item
+        if end is None:
+            return [(key, "bytes=%s-" % start)]
+        starts = range(start, end + 1, self.part_size)
+        # Parts within the overread of a split may start past the end of the
+        # object, which S3 rejects; fold them into the part before
+        while len(starts) > 1 and starts[-1] > end - SPLIT_OVERREAD:
+            starts.pop()
+        ends = [s - 1 for s in starts[1:]] + [end]
+        return [(key, "bytes=%s-%s" % r) for r in zip(starts, ends)]
+
+    def _reserve(self, idx, n):
+        with self._cond:
+            while (not self._closed and idx != self._head
+                    and self._buffered + n > self.max_buffer):
+                self._cond.wait()
+            self._buffered += n
+            return not self._closed
+
+    def _release(self, n):
+        with self._cond:
+            self._buffered -= n
+            self._cond.notify_all()
+
+    def _fetch(self, idx, key, byte_range, out):
+        if self._closed:
+            out.put(IOError("reader closed"))
+            return
+        try:
+            kwargs = {"Bucket": self.bucket, "Key": key}
+            if byte_range:
+                kwargs["Range"] = byte_range
+            resp = self.s3.get_object(**kwargs)
+            out.put((resp.get('Metadata', {}), resp.get('ContentEncoding')))
+            body = resp['Body']
+            while True:
+                data = body.read(CHUNK_SIZE)
+                if not data:
+                    break
+                if not self._reserve(idx, len(data)):
+                    raise IOError("reader closed")
+                out.put(data)
+            body.close()
+            out.put(_DONE)
+        except Exception as e:
+            out.put(e)
+
+    def __iter__(self):
+        pool = ThreadPool(self.concurrency)
+        idx = 0
+        bodies = []
+        for item in self.items:
+            queues = []
+            for key, byte_range in self._parts(item):
+                q = Queue.Queue()
+                # The pool runs tasks in submission order, so the part
+                # the caller waits on has always been started
+                pool.apply_async(self._fetch, (idx, key, byte_range, q))
+                queues.append((idx, q))
+                idx += 1
+                self.requests += 1
+            bodies.append((item, queues))
+        # Workers exit once the queued parts are fetched. Joining the pool
+        # is left out, it costs ~0.1s in 2.7.
+        pool.close()
+        for item, queues in bodies:
+            yield item, _PrefetchBody(self, queues)
+
+    def _advance(self, idx):
+        with self._cond:
+            self._head = idx
+            self._cond.notify_all()
+
+    def close(self):
+        '''
+        Abandon the remaining parts
+        '''
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+class _PrefetchBody(object):
+    def __init__(self, reader, queues):
+        self._reader = reader
+        self._queues = queues
+        self._buf = ''
+        self.metadata = None
+        self.encoding = None
+
+    def content_encoding(self):
+        '''
+        Content-Encoding of the object; waits for the response to the first
+        GET of the body
+        '''
+        if self.metadata is None and self._queues:
+            idx, q = self._queues[0]
+            self._reader._advance(idx)
+            data = q.get()
+            if isinstance(data, Exception):
+                raise data
+            self.metadata, self.encoding = data
+        return self.encoding
+
+    def _next_piece(self):
+        while self._queues:
+            idx, q = self._queues[0]
+            self._reader._advance(idx)
+            data = q.get()
+            if data is _DONE:
+                self._queues.pop(0)
+                continue
+            if isinstance(data, Exception):
+                raise data
+            if isinstance(data, tuple):
+                if self.metadata is None:
+                    self.metadata, self.encoding = data
+                continue
+            self._reader._release(len(data))
+            return data
+        return ''
+
+    def read(self, amt=None):
+        if amt is None:
+            pieces = [self._buf]
+            while True:
+                data = self._next_piece()
+                if not data:
+                    break
+                pieces.append(data)
+            self._buf = ''
+            return ''.join(pieces)
+        if not self._buf:
+            self._buf = self._next_piece()
+        data, self._buf = self._buf[:amt], self._buf[amt:]
+        return data
+
+    def close(self):
+        pass
+
+def prefetch_reader(s3, bucket, items, options=None):
+    '''
+    PrefetchReader configured from the "prefetch" section of a task event
+    '''
+    options = options or {}
+    return PrefetchReader(s3, bucket, items,
+            concurrency=options.get("concurrency", CONCURRENCY),
+            part_size=options.get("partSize", PART_SIZE),
+            max_buffer=options.get("maxBuffer", MAX_BUFFER))
+
+class RangeReader(object):
+    '''
+    Body of one object, read as consecutive ranged GETs of chunk_size
+    bytes; the next chunk is fetched on pool while the current one is read.
+
+    This is for reading many objects at once, as a k-way merge does: each
+    holds at most two chunks, where a PrefetchReader expects its items to
+    be read one after the other. start() begins the first GET; metadata
+    and size are set once the first chunk arrived.
+    '''
+    def __init__(self, s3, bucket, key, pool, chunk_size=CHUNK_SIZE):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.pool = pool
+        self.chunk_size = chunk_size
+        self.metadata = None
+        self.size = None
+        self.requests = 0
+        self._pos = 0 # of the end of the chunks fetched
+        self._buf = ''
+        self._next = None
+
+    def _get(self, start):
+        resp = self.s3.get_object(Bucket=self.bucket, Key=self.key,
+                Range="bytes=%s-%s" % (start, start + self.chunk_size - 1))
+        size = int(resp["ContentRange"].rsplit('/', 1)[1])
+        return resp.get("Metadata", {}), size, resp["Body"].read()
+
+    def start(self):
+        if self._next is None and self.size is None:
+            self._next = self.pool.apply_async(self._get, (0,))
+
+    def _fill(self):
+        metadata, self.size, data = self._next.get()
+        self._next = None
+        self.requests += 1
+        if self.metadata is None:
+            self.metadata = metadata
+        self._pos += len(data)
+        if data and self._pos < self.size:
+            self._next = self.pool.apply_async(self._get, (self._pos,))
+        self._buf += data
+
+    def read(self, amt):
+        self.start()
+        while len(self._buf) < amt and self._next is not None:
+            self._fill()
+        data, self._buf = self._buf[:amt], self._buf[amt:]
+        return data
+
+    def close(self):
+        pass
+
+# Bytes read past the end of a split to finish its last line. Lines longer
+# than this cost an extra GET.
+SPLIT_OVERREAD = 64 * 1024
+
+def split_range(split):
+    '''
+    Byte range to fetch for a (key, start, end) split: from the byte before
+    start, to tell whether start is at a line boundary, to past end, to
+    finish the last line
+    '''
+    key, start, end = split
+    return (key, max(start - 1, 0), end + SPLIT_OVERREAD)
+
+def iter_split_text_blocks(s3, bucket, split, body, chunk_size=CHUNK_SIZE):
+    '''
+    Hadoop-style line splitting over the body of split_range(split): a line
+    belongs to the split it starts in. Unless the split starts the object,
+    the first (partial) line is skipped; it belongs to the previous split.
+    Lines are yielded in blocks like iter_text_blocks.
+    '''
+    key, start, end = split
+    first = max(start - 1, 0)
+    requested = end + SPLIT_OVERREAD - first + 1
+    offset = first # of the first line of the next chunk in the object
+    skip = start > 0
+    received = 0
+    tail = ''
+    while True:
+        chunk = body.read(chunk_size)
+        if not chunk:
+            break
+        received += len(chunk)
+        text = tail + chunk
+        cut = text.rfind('\n')
+        if cut < 0:
+            tail = text
+            continue
+        tail = text[cut + 1:]
+        # Lines that start at or before end: up to the first newline at
+        # or after it
+        stop = text.find('\n', end - offset, cut)
+        block = text[:cut if stop < 0 else stop]
+        if skip:
+            skip = False
+            nl = block.find('\n')
+            block = None if nl < 0 else block[nl + 1:]
+        if block is not None:
+            yield block
+        offset += cut + 1
+        if stop >= 0 or offset > end:
+            return
+    if not tail or skip or offset > end:
+        return
+    if received == requested:
+        # The range stopped inside the last line; read on to its end
+        tail += _read_to_newline(s3, bucket, key, first + received)
+    yield tail
+
+def iter_split_blocks(s3, bucket, split, body, chunk_size=CHUNK_SIZE):
+    for text in iter_split_text_blocks(s3, bucket, split, body, chunk_size):
+        yield text.split('\n')
+
+def iter_split_lines(s3, bucket, split, body, chunk_size=CHUNK_SIZE):
+    for lines in iter_split_blocks(s3, bucket, split, body, chunk_size):
+        for line in lines:
+            yield line
+
+def _read_to_newline(s3, bucket, key, pos):
+    pieces = []
+    while True:
+        # Start one byte early so the range is never past the end of the object
+        data = s3.get_object(Bucket=bucket, Key=key,
+                Range="bytes=%s-%s" % (pos - 1, pos + SPLIT_OVERREAD - 1))['Body'].read()[1:]
+        idx = data.find('\n')
+        if idx >= 0:
+            pieces.append(data[:idx])
+            break
+        pieces.append(data)
+        if len(data) < SPLIT_OVERREAD:
+            break
+        pos += len(data)
+    return ''.join(pieces)
+
+# Codecs of compressed input objects, by key suffix and by Content-Encoding
+GZIP = "gzip"
+BZIP2 = "bzip2"
+SUFFIXES = {".gz": GZIP, ".gzip": GZIP, ".bz2": BZIP2}
+ENCODINGS = {"gzip": GZIP, "x-gzip": GZIP, "bzip2": BZIP2, "x-bzip2": BZIP2}
+
+# Decompressed bytes per compressed byte of text, to plan splits and batches
+# before the data is read
+COMPRESSION_RATIOS = {GZIP: 5.0, BZIP2: 7.0}
+
+# Compressed bytes decompressed at a time; bz2 in 2.7 cannot cap the output
+# of a call, so this bounds it
+RAW_CHUNK_SIZE = 256 * 1024
+
+def codec_for(key, content_encoding=None):
+    '''
+    Codec of an object from the suffix of its key, else its Content-Encoding;
+    None for plain text
+    '''
+    for suffix, codec in SUFFIXES.iteritems():
+        if key.lower().endswith(suffix):
+            return codec
+    return ENCODINGS.get((content_encoding or '').strip().lower())
+
+class DecompressingBody(object):
+    '''
+    Decompressed bytes of a compressed body, decompressed a raw chunk at a
+    time as they are read. Concatenated streams, as written by appending
+    gzip files or by pbzip2, are decompressed one after the other.
+    '''
+    def __init__(self, body, codec, raw_chunk_size=RAW_CHUNK_SIZE):
+        self._body = body
+        self._codec = codec
+        self._raw_chunk_size = raw_chunk_size
+        self._decompressor = self._new()
+        self._buf = ''
+        self._eof = False
+
+    def _new(self):
+        if self._codec == GZIP:
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return bz2.BZ2Decompressor()
+
+    def _fill(self):
+        raw = self._body.read(self._raw_chunk_size)
+        if not raw:
+            self._eof = True
+            if self._codec == GZIP:
+                self._buf += self._decompressor.flush()
+            return
+        pieces = [self._buf]
+        while raw:
+            try:
+                pieces.append(self._decompressor.decompress(raw))
+            except EOFError:
+                # A bz2 stream ended with the last chunk; this one starts the next
+                self._decompressor = self._new()
+                continue
+            raw = self._decompressor.unused_data
+            if raw:
+                self._decompressor = self._new()
+        self._buf = ''.join(pieces)
+
+    def read(self, amt=None):
+        while not self._eof and (amt is None or len(self._buf) < amt):
+            self._fill()
+        if amt is None:
+            amt = len(self._buf)
+        data, self._buf = self._buf[:amt], self._buf[amt:]
+        return data
+
+    def close(self):
+        self._body.close()
+
+class _ResumedBody(object):
+    '''
+    The body of a range from the start of an object, then the rest of the
+    object if the range was not cut short by its end
+    '''
+    def __init__(self, s3, bucket, key, body, requested):
+        self._s3 = s3
+        self._bucket = bucket
+        self._key = key
+        self._body = body
+        self._requested = requested
+        self._received = 0
+        self._resumed = False
+
+    def read(self, amt=None):
+        data = self._body.read(amt)
+        self._received += len(data)
+        if data or self._resumed or self._received < self._requested:
+            return data
+        self._resumed = True
+        # Start one byte early so the range is never past the end of the object
+        self._body = self._s3.get_object(Bucket=self._bucket, Key=self._key,
+                Range="bytes=%s-" % (self._received - 1))['Body']
+        self._body.read(1)
+        return self._body.read(amt)
+
+    def close(self):
+        self._body.close()
+
+def input_range(split):
+    '''
+    What to fetch for a (key, start, end) input split: the whole object if
+    end is None or the object is compressed, else split_range(split)
+    '''
+    key, start, end = split
+    if end is None or codec_for(key):
+        return key
+    return split_range(split)
+
+def iter_input_text_blocks(s3, bucket, split, body, chunk_size=CHUNK_SIZE):
+    '''
+    Text blocks of the lines of an input split from the body of
+    input_range(split), like iter_text_blocks. Compressed objects are
+    decompressed as they stream in.
+
+    An object compressed without a suffix, only known by the
+    Content-Encoding of the response, may have been cut into byte ranges:
+    the split at its start then reads the whole object, and the others none.
+    '''
+    key, start, end = split
+    codec = codec_for(key)
+    if codec is None and hasattr(body, "content_encoding"):
+        codec = codec_for(key, body.content_encoding())
+        if codec and end is not None:
+            if start > 0:
+                # Frees the prefetch buffer of the range
+                while body.read(chunk_size):
+                    pass
+                return iter([])
+            body = _ResumedBody(s3, bucket, key, body, split_range(split)[2] + 1)
+    if codec:
+        return iter_text_blocks(DecompressingBody(body, codec), chunk_size)
+    if end is None:
+        return iter_text_blocks(body, chunk_size)
+    return iter_split_text_blocks(s3, bucket, split, body, chunk_size)
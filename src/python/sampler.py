@@ -0,0 +1,184 @@
+'''
+Sampling pre-pass of the driver
+
+Reads a byte range of a few input objects, runs the job's map and combine
+on them like a mapper, and fits how the number of distinct keys grows with
+the input, as d(n) = d1 * (n / B)^growth for n input bytes, from the keys
+of one sample of B bytes (d1) and of all of them together. growth is 0 for
+a fixed set of keys and 1 when every record has its own key. From that and
+the sizes of the records, the driver estimates:
+
+  - how many input bytes a mapper can take before its output dict no
+    longer fits in memory, to cap the mapper batches
+  - how much a reducer round shrinks the data, for the fan-in planner
+  - the shuffle partitions needed for the partition reducers to fit in
+    memory ("shufflePartitions": "auto")
+  - the Lambda memory the largest reducer needs; the configured
+    lambdaMemory is only ever raised
+
+Copyright 2016 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+'''
+
+import intermediate
+import lambdautils
+import math
+import random
+import s3reader
+import sys
+
+# shufflePartitions setting that has them estimated from the sample
+AUTO = "auto"
+
+SAMPLE_OBJECTS = 8
+SAMPLE_BYTES = 1024 * 1024
+
+# Memory of a dict entry besides its key and value objects: the hash table
+# slot, at the table's usual fill
+DICT_ENTRY_BYTES = 48
+
+# Lambda memory settings (MB)
+MEMORY_STEP = 64
+MAX_MEMORY = 3008
+
+def _read_sample(s3, bucket, key, length, rng):
+    '''
+    Whole lines of a random byte range of up to length bytes of key; of the
+    first length bytes of text if it is compressed
+    '''
+    codec = s3reader.codec_for(key['Key'])
+    if codec is None:
+        n = min(length, key['Size'])
+        start = rng.randint(0, key['Size'] - n)
+        resp = s3.get_object(Bucket=bucket, Key=key['Key'],
+                Range="bytes=%s-%s" % (start, start + n - 1))
+        codec = s3reader.codec_for(key['Key'], resp.get('ContentEncoding'))
+        if codec is None:
+            data = resp["Body"].read()
+            lines = data.split('\n')
+            if start > 0:
+                lines = lines[1:]
+            if start + n < key['Size']:
+                lines = lines[:-1]
+            return lines, len(data)
+        resp["Body"].close()
+    # Compressed: only readable from its start
+    body = s3reader.DecompressingBody(s3.get_object(Bucket=bucket, Key=key['Key'])["Body"], codec)
+    data = body.read(length)
+    body.close()
+    lines = data.split('\n')
+    if len(data) == length:
+        lines = lines[:-1]
+    return lines, len(data)
+
+class Sample(object):
+    def __init__(self, sample_bytes, distinct, combined, lines, record_bytes, entry_bytes):
+        # Per sample: bytes, lines and distinct keys; combined is the
+        # distinct keys of all samples
+        n = len(distinct)
+        self.sample_bytes = sample_bytes
+        self.d1 = max(sum(distinct) / float(n), 1.0)
+        self.growth = 1.0
+        if n > 1 and combined > self.d1:
+            self.growth = min(math.log(combined / self.d1) / math.log(n), 1.0)
+        elif n > 1:
+            self.growth = 0.0
+        self.bytes_per_line = sample_bytes / float(max(lines, 1))
+        self.record_bytes = record_bytes
+        self.entry_bytes = entry_bytes
+
+    def distinct_keys(self, n_bytes):
+        return self.d1 * (max(n_bytes, 1) / self.sample_bytes) ** self.growth
+
+    def output_bytes(self, n_bytes):
+        return self.distinct_keys(n_bytes) * self.record_bytes
+
+    def memory_bytes(self, n_bytes):
+        return self.distinct_keys(n_bytes) * self.entry_bytes
+
+    def max_input_bytes(self, data_memory):
+        '''
+        Input bytes whose distinct keys fill data_memory bytes of dict;
+        infinite when no float is that large, as for a key set that hardly
+        grows
+        '''
+        if self.growth <= 0:
+            return float('inf')
+        # In logs: a small growth makes the power overflow
+        log_bytes = math.log(self.sample_bytes) + \
+                math.log(data_memory / (self.d1 * self.entry_bytes)) / self.growth
+        if log_bytes >= math.log(sys.float_info.max):
+            return float('inf')
+        return math.exp(log_bytes)
+
+    def summary(self, total_bytes):
+        return {
+            "sampleBytes": int(self.sample_bytes),
+            "bytesPerLine": round(self.bytes_per_line, 1),
+            "keyGrowth": round(self.growth, 4),
+            "distinctKeys": int(self.distinct_keys(total_bytes)),
+            "outputBytes": int(self.output_bytes(total_bytes)),
+            "recordBytes": round(self.record_bytes, 1),
+            "entryBytes": round(self.entry_bytes, 1)
+        }
+
+def take(s3, bucket, keys, job, out_format, options=None):
+    '''
+    Sample of options["objects"] input objects, spread over the key list,
+    options["bytes"] bytes each; None if the input is empty
+    '''
+    options = options or {}
+    n_objects = options.get("objects", SAMPLE_OBJECTS)
+    length = options.get("bytes", SAMPLE_BYTES)
+    keys = [key for key in keys if key['Size'] > 0]
+    if not keys:
+        return None
+    step = max(len(keys) / float(n_objects), 1.0)
+    picked = [keys[int(i * step)] for i in range(min(n_objects, len(keys)))]
+    rng = random.Random(0)
+
+    distinct = []
+    combined = {}
+    n_lines = n_bytes = 0
+    for key in picked:
+        lines, size = _read_sample(s3, bucket, key, length, rng)
+        output = {}
+        job.map_into(lines, output)
+        job.map_into(lines, combined)
+        distinct.append(len(output))
+        n_lines += len(lines)
+        n_bytes += size
+    if not combined:
+        return None
+
+    encoded = job.encode_all(combined)
+    record_bytes = len(intermediate.dumps(encoded, out_format)) / float(len(combined))
+    entries = list(combined.iteritems())[:1000]
+    entry_bytes = DICT_ENTRY_BYTES + sum(sys.getsizeof(k) + sys.getsizeof(v)
+            for k, v in entries) / float(len(entries))
+    return Sample(n_bytes / float(len(picked)), distinct, len(combined),
+            n_lines / float(len(picked)), record_bytes, entry_bytes)
+
+def data_memory(lambda_memory):
+    return lambdautils.DATA_MEMORY_FRACTION * lambda_memory * 1000 * 1000
+
+def shuffle_partitions(sample, total_bytes, n_mappers, lambda_memory, concurrent_lambdas):
+    '''
+    Partitions whose reducers hold their keys, and read their inputs, within
+    the data memory
+    '''
+    mapper_bytes = total_bytes / float(max(n_mappers, 1))
+    inputs = n_mappers * sample.output_bytes(mapper_bytes)
+    need = max(sample.memory_bytes(total_bytes), inputs)
+    return int(min(max(math.ceil(need / data_memory(lambda_memory)), 1), concurrent_lambdas))
+
+def reducer_memory(sample, total_bytes, n_partitions, lambda_memory):
+    '''
+    Lambda memory (MB) for the largest reducer: the last one of the tree,
+    or a partition reducer; at least lambda_memory
+    '''
+    need = sample.memory_bytes(total_bytes) / max(n_partitions or 1, 1)
+    memory = lambda_memory
+    while data_memory(memory) < need and memory < MAX_MEMORY:
+        memory = min(memory + MEMORY_STEP, MAX_MEMORY)
+    return memory
@@ -0,0 +1,287 @@
+'''
+Sliding-window task scheduler for the driver
+
+Copyright 2016 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+'''
+
+import collections
+import heapq
+import random
+import threading
+import time
+import traceback
+
+# Retries per task and exponential backoff (secs) between attempts
+MAX_RETRIES = 3
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+
+# Secs between checks for stragglers
+MONITOR_INTERVAL = 0.5
+
+# Secs between polls for the outputs of Event-invoked tasks
+POLL_INTERVAL = 1.0
+
+# Lambda retries a failed Event invocation twice, about 1 and 2 minutes
+# after the failure
+ASYNC_RETRY_SECS = 180
+
+class TaskFailed(Exception):
+    def __init__(self, failures):
+        Exception.__init__(self, "%s task(s) failed: %s" % (len(failures),
+                ", ".join(str(t) for t in sorted(failures))))
+        self.failures = failures
+
+class Speculation(object):
+    '''
+    Straggler policy: once min_done_fraction of the tasks have finished, a
+    task running longer than slow_factor times the median duration of the
+    finished ones, and at least min_secs, gets one backup copy.
+    '''
+    def __init__(self, slow_factor=2.0, min_done_fraction=0.5, min_secs=10):
+        self.slow_factor = slow_factor
+        self.min_done_fraction = min_done_fraction
+        self.min_secs = min_secs
+
+    @classmethod
+    def from_config(cls, config):
+        '''
+        None unless the "speculation" section of driverconfig.json is present
+        '''
+        if not config:
+            return None
+        return cls(config.get("slowFactor", 2.0), config.get("minDoneFraction", 0.5),
+                config.get("minSecs", 10))
+
+    def stragglers(self, durations, running, total):
+        '''
+        durations: secs of finished tasks; running: {task: secs so far}
+        '''
+        if not durations or len(durations) < self.min_done_fraction * total:
+            return []
+        durations = sorted(durations)
+        limit = max(self.slow_factor * durations[len(durations) // 2], self.min_secs)
+        return [t for t, secs in running.items() if secs > limit]
+
+class TaskScheduler(object):
+    '''
+    Runs fn(task_id) for every task with up to `concurrency` calls in flight,
+    starting the next task as soon as any call returns rather than waiting
+    for a whole wave. A call that raises (throttled or failed invocation) is
+    retried up to max_retries times after a jittered exponential backoff;
+    the slot runs other tasks in the meantime.
+
+    With a Speculation policy, stragglers get a backup copy and the first
+    copy to return wins. fn must therefore be safe to run twice.
+    '''
+    def __init__(self, concurrency, max_retries=MAX_RETRIES, backoff_base=BACKOFF_BASE,
+            backoff_max=BACKOFF_MAX, speculation=None):
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.speculation = speculation
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def run(self, task_ids, fn):
+        '''
+        Returns {task_id: result}. Raises TaskFailed if a task is still
+        failing after its retries.
+        '''
+        self._fn = fn
+        self._cond = threading.Condition()
+        self._ready = [(0, seq, task_id, 0) for seq, task_id in enumerate(task_ids)]
+        self._seq = len(self._ready)
+        self._total = len(self._ready)
+        self._pending = self._total
+        self._running = {} # task -> {copy: start time} of its running copies
+        self._backed_up = set()
+        self.durations = []
+        self.backups = 0
+        self.results = {}
+        self.failures = {}
+
+        for i in range(min(self.concurrency, self._pending)):
+            w = threading.Thread(target=self._worker)
+            w.daemon = True
+            w.start()
+
+        with self._cond:
+            while self._pending:
+                self._cond.wait(MONITOR_INTERVAL)
+                if self.speculation:
+                    self._speculate()
+        # A losing copy may still be running; its result is dropped
+
+        if self.failures:
+            raise TaskFailed(self.failures)
+        return self.results
+
+    def _speculate(self):
+        now = time.time()
+        running = dict((t, now - min(copies.values())) for t, copies in self._running.items()
+                if t not in self._backed_up and not self._done(t))
+        for task_id in self.speculation.stragglers(self.durations, running, self._total):
+            print "Task %s is a straggler, launching a backup copy" % task_id
+            self._backed_up.add(task_id)
+            self.backups += 1
+            self._seq += 1
+            # Ahead of any task waiting out a backoff
+            heapq.heappush(self._ready, (0, -self._seq, task_id, 0))
+            self._cond.notify_all()
+
+    def _done(self, task_id):
+        return task_id in self.results or task_id in self.failures
+
+    def _stop_copy(self, task_id, copy):
+        '''
+        Start time of a copy of a task that returned; the task stops
+        running with its last copy
+        '''
+        copies = self._running.get(task_id, {})
+        start = copies.pop(copy, None)
+        if not copies:
+            self._running.pop(task_id, None)
+        return start
+
+    def _next(self):
+        '''
+        Earliest task whose backoff has passed; None when all are done
+        '''
+        with self._cond:
+            while True:
+                if not self._pending:
+                    return None
+                if self._ready:
+                    wait = self._ready[0][0] - time.time()
+                    if wait <= 0:
+                        item = heapq.heappop(self._ready)
+                        if self._done(item[2]):
+                            continue
+                        # A copy is known by the seq it was queued with
+                        self._running.setdefault(item[2], {})[item[1]] = time.time()
+                        return item
+                    self._cond.wait(wait)
+                else:
+                    # Remaining tasks are running; one may come back for a
+                    # retry or need a backup
+                    self._cond.wait()
+
+    def _worker(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            ready_at, seq, task_id, attempt = item
+            try:
+                result = self._fn(task_id)
+            except Exception as e:
+                with self._cond:
+                    self._stop_copy(task_id, seq)
+                    if self._done(task_id):
+                        pass
+                    elif task_id in self._running:
+                        # Another copy is still running; it retries if it fails too
+                        print "Task %s failed, waiting for its other copy: %s" % (task_id, e)
+                    elif attempt < self.max_retries:
+                        print "Task %s failed (attempt %s), retrying: %s" % (task_id, attempt + 1, e)
+                        self._seq += 1
+                        heapq.heappush(self._ready,
+                                (time.time() + self.backoff(attempt), self._seq, task_id, attempt + 1))
+                    else:
+                        traceback.print_exc()
+                        self.failures[task_id] = e
+                        self._pending -= 1
+                    self._cond.notify_all()
+                continue
+            with self._cond:
+                start = self._stop_copy(task_id, seq)
+                if not self._done(task_id):
+                    try:
+                        self.results[task_id] = result
+                        self.durations.append(time.time() - start)
+                    finally:
+                        # run() returns once no task is pending
+                        self._pending -= 1
+                        self._cond.notify_all()
+
+class EventScheduler(object):
+    '''
+    Runs tasks as Event invocations and follows them by their outputs, so
+    the driver holds no thread or connection per running task. Keeps up to
+    `concurrency` tasks started and not done: launch(task_ids) invokes the
+    tasks, done() returns the ids of the tasks whose output is in place,
+    polled every poll_interval secs.
+
+    Lambda retries a throttled or failed Event invocation itself. A task
+    without output timeout secs after it was launched is launched again, up
+    to max_retries times. Speculation works as in TaskScheduler, so
+    launching a task twice must be safe.
+    '''
+    def __init__(self, concurrency, timeout, max_retries=MAX_RETRIES, speculation=None,
+            poll_interval=POLL_INTERVAL):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.speculation = speculation
+        self.poll_interval = poll_interval
+
+    def run(self, task_ids, launch, done):
+        '''
+        Returns the set of finished tasks. Raises TaskFailed if a task still
+        has no output after its retries.
+        '''
+        waiting = collections.deque(task_ids)
+        total = len(waiting)
+        running = {} # task -> time of its latest launch
+        attempts = {}
+        backed_up = set()
+        finished = set()
+        failures = {}
+        self.durations = []
+        self.backups = 0
+        self.relaunches = 0
+
+        while waiting or running:
+            now = time.time()
+            batch = []
+            for task_id, started in running.items():
+                if now - started < self.timeout:
+                    continue
+                attempts[task_id] = attempts.get(task_id, 0) + 1
+                if attempts[task_id] > self.max_retries:
+                    failures[task_id] = "no output %d secs after launch" % self.timeout
+                    del running[task_id]
+                else:
+                    print "Task %s has no output after %d secs, launching it again" % (task_id, now - started)
+                    self.relaunches += 1
+                    running[task_id] = now
+                    batch.append(task_id)
+            if self.speculation:
+                stragglers = self.speculation.stragglers(self.durations, dict((t, now - s)
+                        for t, s in running.items() if t not in backed_up), total)
+                for task_id in stragglers:
+                    print "Task %s is a straggler, launching a backup copy" % task_id
+                    backed_up.add(task_id)
+                    self.backups += 1
+                    batch.append(task_id)
+            while waiting and len(running) < self.concurrency:
+                task_id = waiting.popleft()
+                running[task_id] = now
+                batch.append(task_id)
+            if batch:
+                launch(batch)
+
+            time.sleep(self.poll_interval)
+            now = time.time()
+            for task_id in done():
+                if task_id in running:
+                    self.durations.append(now - running.pop(task_id))
+                    finished.add(task_id)
+
+        if failures:
+            raise TaskFailed(failures)
+        return finished
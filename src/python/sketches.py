@@ -0,0 +1,208 @@
+'''
+Mergeable sketch accumulators
+
+For distinct counts, frequencies and heavy hitters a job does not need to
+ship every item through the reducers: its accumulator can be a sketch of
+fixed size that mappers fill and reducers merge, so intermediates and the
+result stay the same size however large the input is.
+
+    HyperLogLog(p)              distinct items, within about 1.04 / 2^(p/2)
+                                (1.6% at the default p=12)
+    CountMin(width, depth)      weight of any item, overestimated by at most
+                                e / width of the total weight with
+                                probability 1 - e^-depth
+    TopK(k, capacity)           the k heaviest items (space-saving), with
+                                counts overestimated by at most the total
+                                weight / capacity
+
+All of them have add(item, weight=1) and merge(other), which return the
+sketch, and dumps() / loads(value) for a compact JSON form. As a job's
+ACC_TYPE (see jobspec.py), their accumulators are written in that form and
+the result holds result(): the estimated count, the serialized CountMin to
+query, or the top items.
+
+  ACC_TYPE = sketches.HyperLogLog
+
+  def create(value):
+      return sketches.HyperLogLog().add(value)
+
+  def combine(acc, value):
+      return acc.add(value)
+
+  def reduce(acc, other):
+      return acc.merge(other)
+
+Items are str (unicode is encoded as UTF-8) and are hashed with MD5.
+
+Copyright 2016 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+'''
+
+import array
+import base64
+import hashlib
+import math
+import struct
+import zlib
+
+def _hash64(item):
+    if not isinstance(item, str):
+        item = unicode(item).encode('utf-8')
+    return struct.unpack('<QQ', hashlib.md5(item).digest())
+
+def _pack(data):
+    return base64.b64encode(zlib.compress(data))
+
+def _unpack(text):
+    return zlib.decompress(base64.b64decode(text))
+
+class HyperLogLog(object):
+    def __init__(self, p=12):
+        self.p = p
+        self.registers = bytearray(1 << p)
+
+    def add(self, item, weight=1):
+        x = _hash64(item)[0]
+        bits = 64 - self.p
+        rest = x & ((1 << bits) - 1)
+        rank = bits - rest.bit_length() + 1
+        index = x >> bits
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+        return self
+
+    def merge(self, other):
+        if other.p != self.p:
+            raise ValueError("HyperLogLog precisions differ: %s and %s" % (self.p, other.p))
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+        return self
+
+    def count(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(b'\x00')
+        if estimate <= 2.5 * m and zeros:
+            # Small range: linear counting
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+    def result(self):
+        return self.count()
+
+    def dumps(self):
+        return "%s:%s" % (self.p, _pack(str(self.registers)))
+
+    @classmethod
+    def loads(cls, value):
+        p, data = value.split(':', 1)
+        sketch = cls(int(p))
+        sketch.registers = bytearray(_unpack(data))
+        return sketch
+
+class CountMin(object):
+    def __init__(self, width=1024, depth=4):
+        self.width = width
+        self.depth = depth
+        self.counts = array.array('d', [0.0]) * (width * depth)
+        self.total = 0.0
+
+    def _cells(self, item):
+        # depth hashes from two (Kirsch-Mitzenmacher)
+        h1, h2 = _hash64(item)
+        return [row * self.width + (h1 + row * h2) % self.width for row in range(self.depth)]
+
+    def add(self, item, weight=1):
+        for cell in self._cells(item):
+            self.counts[cell] += weight
+        self.total += weight
+        return self
+
+    def merge(self, other):
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError("CountMin shapes differ")
+        counts = self.counts
+        for i, count in enumerate(other.counts):
+            if count:
+                counts[i] += count
+        self.total += other.total
+        return self
+
+    def estimate(self, item):
+        return min(self.counts[cell] for cell in self._cells(item))
+
+    def result(self):
+        return self.dumps()
+
+    def dumps(self):
+        return "%s:%s:%r:%s" % (self.width, self.depth, self.total, _pack(self.counts.tostring()))
+
+    @classmethod
+    def loads(cls, value):
+        width, depth, total, data = value.split(':', 3)
+        sketch = cls(int(width), int(depth))
+        sketch.counts = array.array('d', _unpack(data))
+        sketch.total = float(total)
+        return sketch
+
+class TopK(object):
+    '''
+    Space-saving summary of capacity counters: an item without a counter
+    takes over the smallest one, inheriting its count as its error
+    '''
+    def __init__(self, k=10, capacity=None):
+        self.k = k
+        self.capacity = capacity or 10 * k
+        # item -> [count, error]
+        self.counters = {}
+
+    def add(self, item, weight=1):
+        counter = self.counters.get(item)
+        if counter is not None:
+            counter[0] += weight
+        elif len(self.counters) < self.capacity:
+            self.counters[item] = [weight, 0]
+        else:
+            smallest = min(self.counters, key=lambda i: self.counters[i][0])
+            count = self.counters.pop(smallest)[0]
+            self.counters[item] = [count + weight, count]
+        return self
+
+    def _floor(self):
+        # Largest count an item without a counter can have
+        if len(self.counters) < self.capacity:
+            return 0
+        return min(counter[0] for counter in self.counters.itervalues())
+
+    def merge(self, other):
+        floor, other_floor = self._floor(), other._floor()
+        merged = {}
+        for item in set(self.counters) | set(other.counters):
+            count, error = self.counters.get(item, (floor, floor))
+            other_count, other_error = other.counters.get(item, (other_floor, other_floor))
+            merged[item] = [count + other_count, error + other_error]
+        self.capacity = max(self.capacity, other.capacity)
+        self.k = max(self.k, other.k)
+        self.counters = dict(sorted(merged.iteritems(), key=lambda kv: -kv[1][0])[:self.capacity])
+        return self
+
+    def top(self):
+        '''
+        [item, count, error] of the k heaviest items, heaviest first
+        '''
+        ranked = sorted(self.counters.iteritems(), key=lambda kv: -kv[1][0])[:self.k]
+        return [[item, count, error] for item, (count, error) in ranked]
+
+    def result(self):
+        return self.top()
+
+    def dumps(self):
+        return [self.k, self.capacity, [[item, count, error]
+                for item, (count, error) in self.counters.iteritems()]]
+
+    @classmethod
+    def loads(cls, value):
+        k, capacity, counters = value
+        sketch = cls(k, capacity)
+        sketch.counters = dict((item, [count, error]) for item, count, error in counters)
+        return sketch
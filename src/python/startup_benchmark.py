@@ -0,0 +1,75 @@
+'''
+Benchmark the cold start of the handlers
+
+Starts a fresh interpreter per handler and run, like a new Lambda
+container, and reports the medians of:
+
+  importSecs    - time to import the handler module
+  modules       - modules the import loaded
+  clientSecs    - time to create its S3 client on first use
+  firstByteSecs - time from the start of the import to the first byte of
+                  bucket/key (only with a key)
+
+The handlers use the backend of the environment, e.g. BL_BACKEND=local
+BL_LOCAL_ROOT=... for the local one.
+
+  $ python startup_benchmark.py [bucket key] [repeat]
+'''
+
+import json
+import subprocess
+import sys
+import time
+
+HANDLERS = ["mapper", "reducer", "reducerCoordinator"]
+
+def probe(handler, bucket=None, key=None):
+    '''
+    Runs in the fresh interpreter
+    '''
+    loaded = len(sys.modules)
+    start = time.time()
+    __import__(handler)
+    imported = time.time()
+    modules = len(sys.modules) - loaded
+
+    import backend
+    client = backend.s3_client()
+    created = time.time()
+    first_byte = None
+    if key:
+        client.get_object(Bucket=bucket, Key=key, Range="bytes=0-0")["Body"].read()
+        first_byte = time.time() - start
+    return {"importSecs": imported - start, "modules": modules,
+            "clientSecs": created - imported, "firstByteSecs": first_byte}
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def run(bucket=None, key=None, repeat=5):
+    stats = {}
+    for handler in HANDLERS:
+        runs = []
+        for i in range(repeat):
+            out = subprocess.check_output([sys.executable, __file__, "--probe", handler,
+                    bucket or "", key or ""])
+            runs.append(json.loads(out.splitlines()[-1]))
+        stats[handler] = dict((field, median([r[field] for r in runs]))
+                for field in runs[0] if runs[0][field] is not None)
+    return stats
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "--probe":
+        print json.dumps(probe(*sys.argv[2:]))
+        sys.exit(0)
+    bucket = sys.argv[1] if len(sys.argv) > 2 else None
+    key = sys.argv[2] if len(sys.argv) > 2 else None
+    repeat = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    stats = run(bucket, key, repeat)
+    print "%-20s %10s %8s %10s %14s" % ("handler", "import s", "modules", "client s", "first byte s")
+    for handler in HANDLERS:
+        s = stats[handler]
+        print "%-20s %10.3f %8d %10.3f %14s" % (handler, s["importSecs"], s["modules"],
+                s["clientSecs"], "%.3f" % s["firstByteSecs"] if "firstByteSecs" in s else "-")
+    print json.dumps(stats)
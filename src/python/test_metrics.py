@@ -0,0 +1,59 @@
+'''
+Tests of the task metrics
+
+  $ python -m unittest test_metrics
+
+Copyright 2016 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+'''
+
+import unittest
+
+import metrics
+
+def record(stage, secs):
+    r = dict.fromkeys(metrics.SUM_FIELDS, 123456)
+    r.update({"task": stage + "-0", "stage": stage, "coldStart": True, "peakRssKb": 65536,
+            "totalSecs": secs})
+    return r
+
+def reducer_stages(n_steps, tasks_per_step):
+    stages = {}
+    for step in range(1, n_steps + 1):
+        summary = stages["reducer-%s" % step] = metrics.StageSummary()
+        for i in range(tasks_per_step):
+            summary.add(record("reducer-%s" % step, 0.01 * 1.3 ** i))
+    return stages
+
+class WithStagesTest(unittest.TestCase):
+    def metadata(self):
+        return {"linecount": "1000000", "processingtime": "12.345678901",
+                "memoryUsage": "65536",
+                metrics.METRICS_META: metrics.dumps(record("reducer-9", 1.5))}
+
+    def test_few_steps_keep_histograms(self):
+        out = metrics.with_stages(self.metadata(), reducer_stages(2, 5))
+        self.assertLessEqual(metrics.metadata_size(out), metrics.METADATA_LIMIT)
+        stages = metrics.loads_stages(out[metrics.STAGES_META])
+        self.assertEqual(sorted(stages), ["reducer-1", "reducer-2"])
+        self.assertTrue(all(s.data["hist"] for s in stages.values()))
+
+    def test_many_steps_fit(self):
+        stages = reducer_stages(30, 20)
+        out = metrics.with_stages(self.metadata(), stages)
+        self.assertLessEqual(metrics.metadata_size(out), metrics.METADATA_LIMIT)
+        kept = metrics.loads_stages(out[metrics.STAGES_META])
+        # The earliest steps are merged, with every task still counted
+        self.assertIn(metrics.MERGED_STAGE, kept)
+        self.assertIn("reducer-30", kept)
+        self.assertEqual(sum(s.data["n"] for s in kept.values()), 30 * 20)
+        self.assertEqual(sum(s.data["bytesIn"] for s in kept.values()), 30 * 20 * 123456)
+
+    def test_folds_merged_stage(self):
+        out = metrics.with_stages(self.metadata(), reducer_stages(30, 20))
+        stages = {}
+        metrics.fold(stages, out)
+        self.assertEqual(sum(s.data["n"] for s in stages.values()), 30 * 20 + 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+'''
+Tests of the sampler's estimates
+
+  $ python -m unittest test_sampler
+
+Copyright 2016 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+'''
+
+import unittest
+
+import sampler
+
+class MaxInputBytesTest(unittest.TestCase):
+    def test_near_constant_keys(self):
+        # One more key over 8 samples: growth is about 0.004, and the
+        # power of the estimate overflows a float
+        sample = sampler.Sample(1e6, [100] * 7 + [101], 101, 1e4, 20, 150)
+        self.assertTrue(0 < sample.growth < 0.01)
+        self.assertEqual(sample.max_input_bytes(sampler.data_memory(1536)), float('inf'))
+
+    def test_constant_keys(self):
+        sample = sampler.Sample(1e6, [100] * 8, 100, 1e4, 20, 150)
+        self.assertEqual(sample.growth, 0.0)
+        self.assertEqual(sample.max_input_bytes(sampler.data_memory(1536)), float('inf'))
+
+    def test_growing_keys(self):
+        # Keys grow as the square root of the input: 4x the memory takes
+        # 16x the input
+        sample = sampler.Sample(1e6, [1000] * 4, 2000, 1e4, 20, 100)
+        self.assertAlmostEqual(sample.growth, 0.5)
+        self.assertAlmostEqual(sample.max_input_bytes(4 * 1000 * 100) / 16e6, 1.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+'''
+Tests of the task schedulers
+
+  $ python -m unittest test_scheduler
+
+Copyright 2016 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+'''
+
+import threading
+import time
+import unittest
+
+import scheduler
+
+# Secs a run may take before the test calls it hung
+RUN_TIMEOUT = 10
+
+class Straggler(object):
+    '''
+    Every task returns right away, but the first copy of SLOW runs for
+    SLOW_SECS; the copies after it run `later`
+    '''
+    SLOW = 9
+    SLOW_SECS = 1.5
+
+    def __init__(self, later):
+        self.later = later
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def __call__(self, task_id):
+        if task_id != self.SLOW:
+            return task_id
+        with self.lock:
+            self.calls += 1
+            first = self.calls == 1
+        if first:
+            time.sleep(self.SLOW_SECS)
+            return task_id
+        return self.later(task_id)
+
+def run_with_timeout(sched, task_ids, fn):
+    out = {}
+    def target():
+        try:
+            out["results"] = sched.run(task_ids, fn)
+        except Exception as e:
+            out["error"] = e
+    t = threading.Thread(target=target)
+    t.daemon = True
+    t.start()
+    t.join(RUN_TIMEOUT)
+    return t.is_alive(), out
+
+class TaskSchedulerTest(unittest.TestCase):
+    def scheduler(self):
+        speculation = scheduler.Speculation(slow_factor=2.0, min_done_fraction=0.5, min_secs=0.2)
+        return scheduler.TaskScheduler(4, backoff_base=0.01, speculation=speculation)
+
+    def test_backup_fails_while_original_runs(self):
+        def fail(task_id):
+            raise IOError("backup failed")
+        sched = self.scheduler()
+        # A retry of the backup would still be waiting when the original returns
+        sched.backoff = lambda attempt: 2 * Straggler.SLOW_SECS
+        fn = Straggler(fail)
+        hung, out = run_with_timeout(sched, range(10), fn)
+        self.assertFalse(hung)
+        self.assertNotIn("error", out)
+        self.assertEqual(out["results"], dict((t, t) for t in range(10)))
+        self.assertEqual(sched.backups, 1)
+        # The original was still running, so the failed backup is not retried
+        self.assertEqual(fn.calls, 2)
+
+    def test_backup_wins(self):
+        sched = self.scheduler()
+        hung, out = run_with_timeout(sched, range(10), Straggler(lambda task_id: task_id))
+        self.assertFalse(hung)
+        self.assertEqual(out["results"], dict((t, t) for t in range(10)))
+        self.assertEqual(len(sched.durations), 10)
+
+    def test_retries_then_fails(self):
+        def fn(task_id):
+            if task_id == 3:
+                raise IOError("always fails")
+            return task_id
+        sched = scheduler.TaskScheduler(2, max_retries=2, backoff_base=0.01)
+        hung, out = run_with_timeout(sched, range(5), fn)
+        self.assertFalse(hung)
+        self.assertIsInstance(out["error"], scheduler.TaskFailed)
+        self.assertEqual(out["error"].failures.keys(), [3])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+'''
+Tests of the line splitting of input byte ranges
+
+  $ python -m unittest test_splits
+
+Copyright 2016 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+'''
+
+import StringIO
+import unittest
+
+import lambdautils
+import s3reader
+
+BUCKET = "input"
+KEY = "data"
+
+class RangeS3(object):
+    '''
+    get_object of one in-memory object, with byte ranges like S3
+    '''
+    def __init__(self, data):
+        self.data = data
+        self.requests = 0
+
+    def get_object(self, Bucket, Key, Range=None):
+        self.requests += 1
+        first, last = Range.split('=')[1].split('-')
+        return {"Body": StringIO.StringIO(self.data[int(first):int(last) + 1])}
+
+def split_lines(data, split_size, chunk_size=s3reader.CHUNK_SIZE, s3=None):
+    '''
+    The lines of every split of data, in order, the way a mapper reads them
+    '''
+    s3 = s3 or RangeS3(data)
+    lines = []
+    for split in lambdautils.split_creator([{"Key": KEY, "Size": len(data)}], split_size):
+        split = (split["Key"], split["Start"], split["End"])
+        key, first, last = s3reader.split_range(split)
+        body = s3.get_object(Bucket=BUCKET, Key=key, Range="bytes=%s-%s" % (first, last))["Body"]
+        for text in s3reader.iter_split_text_blocks(s3, BUCKET, split, body, chunk_size):
+            lines += text.split('\n')
+    return lines
+
+def file_lines(data):
+    lines = data.split('\n')
+    return lines[:-1] if data.endswith('\n') else lines
+
+class SplitLinesTest(unittest.TestCase):
+    def assertEveryLineOnce(self, data, split_size, chunk_sizes=(7, 64, s3reader.CHUNK_SIZE)):
+        for chunk_size in chunk_sizes:
+            self.assertEqual(split_lines(data, split_size, chunk_size), file_lines(data),
+                    "split size %s, chunk size %s" % (split_size, chunk_size))
+
+    def test_line_across_boundary(self):
+        data = "aaaa\nbbbbbbbb\ncc\n"
+        # Split 0 ends, and split 1 starts, inside "bbbbbbbb"
+        self.assertEqual(data.index("bbbbbbbb"), 5)
+        self.assertEveryLineOnce(data, 8)
+
+    def test_split_starts_at_line(self):
+        data = "aaa\nbbb\nccc\nddd\n"
+        # Every split starts at a line start, right after a newline
+        self.assertEveryLineOnce(data, 4)
+        self.assertEveryLineOnce(data, 8)
+
+    def test_split_starts_at_newline(self):
+        # A split that starts on a newline byte
+        data = "aaa\nbbb\nccc\nddd\n"
+        self.assertEveryLineOnce(data, 3)
+
+    def test_line_longer_than_overread(self):
+        long_line = "x" * (3 * s3reader.SPLIT_OVERREAD + 5)
+        data = "head\n" + long_line + "\nmiddle\n" + long_line + "\ntail\n"
+        for split_size in (1000, s3reader.SPLIT_OVERREAD // 3, s3reader.SPLIT_OVERREAD):
+            self.assertEveryLineOnce(data, split_size, (4096, s3reader.CHUNK_SIZE))
+        # The splits the long lines start in read on past their overread
+        s3 = RangeS3(data)
+        n_splits = len(lambdautils.split_creator([{"Key": KEY, "Size": len(data)}], 1000))
+        self.assertEqual(split_lines(data, 1000, s3=s3), file_lines(data))
+        self.assertGreater(s3.requests, n_splits)
+
+    def test_no_trailing_newline(self):
+        data = "aaaa\nbbbbbbbb\ncccccc"
+        for split_size in range(1, len(data) + 1):
+            self.assertEveryLineOnce(data, split_size)
+
+    def test_many_split_sizes(self):
+        data = "".join("line %s %s\n" % (i, "y" * (i % 13)) for i in range(200))
+        for split_size in (1, 2, 3, 5, 17, 64, 100, 1000, len(data)):
+            self.assertEveryLineOnce(data, split_size)
+
+class SplitSizesTest(unittest.TestCase):
+    def test_cached_objects_keep_their_splits(self):
+        # As PartialCache.split_sizes gives them: the length of the first split
+        keys = [{"Key": "old", "Size": 1000, "ETag": "a"}, {"Key": "small", "Size": 80, "ETag": "b"},
+                {"Key": "new", "Size": 1000, "ETag": "c"}]
+        before = lambdautils.split_creator(keys[:2], 300)
+        sizes = dict(((s["Key"], s["ETag"]), s["End"] + 1) for s in before if s["Start"] == 0)
+        after = lambdautils.split_creator(keys, 400, split_sizes=sizes)
+        self.assertEqual([s for s in after if s["Key"] != "new"], before)
+        self.assertEqual([(s["Start"], s["End"]) for s in after if s["Key"] == "new"],
+                [(0, 399), (400, 799), (800, 999)])
+
+    def test_changed_object_is_cut_anew(self):
+        sizes = {("old", "a"): 300}
+        splits = lambdautils.split_creator([{"Key": "old", "Size": 1000, "ETag": "z"}], 400,
+                split_sizes=sizes)
+        self.assertEqual(len(splits), 3)
+
+if __name__ == '__main__':
+    unittest.main()
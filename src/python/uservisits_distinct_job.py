@@ -0,0 +1,32 @@
+'''
+Job spec with a sketch accumulator (see jobspec.py and sketches.py):
+approximate distinct visitors per country
+
+  SELECT countryCode, COUNT(DISTINCT sourceIP) FROM uservisits
+  GROUP BY countryCode
+
+Every intermediate record holds a HyperLogLog of 4 KB, however many
+visitors a country has.
+
+Copyright 2016 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+'''
+
+import sketches
+
+KEY_TYPE = str
+ACC_TYPE = sketches.HyperLogLog
+
+# sourceIP is column 0 and countryCode column 5
+def map_line(line):
+    data = line.split(',')
+    return [(data[5], data[0])]
+
+def create(value):
+    return sketches.HyperLogLog().add(value)
+
+def combine(acc, value):
+    return acc.add(value)
+
+def reduce(acc, other):
+    return acc.merge(other)
@@ -0,0 +1,22 @@
+'''
+Default job (see jobspec.py): Amplab benchmark query 2a
+
+  SELECT SUBSTR(sourceIP, 1, 8), SUM(adRevenue) FROM uservisits
+  GROUP BY SUBSTR(sourceIP, 1, 8)
+
+Copyright 2016 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+'''
+
+KEY_TYPE = str
+ACC_TYPE = float
+
+# sourceIP is column 0 and adRevenue column 3
+VECTORIZED = {"keyColumn": 0, "keyWidth": 8, "valueColumn": 3}
+
+def map_line(line):
+    data = line.split(',')
+    return [(data[0][:8], float(data[3]))]
+
+def combine(acc, value):
+    return acc + value